@@ -1,2 +1,18 @@
+from functools import lru_cache
+
 LOG_FORMAT = '%(asctime)-15s %(message)s'
 LOG_LEVEL = 'DEBUG'
+
+DISTRIBUTION_NAME = 'alert-autoconf'
+
+
+@lru_cache(maxsize=None)
+def get_version() -> str:
+    """Version of the installed distribution, read without pkg_resources which takes ~0.1s to import."""
+    try:
+        from importlib.metadata import version
+    except ImportError:  # python 3.7
+        from pkg_resources import get_distribution
+
+        return get_distribution(DISTRIBUTION_NAME).version
+    return version(DISTRIBUTION_NAME)
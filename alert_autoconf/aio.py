@@ -0,0 +1,774 @@
+"""asyncio engine with the synchronization semantics of alert_autoconf.moira.MoiraAlert.
+
+Independent requests overlap: triggers and subscriptions are synchronized at the same
+time, triggers are fetched and written concurrently, contacts are created concurrently.
+Requires the `aio` extra: aiohttp and an asyncio Redis client (redis>=4.2 or
+aioredis>=2).
+"""
+import asyncio
+import json
+import logging
+
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import Dict, Iterable, List, Optional, Set
+
+import aiohttp
+
+from moira_client.client import InvalidJSONError, ResponseStructureError
+
+from alert_autoconf import storage
+from alert_autoconf.concurrency import bounded_gather, chunks, raise_first_error
+from alert_autoconf.models import Alerts, Contact, Subscription, Trigger
+from alert_autoconf.moira import (
+    SKIP_TAGS,
+    build_subscriptions,
+    configured_alerting,
+    contact_key,
+    deletable_subscriptions,
+    filter_subscriptions_by_tags,
+    registered_subscriptions,
+    remote_fingerprint,
+    render_triggers,
+    trigger_json_to_model,
+)
+from alert_autoconf.reconcile import plan_subscriptions, plan_triggers
+from alert_autoconf.snapshot import TriggerCatalog, TriggerSnapshot
+
+
+DEFAULT_CONCURRENCY = 8
+
+SUBSCRIPTION_DEFAULTS = {
+    "enabled": True,
+    "throttling": True,
+    "ignore_warnings": False,
+    "ignore_recoverings": False,
+    "plotting": {"enabled": False, "theme": "light"},
+}
+
+
+def connect_redis(url: str):
+    """Returns an asyncio Redis client for the url."""
+    try:
+        from redis import asyncio as aioredis
+    except ImportError:  # redis < 4.2
+        import aioredis
+    return aioredis.from_url(url)
+
+
+class AsyncMoiraClient:
+    """Moira API client with the interface of moira_client.client.Client, but async.
+    All requests share one aiohttp session, so connections are kept alive.
+    """
+
+    def __init__(
+        self,
+        api_url: str,
+        auth_custom: Optional[dict] = None,
+        auth_user: Optional[str] = None,
+        auth_pass: Optional[str] = None,
+        login: Optional[str] = None,
+        connections: int = DEFAULT_CONCURRENCY,
+        max_tries: int = 1,
+        delay: float = 0,
+        backoff: float = 1,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+        gzip: bool = True,
+    ):
+        """
+        :param api_url: Moira API URL
+        :param auth_custom: additional headers
+        :param auth_user: basic auth user
+        :param auth_pass: basic auth password
+        :param login: X-Webauth-User header
+        :param connections: size of the connection pool
+        :param max_tries: attempts for connection errors and 5xx responses
+        :param delay: seconds before the first retry
+        :param backoff: multiplier of the delay after each retry
+        :param connect_timeout: seconds to connect, None to wait forever
+        :param read_timeout: seconds to wait for each chunk of a response,
+            None to wait forever
+        :param gzip: ask for gzip-compressed responses
+        """
+        self.api_url = api_url if api_url.endswith("/") else api_url + "/"
+        self.headers = {
+            "X-Webauth-User": login or "",
+            "Content-Type": "application/json",
+            "User-Agent": "Python Moira Client",
+            "Accept-Encoding": "gzip" if gzip else "identity",
+        }
+        if auth_custom:
+            self.headers.update(auth_custom)
+        self.auth = (
+            aiohttp.BasicAuth(auth_user, auth_pass) if auth_user and auth_pass else None
+        )
+        self.connections = connections
+        self.max_tries = max_tries
+        self.delay = delay
+        self.backoff = backoff
+        if connect_timeout is None and read_timeout is None:
+            self.timeout = aiohttp.client.DEFAULT_TIMEOUT
+        else:
+            self.timeout = aiohttp.ClientTimeout(
+                sock_connect=connect_timeout, sock_read=read_timeout
+            )
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections),
+                headers=self.headers,
+                auth=self.auth,
+                timeout=self.timeout,
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def get(self, path: str = "", **kwargs):
+        return await self._request("GET", path, **kwargs)
+
+    async def put(self, path: str = "", **kwargs):
+        return await self._request("PUT", path, **kwargs)
+
+    async def delete(self, path: str = "", **kwargs):
+        return await self._request("DELETE", path, **kwargs)
+
+    async def _request(self, method: str, path: str, **kwargs):
+        """
+        :return: decoded JSON response
+        :raises: aiohttp.ClientResponseError
+        :raises: InvalidJSONError
+        """
+        delay = self.delay
+        for attempt in range(1, self.max_tries + 1):
+            try:
+                async with self._get_session().request(
+                    method, self.api_url + path, **kwargs
+                ) as response:
+                    response.raise_for_status()
+                    content = await response.read()
+                break
+            except aiohttp.ClientResponseError as e:
+                if e.status < 500 or attempt == self.max_tries:
+                    raise
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == self.max_tries:
+                    raise
+            await asyncio.sleep(delay)
+            delay *= self.backoff
+
+        try:
+            return json.loads(content)
+        except ValueError:
+            raise InvalidJSONError(content)
+
+
+class AsyncTokenStorage(storage.TokenStorage):
+    """TokenStorage for an asyncio Redis client.
+    The same commands are sent in the same batches.
+    """
+
+    def __init__(self, redis, token: str):
+        super().__init__(redis, token)
+        # created in the running loop, Python < 3.10 binds a lock to a loop
+        self._flush_lock = None
+
+    async def load(self) -> storage.TokenState:
+        pipe = self.redis.pipeline(transaction=False)
+        self._queue_load(pipe)
+        return self._parse_load(await pipe.execute())
+
+    async def save_digest(self, digest: str):
+        await self.redis.set(self.digest_key, digest, ex=storage.CONFIG_DIGEST_TTL)
+
+    async def clear_digest(self):
+        await self.redis.delete(self.digest_key)
+
+    async def get_subscription_owners(
+        self, subscription_ids: Iterable[str]
+    ) -> Dict[str, str]:
+        subscription_ids = list(subscription_ids)
+        if not subscription_ids:
+            return {}
+        owners = await self.redis.hmget(
+            storage.SUBSCRIPTION_OWNERS_KEY, subscription_ids
+        )
+        owners = storage._parse_owners(subscription_ids, owners)
+        missing = [i for i in subscription_ids if i not in owners]
+        if missing:
+            storage._log_scan(len(missing))
+            owners.update(await self.find_subscription_owners(missing))
+        return owners
+
+    async def find_subscription_owners(
+        self, subscription_ids: List[str]
+    ) -> Dict[str, str]:
+        """See storage.find_subscription_owners, the own token is excluded."""
+        excluded_key = storage._alerting_key(self.token)
+        keys = []
+        cursor = None
+        while cursor != 0:
+            cursor, batch = await self.redis.scan(
+                cursor or 0, match=storage.ALERTING_TOKEN_PREFIX + "*"
+            )
+            keys.extend(key for key in batch if key != excluded_key)
+        keys.sort()
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            for subscription_id in subscription_ids:
+                pipe.sismember(key, subscription_id)
+        found = storage._found_ids(subscription_ids, await pipe.execute())
+        return storage._merge_owners(keys, found, None)
+
+    async def flush(self):
+        """See TokenStorage.flush. Coroutines writing concurrently buffer changes
+        while a flush awaits the owners of removed subscriptions, so flushes are
+        serialized and each one writes the changes buffered before it started.
+        """
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            removed = self._removed_subscriptions(pending)
+            indexed = (
+                await self.redis.hmget(storage.SUBSCRIPTION_OWNERS_KEY, removed)
+                if removed
+                else []
+            )
+            pipe = self.redis.pipeline(transaction=True)
+            self._queue_flush(pipe, indexed, pending)
+            await pipe.execute()
+
+    @asynccontextmanager
+    async def batch(self):
+        try:
+            yield self
+        finally:
+            await self.flush()
+
+
+class AsyncMoiraAlert:
+    def __init__(
+        self,
+        client: AsyncMoiraClient,
+        redis,
+        token: str,
+        concurrency: int = DEFAULT_CONCURRENCY,
+    ):
+        """
+        :param client: AsyncMoiraClient
+        :param redis: asyncio Redis client, see connect_redis
+        :param token: unique key the triggers and subscriptions are synchronized by
+        :param concurrency: max number of concurrent Moira requests of one kind
+        """
+        if not isinstance(token, str):
+            raise TypeError("Input argument must be str instance")
+        if not isinstance(concurrency, int) or concurrency < 1:
+            raise ValueError("concurrency must be a positive integer")
+        self.client = client
+        self.redis = redis
+        self.base_token = token
+        self.storage = AsyncTokenStorage(redis, token)
+        self.trigger_token = self.storage.trigger_key
+        self.alerting_token = self.storage.alerting_key
+        self.concurrency = concurrency
+
+        self._is_prefixed = False
+        self._catalog_task = None
+        # ids of Moira triggers by (name, tags, targets),
+        # moira_client looks them up before creating
+        self._ids_by_identity = None
+        self._identity_locks = defaultdict(asyncio.Lock)
+        # subscriptions and contacts fetched by is_up_to_date for the next setup
+        self._prefetched = None
+
+    async def setup(self, data: Alerts):
+        """See MoiraAlert.setup.
+        Triggers and subscriptions are synchronized concurrently, an error in one of
+        them does not interrupt the other one and is raised at the end.
+        """
+        self._is_prefixed = data.version >= 1.1 and len(data.prefix)
+        self._catalog_task = None
+        self._ids_by_identity = None
+        prefetched, self._prefetched = self._prefetched, None
+        state = await self.storage.load()
+        if state.digest is not None:
+            await self.storage.clear_digest()
+        if any(trigger.parents for trigger in data.triggers):
+            # all Moira triggers are needed for the second pass, start loading them now
+            self._catalog_task = asyncio.ensure_future(self._load_trigger_catalog())
+
+        try:
+            results = await asyncio.gather(
+                self._sync_triggers(data.triggers, state),
+                self._create_alerting(data.alerting, state, prefetched),
+                return_exceptions=True,
+            )
+        finally:
+            if self._catalog_task is not None and not self._catalog_task.done():
+                self._catalog_task.cancel()
+            await self.storage.flush()
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def is_up_to_date(self, config_digest: str) -> bool:
+        """See MoiraAlert.is_up_to_date."""
+        self._prefetched = None
+        state = await self.storage.load()
+        if state.digest is None or not state.digest.startswith(config_digest + ":"):
+            return False
+        self._prefetched = await self._fetch_remote()
+        return state.digest == self._digest(config_digest, state, *self._prefetched)
+
+    async def save_digest(self, config_digest: str):
+        """See MoiraAlert.save_digest."""
+        state = await self.storage.load()
+        await self.storage.save_digest(await self._make_digest(config_digest, state))
+
+    async def _make_digest(self, config_digest: str, state: storage.TokenState) -> str:
+        """See MoiraAlert._make_digest, both engines produce the same digest."""
+        return self._digest(config_digest, state, *await self._fetch_remote())
+
+    @staticmethod
+    def _digest(
+        config_digest: str,
+        state: storage.TokenState,
+        subscriptions: List[SimpleNamespace],
+        contacts: List[dict],
+    ) -> str:
+        contacts = [SimpleNamespace(**c) for c in contacts]
+        remote = remote_fingerprint(state, subscriptions, contacts)
+        return "{}:{}".format(config_digest, remote)
+
+    async def _fetch_remote(self) -> tuple:
+        """Subscriptions and contacts of the Moira user."""
+        return tuple(
+            await asyncio.gather(self._fetch_subscriptions(), self._fetch_contacts())
+        )
+
+    async def _sync_triggers(
+        self, triggers_from_file: List[Trigger], state: storage.TokenState
+    ):
+        snapshot = await self._load_trigger_snapshot(
+            triggers_from_file, state.trigger_ids
+        )
+        await self._triggers_worker(
+            triggers_from_file, snapshot, ignore_inheritance=True
+        )
+        await self._triggers_worker(
+            triggers_from_file, snapshot, ignore_inheritance=False
+        )
+
+    async def _fetch_trigger(self, trigger_id: str) -> Optional[dict]:
+        """Returns the trigger or None if it is absent in Moira,
+        like TriggerManager.fetch_by_id.
+        """
+        result = await self.client.get("trigger/" + trigger_id + "/state")
+        if "state" in result:
+            return await self.client.get("trigger/" + trigger_id)
+        elif "trigger_id" not in result:
+            raise ResponseStructureError("invalid api response", result)
+        return None
+
+    async def _fetch_triggers(self, trigger_ids: List[str]) -> List[Optional[dict]]:
+        outcomes = await bounded_gather(
+            self._fetch_trigger, trigger_ids, self.concurrency
+        )
+        raise_first_error(outcomes)
+        return [outcome.result for outcome in outcomes]
+
+    async def _load_trigger_snapshot(
+        self, triggers_from_file: List[Trigger], trigger_ids: Set[str]
+    ) -> TriggerSnapshot:
+        """See MoiraAlert._load_trigger_snapshot."""
+        api_triggers = []
+        redis_has_triggers = bool(trigger_ids)
+        if redis_has_triggers:
+            trigger_ids = list(trigger_ids)
+            logging.debug("Trigger IDs: {!r}".format(sorted(trigger_ids)))
+            missing_ids = []
+            for tid, api_trigger in zip(
+                trigger_ids, await self._fetch_triggers(trigger_ids)
+            ):
+                if not api_trigger:
+                    logging.debug(
+                        "Trigger present in Redis but absent in Moira :: ({})".format(
+                            tid
+                        )
+                    )
+                    missing_ids.append(tid)
+                else:
+                    api_triggers.append(api_trigger)
+            self.storage.remove_triggers(missing_ids)
+        elif self._is_prefixed:
+            custom_tags = {
+                tag for trigger in triggers_from_file for tag in trigger.tags
+            } - SKIP_TAGS
+            api_triggers = await self._fetch_triggers(
+                await self._fetch_assigned_trigger_ids(custom_tags)
+            )
+            logging.debug("Tags: {!r}".format(sorted(custom_tags)))
+
+        return TriggerSnapshot(
+            [trigger_json_to_model(t) for t in api_triggers],
+            registered=redis_has_triggers,
+        )
+
+    async def _fetch_assigned_trigger_ids(self, tags: Set[str]) -> List[str]:
+        """Like TagManager.fetch_assigned_triggers_by_tags of moira_client, only ids."""
+        result = await self.client.get("tag/stats")
+        if "list" not in result:
+            raise ResponseStructureError("list doesn't exist in response", result)
+        return list(
+            {
+                trigger_id
+                for stat in result["list"]
+                if stat.get("name") in tags
+                for trigger_id in stat.get("triggers") or ()
+            }
+        )
+
+    async def _load_trigger_catalog(self) -> TriggerCatalog:
+        result = await self.client.get("trigger")
+        if "list" not in result:
+            raise ResponseStructureError("list doesn't exist in response", result)
+        triggers = [SimpleNamespace(**t) for t in result["list"]]
+        self._ids_by_identity = {}
+        for trigger in triggers:
+            self._ids_by_identity.setdefault(_identity(trigger), trigger.id)
+        return TriggerCatalog(triggers)
+
+    async def _get_trigger_catalog(self) -> TriggerCatalog:
+        if self._catalog_task is None:
+            self._catalog_task = asyncio.ensure_future(self._load_trigger_catalog())
+        return await self._catalog_task
+
+    async def _triggers_worker(
+        self,
+        triggers_from_file: List[Trigger],
+        snapshot: TriggerSnapshot,
+        ignore_inheritance: bool,
+    ):
+        """See MoiraAlert._triggers_worker."""
+        find_parents = None
+        if not ignore_inheritance and any(
+            trigger.parents for trigger in triggers_from_file
+        ):
+            find_parents = (await self._get_trigger_catalog()).resolve
+        triggers = render_triggers(triggers_from_file, find_parents, ignore_inheritance)
+
+        if not triggers_from_file and not snapshot.registered:
+            return
+
+        if not len(snapshot):
+            logging.info(f"Triggers by RedisToken: {self.trigger_token} not found!")
+            snapshot.put_all(await self._save_triggers(triggers))
+            return
+
+        plan = plan_triggers(triggers, snapshot.triggers(), ignore_inheritance)
+        for trigger, api_trigger in plan.to_update:
+            logging.info(f"Updating trigger: {api_trigger.id}")
+            trigger.id = api_trigger.id
+            if ignore_inheritance:
+                trigger.parents = api_trigger.parents
+        snapshot.put_all(
+            await self._save_triggers([trigger for trigger, _ in plan.to_update])
+        )
+
+        # deletes start only when all updates are finished
+        await self._delete_triggers(plan.to_delete, snapshot)
+
+        snapshot.put_all(await self._save_triggers(plan.to_create))
+
+    async def _save_triggers(self, triggers: List[Trigger]) -> List[Trigger]:
+        """See MoiraAlert._create_trigger."""
+        if any(not trigger.id for trigger in triggers):
+            # like moira_client, a new trigger replaces one with the same identity
+            await self._get_trigger_catalog()
+
+        async def save(trigger: Trigger) -> str:
+            trigger_id = await self._put(trigger)
+            self._register_trigger(trigger, trigger_id)
+            return trigger_id
+
+        outcomes = []
+        for chunk in chunks(triggers, storage.REGISTER_CHUNK_SIZE):
+            async with self.storage.batch():
+                chunk_outcomes = await bounded_gather(save, chunk, self.concurrency)
+            outcomes.extend(chunk_outcomes)
+
+        for trigger, (_, error) in zip(triggers, outcomes):
+            if error is not None:
+                logging.error(
+                    f"Failed to save trigger (id :: {trigger.id}; "
+                    f"name :: {trigger.name}; tags :: {{{trigger.tags}}}): "
+                    f"{error!r}"
+                )
+        raise_first_error(outcomes)
+        return triggers
+
+    async def _put(self, trigger: Trigger) -> str:
+        fields = trigger.to_custom_dict()
+        if trigger.id:
+            fields["id"] = trigger.id
+            return await self._put_trigger("trigger/" + trigger.id, fields)
+        key = _identity(trigger)
+        async with self._identity_locks[key]:
+            existing_id = self._ids_by_identity.get(key)
+            if existing_id:
+                fields["id"] = existing_id
+                trigger_id = await self._put_trigger("trigger/" + existing_id, fields)
+            else:
+                trigger_id = await self._put_trigger("trigger", fields)
+            self._ids_by_identity[key] = trigger_id
+            return trigger_id
+
+    def _register_trigger(self, trigger: Trigger, trigger_id: str):
+        """See MoiraAlert._register_trigger."""
+        action = "Update" if trigger.id else "Create"
+        logging.debug(
+            f"{action} trigger (id :: {trigger_id}; name :: {trigger.name}; "
+            f"tags :: {{{trigger.tags}}} )"
+        )
+        self.storage.add_triggers([trigger_id])
+        if self._catalog_task is not None and self._catalog_task.done():
+            self._catalog_task.result().put(trigger_id, trigger.name, trigger.tags)
+        trigger.id = trigger_id
+
+    async def _put_trigger(self, path: str, fields: dict) -> str:
+        result = await self.client.put(path, json=fields)
+        if "id" not in result:
+            raise ResponseStructureError("id not in response", result)
+        return result["id"]
+
+    async def _delete(self, path: str) -> bool:
+        """Like moira_client, a delete succeeded if the response is not JSON."""
+        try:
+            await self.client.delete(path)
+            return False
+        except InvalidJSONError:
+            return True
+
+    async def _delete_triggers(
+        self, triggers: List[Trigger], snapshot: TriggerSnapshot
+    ):
+        """See MoiraAlert._delete_triggers."""
+
+        async def delete(trigger: Trigger) -> bool:
+            logging.debug(
+                f"Delete trigger (id :: {trigger.id}; name :: {trigger.name}; "
+                f"tags :: {{{trigger.tags}}})"
+            )
+            return await self._delete("trigger/" + trigger.id)
+
+        outcomes = await bounded_gather(delete, triggers, self.concurrency)
+
+        async with self.storage.batch():
+            for trigger, (deleted, error) in zip(triggers, outcomes):
+                if error is not None:
+                    logging.error(
+                        f"Failed to delete trigger (id :: {trigger.id}; "
+                        f"name :: {trigger.name}): {error!r}"
+                    )
+                elif deleted:
+                    self.storage.remove_triggers([trigger.id])
+                    snapshot.discard(trigger.id)
+                    if self._catalog_task is not None and self._catalog_task.done():
+                        self._catalog_task.result().discard(trigger.id)
+                    if self._ids_by_identity is not None:
+                        self._ids_by_identity.pop(_identity(trigger), None)
+
+        raise_first_error(outcomes)
+
+    async def _fetch_subscriptions(self) -> List[SimpleNamespace]:
+        result = await self.client.get("subscription")
+        if "list" not in result:
+            raise ResponseStructureError("list doesn't exist in response", result)
+        return [SimpleNamespace(**s) for s in result["list"]]
+
+    async def _fetch_contacts(self) -> List[dict]:
+        result = await self.client.get("user/settings")
+        if "contacts" not in result:
+            raise ResponseStructureError(
+                "'contacts' field doesn't exist in response", result
+            )
+        return result["contacts"]
+
+    async def _add_contact(self, contact: Contact) -> dict:
+        data = {"value": contact.value, "type": contact.type.value}
+        if contact.fallback_value is not None:
+            data["fallback_value"] = contact.fallback_value
+        result = await self.client.put("contact", json=data)
+        if "id" not in result:
+            raise ResponseStructureError("No id in response", result)
+        return {**data, "id": result["id"]}
+
+    async def _index_contacts(
+        self, alerts: List[Subscription], contacts: List[dict]
+    ) -> Dict[tuple, dict]:
+        """Returns contacts of the Moira user indexed by contact_key,
+        contacts of the config missing in Moira are created concurrently, each one once.
+        :param contacts: contacts of the Moira user
+        """
+        current_contacts = {
+            contact_key(c["type"], c["value"], c.get("fallback_value")): c
+            for c in contacts
+        }
+        missing = {}
+        for item in configured_alerting(alerts):
+            for contact in item.contacts + [
+                c for e in item.escalations for c in e.contacts
+            ]:
+                key = contact_key(contact.type, contact.value, contact.fallback_value)
+                if contact.value and key not in current_contacts:
+                    missing.setdefault(key, contact)
+
+        outcomes = await bounded_gather(
+            self._add_contact, list(missing.values()), self.concurrency
+        )
+        raise_first_error(outcomes)
+        current_contacts.update(zip(missing, (outcome.result for outcome in outcomes)))
+        return current_contacts
+
+    async def _get_protected_subscriptions(
+        self, subscriptions: List[SimpleNamespace]
+    ) -> Dict[str, str]:
+        """See MoiraAlert._get_protected_subscriptions."""
+        owners = await self.storage.get_subscription_owners(s.id for s in subscriptions)
+        return {
+            sub_id: token
+            for sub_id, token in owners.items()
+            if token != self.base_token
+        }
+
+    async def _create_alerting(
+        self,
+        alerts: List[Subscription],
+        state: storage.TokenState,
+        prefetched: Optional[tuple] = None,
+    ):
+        """See MoiraAlert._create_alerting.
+        :param prefetched: subscriptions and contacts fetched by is_up_to_date
+        """
+        if not alerts and not state.subscription_ids:
+            return
+
+        all_subscriptions, contacts = prefetched or await self._fetch_remote()
+        current_contacts = await self._index_contacts(alerts, contacts)
+        current_subscriptions = self._current_subscriptions(
+            alerts, state.subscription_ids, all_subscriptions
+        )
+        desired_subscriptions = build_subscriptions(
+            alerts, lambda contacts: self._get_contacts(contacts, current_contacts)
+        )
+        plan = plan_subscriptions(desired_subscriptions, current_subscriptions)
+        await self._delete_subscriptions(plan.to_delete)
+        await self._create_subscriptions(plan.to_create)
+
+    def _current_subscriptions(
+        self,
+        alerts: List[Subscription],
+        subscription_ids: Set[str],
+        subscriptions: List[SimpleNamespace],
+    ) -> List[SimpleNamespace]:
+        """See MoiraAlert._current_subscriptions.
+        :param subscriptions: all subscriptions of the Moira user
+        """
+        if not subscription_ids:
+            return filter_subscriptions_by_tags(alerts, subscriptions)
+        current, absent_ids = registered_subscriptions(subscription_ids, subscriptions)
+        self.storage.remove_subscriptions(absent_ids)
+        return current
+
+    @staticmethod
+    def _get_contacts(
+        contacts: List[Contact], current_contacts: Dict[tuple, dict]
+    ) -> List[Contact]:
+        """See MoiraAlert._get_contacts, missing ones are created by _index_contacts."""
+        result = []
+        for yaml_contact in contacts:
+            if not yaml_contact.value:
+                continue
+            contact = current_contacts[
+                contact_key(
+                    yaml_contact.type, yaml_contact.value, yaml_contact.fallback_value
+                )
+            ]
+            result.append(
+                Contact(
+                    id=contact["id"],
+                    type=contact["type"],
+                    value=contact["value"],
+                    fallback_value=contact.get("fallback_value"),
+                )
+            )
+        return result
+
+    async def _delete_subscriptions(self, subscriptions: List[SimpleNamespace]):
+        """See MoiraAlert._delete_subscriptions."""
+        deletable = deletable_subscriptions(
+            subscriptions, await self._get_protected_subscriptions(subscriptions)
+        )
+        outcomes = await bounded_gather(
+            lambda s: self._delete("subscription/" + s.id), deletable, self.concurrency
+        )
+        async with self.storage.batch():
+            for subscription, (deleted, error) in zip(deletable, outcomes):
+                if error is None and deleted:
+                    self.storage.remove_subscriptions([subscription.id])
+                    logging.debug("Remove subscription :: {}".format(subscription.id))
+        raise_first_error(outcomes)
+
+    async def _create_subscriptions(self, subscriptions: List[Subscription]):
+        """See MoiraAlert._create_subscriptions."""
+        outcomes = await bounded_gather(
+            self._put_subscription, subscriptions, self.concurrency
+        )
+        async with self.storage.batch():
+            for subscription, (subscription_id, error) in zip(subscriptions, outcomes):
+                if error is not None:
+                    logging.error(
+                        f"Failed to save subscription "
+                        f"(tags :: {{{subscription.tags}}}): {error!r}"
+                    )
+                    continue
+                self.storage.add_subscriptions([subscription_id])
+                log_text = (
+                    "Save subscription (id :: {}; contacts :: {{{}}}; tags :: {{{}}} )"
+                )
+                logging.debug(
+                    log_text.format(
+                        subscription_id, subscription.contacts, subscription.tags
+                    )
+                )
+        raise_first_error(outcomes)
+
+    async def _put_subscription(self, subscription: Subscription) -> str:
+        """Like SubscriptionManager.create of moira_client, which adds the defaults."""
+        result = await self.client.put(
+            "subscription",
+            json={**SUBSCRIPTION_DEFAULTS, **subscription.to_custom_dict()},
+        )
+        if "id" not in result:
+            raise ResponseStructureError("id doesn't exist in response", result)
+        return result["id"]
+
+
+def _identity(trigger) -> tuple:
+    return trigger.name, frozenset(trigger.tags), frozenset(trigger.targets)
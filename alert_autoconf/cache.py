@@ -0,0 +1,427 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import zlib
+
+from typing import Callable, Dict, FrozenSet, Iterable, Optional
+
+import pydantic
+
+from alert_autoconf.models import Alerts, Subscription, Trigger, TriggerFile
+
+
+# bump when the file layout changes, files of other versions are ignored
+TRIGGER_CACHE_FORMAT = 1
+SNAPSHOT_CACHE_FORMAT = 1
+# Moira has no cheap check for edits which keep ids and tags (a changed target,
+# a renamed trigger, a contact changed by hand), so cached objects are fetched
+# again at least this often, like storage.CONFIG_DIGEST_TTL
+SNAPSHOT_MAX_AGE = 24 * 60 * 60
+CONFIG_CACHE_FORMAT = 1
+# rendered configs unused for this long are removed
+CONFIG_CACHE_TTL = 7 * 24 * 60 * 60
+VALIDATION_CACHE_FORMAT = 1
+# valid targets stay valid until metrics are removed,
+# invalid ones are usually fixed soon
+VALIDATION_CACHE_TTL = 24 * 60 * 60
+VALIDATION_CACHE_NEGATIVE_TTL = 10 * 60
+
+
+def default_cache_dir() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "alert-autoconf")
+
+
+def _hash(*parts: Optional[str]) -> str:
+    return hashlib.sha256(
+        "\0".join(p or "" for p in parts).encode("utf-8")
+    ).hexdigest()[:32]
+
+
+def atomic_write(path: str, data: bytes):
+    """Writes the file through a temporary file in the same directory and os.replace,
+    so readers see either the old or the new content.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as stream:
+            stream.write(data)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _read_cache(path: str, what: str) -> Optional[dict]:
+    """Content of a zlib-compressed JSON cache file, None if it is absent or unreadable."""
+    try:
+        with open(path, "rb") as stream:
+            return json.loads(zlib.decompress(stream.read()).decode("utf-8"))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, zlib.error) as e:
+        logging.warning(f"Ignoring unreadable {what} cache {path}: {e!r}")
+        return None
+
+
+def _write_cache(path: str, content: dict):
+    atomic_write(
+        path, zlib.compress(json.dumps(content, separators=(",", ":")).encode("utf-8"))
+    )
+
+
+class TriggerCache:
+    """Triggers of one token as they were last fetched from or written to Moira,
+    kept between runs in a zlib-compressed JSON file, see SnapshotCache.trigger_cache.
+
+    Only ids registered in Redis are looked up, so triggers unregistered by any run
+    are never used. A cached trigger is used while Moira has it with the same tags
+    and it is not older than `max_age` seconds. Changes are kept in memory until save().
+    """
+
+    def __init__(self, path: str, max_age: int = SNAPSHOT_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self._entries = None
+        self._dirty = False
+
+    @staticmethod
+    def _schema() -> list:
+        return sorted(Trigger.__fields__)
+
+    def _load(self) -> Dict[str, dict]:
+        if self._entries is None:
+            content = _read_cache(self.path, "trigger") or {}
+            if (
+                content.get("format") == TRIGGER_CACHE_FORMAT
+                and content.get("schema") == self._schema()
+            ):
+                self._entries = content["triggers"]
+            else:
+                self._entries = {}
+        return self._entries
+
+    def get(
+        self,
+        trigger_ids: Iterable[str],
+        remote_tags: Callable[[], Dict[str, FrozenSet[str]]],
+    ) -> Dict[str, Trigger]:
+        """Returns cached triggers which are still in Moira with the same tags.
+        :param trigger_ids: ids registered in Redis
+        :param remote_tags: returns tags of every Moira trigger by id,
+            see MoiraSnapshot.trigger_tags; called only if something is cached
+        """
+        entries = self._load()
+        expired_before = time.time() - self.max_age
+        candidates = {
+            trigger_id: entries[trigger_id]["trigger"]
+            for trigger_id in trigger_ids
+            if trigger_id in entries and entries[trigger_id]["at"] > expired_before
+        }
+        if not candidates:
+            return {}
+        tags = remote_tags()
+        return {
+            trigger_id: Trigger.trusted(trigger)
+            for trigger_id, trigger in candidates.items()
+            if tags.get(trigger_id) == frozenset(trigger["tags"])
+        }
+
+    def put(self, trigger: Trigger):
+        """Remembers a trigger just fetched from or saved to Moira."""
+        self._load()[trigger.id] = {
+            "at": time.time(),
+            "trigger": json.loads(trigger.json()),
+        }
+        self._dirty = True
+
+    def discard(self, trigger_id: str):
+        if self._load().pop(trigger_id, None) is not None:
+            self._dirty = True
+
+    def retain(self, trigger_ids: Iterable[str]):
+        """Drops triggers which are no longer registered in Redis."""
+        entries = self._load()
+        for trigger_id in set(entries) - set(trigger_ids):
+            self.discard(trigger_id)
+
+    def save(self):
+        if not self._dirty:
+            return
+        _write_cache(
+            self.path,
+            {
+                "format": TRIGGER_CACHE_FORMAT,
+                "schema": self._schema(),
+                "triggers": self._entries,
+            },
+        )
+        self._dirty = False
+
+
+class SnapshotCache:
+    """Parts of snapshot.MoiraSnapshot (subscriptions and contacts of the Moira user,
+    the catalog of all triggers) as they were after the last run, kept in a
+    zlib-compressed JSON file in a directory per Moira url and user. Triggers of every
+    token are kept in the same directory, see trigger_cache().
+
+    Every part is stored with the time it was fetched from Moira and is not returned
+    after `max_age` seconds; MoiraSnapshot checks the rest against one tag/stats
+    request. Changes are kept in memory until save().
+    """
+
+    def __init__(self, directory: str, max_age: int = SNAPSHOT_MAX_AGE):
+        self.directory = directory
+        self.path = os.path.join(directory, "moira.cache")
+        self.max_age = max_age
+        self._parts = None
+        self._dirty = False
+
+    @classmethod
+    def for_user(
+        cls,
+        url: str,
+        user: Optional[str],
+        directory: str = None,
+        max_age: int = SNAPSHOT_MAX_AGE,
+    ) -> "SnapshotCache":
+        directory = directory or default_cache_dir()
+        return cls(os.path.join(directory, _hash(url, user)), max_age=max_age)
+
+    def trigger_cache(self, token: str) -> TriggerCache:
+        """Cache of the triggers of `token`."""
+        return TriggerCache(
+            os.path.join(self.directory, _hash(token) + ".cache"), max_age=self.max_age
+        )
+
+    def _load(self) -> Dict[str, dict]:
+        if self._parts is None:
+            content = _read_cache(self.path, "snapshot") or {}
+            if content.get("format") == SNAPSHOT_CACHE_FORMAT:
+                self._parts = content["parts"]
+            else:
+                self._parts = {}
+        return self._parts
+
+    def get(self, part: str) -> Optional[dict]:
+        """Returns {"at": fetch time, "items": [...]} of a part not older than max_age."""
+        entry = self._load().get(part)
+        if entry is not None and entry["at"] > time.time() - self.max_age:
+            return entry
+        return None
+
+    def put(self, part: str, items: list, at: float):
+        """
+        :param items: JSON of the part
+        :param at: when the part was fetched from Moira, our writes keep the time
+        """
+        self._load()[part] = {"at": at, "items": items}
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        _write_cache(self.path, {"format": SNAPSHOT_CACHE_FORMAT, "parts": self._parts})
+        self._dirty = False
+
+
+class ConfigCache:
+    """Configs rendered by config.read_from_file (after prefix and cluster), one
+    zlib-compressed JSON file per file content, cluster name and versions of
+    alert-autoconf and pydantic. Only fields set in the config are stored, so a
+    cached config is rebuilt the way a cold parse builds it, without validation
+    of triggers.
+    """
+
+    def __init__(
+        self, directory: str = None, version: str = "", ttl: int = CONFIG_CACHE_TTL
+    ):
+        """
+        :param directory: cache directory, default_cache_dir()/configs by default
+        :param version: alert-autoconf version,
+            cached configs of other versions are not used
+        :param ttl: seconds after which unused configs are removed
+        """
+        self.directory = directory or os.path.join(default_cache_dir(), "configs")
+        self.version = version
+        self.ttl = ttl
+
+    def key(self, content: bytes, cluster_name: Optional[str]) -> str:
+        digest = hashlib.sha256(content).hexdigest()
+        return _hash(digest, cluster_name, self.version, str(pydantic.VERSION))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".cache")
+
+    def get(self, key: str) -> Optional[Alerts]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as stream:
+                content = json.loads(zlib.decompress(stream.read()).decode("utf-8"))
+            if content.get("format") != CONFIG_CACHE_FORMAT:
+                return None
+            data = _alerts_from_json(content["config"])
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable config cache {path}: {e!r}")
+            return None
+        # the mtime tells how long ago the config was used
+        os.utime(path)
+        return data
+
+    def put(self, key: str, data: Alerts):
+        content = {"format": CONFIG_CACHE_FORMAT, "config": _alerts_to_json(data)}
+        atomic_write(
+            self._path(key),
+            zlib.compress(json.dumps(content, separators=(",", ":")).encode("utf-8")),
+        )
+        self._remove_unused()
+
+    def _remove_unused(self):
+        unused_before = time.time() - self.ttl
+        for entry in os.scandir(self.directory):
+            try:
+                if (
+                    entry.name.endswith(".cache")
+                    and entry.stat().st_mtime < unused_before
+                ):
+                    os.unlink(entry.path)
+            except OSError:
+                pass
+
+
+def _set_fields(model: pydantic.BaseModel) -> dict:
+    """JSON of the fields set in the config, the others have their defaults."""
+    return {
+        k: v for k, v in json.loads(model.json()).items() if k in model.__fields_set__
+    }
+
+
+def _alerts_to_json(data: Alerts) -> dict:
+    content = _set_fields(data)
+    content["triggers"] = [_set_fields(trigger) for trigger in data.triggers]
+    content["alerting"] = [_set_fields(subscription) for subscription in data.alerting]
+    return content
+
+
+def _alerts_from_json(content: dict) -> Alerts:
+    # triggers are the bulk of a config and were validated before they were cached;
+    # subscriptions are few and validated again
+    return Alerts.construct(
+        _fields_set=set(content) & set(Alerts.__fields__),
+        version=content.get("version", Alerts.__fields__["version"].default),
+        prefix=content.get("prefix", Alerts.__fields__["prefix"].default),
+        triggers=[TriggerFile.trusted(trigger) for trigger in content["triggers"]],
+        alerting=[Subscription(**subscription) for subscription in content["alerting"]],
+    )
+
+
+class ValidationCache:
+    """Results of rendering targets by one Graphite render API, kept between runs
+    of validate.py in a zlib-compressed JSON file.
+
+    A target is valid if the response is JSON; invalid targets are stored with the
+    response text, so they are reported the same way. Failed requests are not stored.
+    Valid targets are used for `ttl` seconds, invalid ones for `negative_ttl`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: int = VALIDATION_CACHE_TTL,
+        negative_ttl: int = VALIDATION_CACHE_NEGATIVE_TTL,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self._entries = None
+        self._dirty = False
+
+    @classmethod
+    def for_url(cls, url: str, directory: str = None, **kwargs) -> "ValidationCache":
+        """Cache file of a render API url."""
+        directory = directory or default_cache_dir()
+        return cls(
+            os.path.join(directory, "validation", _hash(url) + ".cache"), **kwargs
+        )
+
+    def _load(self) -> Dict[str, dict]:
+        if self._entries is None:
+            self._entries = {}
+            try:
+                with open(self.path, "rb") as stream:
+                    content = json.loads(zlib.decompress(stream.read()).decode("utf-8"))
+            except FileNotFoundError:
+                return self._entries
+            except (OSError, ValueError, zlib.error) as e:
+                logging.warning(
+                    f"Ignoring unreadable validation cache {self.path}: {e!r}"
+                )
+                return self._entries
+            if content.get("format") == VALIDATION_CACHE_FORMAT:
+                self._entries = content["targets"]
+        return self._entries
+
+    def get(self, targets: Iterable[str]) -> Dict[str, Optional[str]]:
+        """Returns targets with fresh results:
+        None for valid ones, the response text for invalid ones.
+        Other targets are counted as misses.
+        """
+        entries = self._load()
+        found = {}
+        for target in targets:
+            entry = entries.get(target)
+            if entry is not None and self._fresh(entry):
+                found[target] = entry["text"]
+            else:
+                self.misses += 1
+        self.hits += len(found)
+        self.negative_hits += sum(text is not None for text in found.values())
+        return found
+
+    def _fresh(self, entry: dict) -> bool:
+        ttl = self.ttl if entry["text"] is None else self.negative_ttl
+        return entry["at"] > time.time() - ttl
+
+    def put(self, target: str, text: Optional[str]):
+        """
+        :param target: rendered target
+        :param text: None if the target is valid, the response text otherwise
+        """
+        self._load()[target] = {"at": time.time(), "text": text}
+        self._dirty = True
+
+    def summary(self) -> str:
+        return "Validation cache: {} hits ({} invalid), {} misses".format(
+            self.hits, self.negative_hits, self.misses
+        )
+
+    def save(self):
+        if not self._dirty:
+            return
+        # expired results are dropped,
+        # so the file does not grow with every renamed metric
+        entries = {
+            target: entry
+            for target, entry in self._entries.items()
+            if self._fresh(entry)
+        }
+        content = {"format": VALIDATION_CACHE_FORMAT, "targets": entries}
+        atomic_write(
+            self.path,
+            zlib.compress(json.dumps(content, separators=(",", ":")).encode("utf-8")),
+        )
+        self._dirty = False
@@ -0,0 +1,82 @@
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Awaitable,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    TypeVar,
+)
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def bounded_map(func: Callable[[T], R], items: Iterable[T], workers: int) -> List[R]:
+    """Applies `func` to every item using at most `workers` threads.
+    Results are returned in the order of `items`, the first exception is re-raised.
+    With a single worker everything runs in the calling thread.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+def chunks(items: List[T], size: int) -> Iterator[List[T]]:
+    """Splits `items` into consecutive lists of at most `size` items."""
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+class Outcome(NamedTuple):
+    """Result of applying a function to one item: either `result` or `error` is set."""
+
+    result: Optional[object]
+    error: Optional[Exception]
+
+
+def bounded_apply(
+    func: Callable[[T], R], items: Iterable[T], workers: int
+) -> List[Outcome]:
+    """Like bounded_map, but every item is processed even if some of them fail.
+    Outcomes are returned in the order of `items`.
+    """
+
+    def apply(item: T) -> Outcome:
+        try:
+            return Outcome(func(item), None)
+        except Exception as e:
+            return Outcome(None, e)
+
+    return bounded_map(apply, items, workers)
+
+
+async def bounded_gather(
+    func: Callable[[T], Awaitable[R]], items: Iterable[T], limit: int
+) -> List[Outcome]:
+    """Awaits `func` for every item, at most `limit` of them at once.
+    Like bounded_apply, every item is processed and outcomes keep the order of `items`.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def apply(item: T) -> Outcome:
+        async with semaphore:
+            try:
+                return Outcome(await func(item), None)
+            except Exception as e:
+                return Outcome(None, e)
+
+    return list(await asyncio.gather(*(apply(item) for item in items)))
+
+
+def raise_first_error(outcomes: Iterable[Outcome]):
+    for outcome in outcomes:
+        if outcome.error is not None:
+            raise outcome.error
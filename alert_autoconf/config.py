@@ -1,54 +1,249 @@
 import codecs
+import hashlib
+import os
 
 import yaml
-from typing import Optional
+from pydantic import ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.errors import DictError
+from typing import Iterator, Optional, Union
+from yaml.composer import Composer, ComposerError
+from yaml.constructor import FullConstructor
+from yaml.resolver import BaseResolver, Resolver
 
-from alert_autoconf.models import Alerts
+from alert_autoconf.cache import ConfigCache
+from alert_autoconf.models import Alerts, Manifest, Subscription, TriggerFile
 
 
 CLUSTER_NAME_PLACEHOLDER = "{cluster}"
 
+# загрузчик на libyaml в разы быстрее, если PyYAML собран с ним
+YAML_LOADER = getattr(yaml, "CFullLoader", yaml.FullLoader)
 
-def read_from_file(filename: str, cluster_name: Optional[str]) -> Alerts:
+# секции, элементы которых ConfigReader разбирает и проверяет по одному
+STREAMED_SECTIONS = {"triggers": TriggerFile, "alerting": Subscription}
+
+# теги, к которым не добавляется prefix
+PREFIX_SKIP_TAGS = ("ERROR", "WARN", "OK", "NODATA", "MONAD")
+
+
+if hasattr(yaml, "CFullLoader"):
+    from yaml.cyaml import CParser
+
+    class _StreamLoader(CParser, Composer, FullConstructor, Resolver):
+        """События libyaml, из которых узлы собираются по одному,
+        а не всем документом.
+        """
+
+        def __init__(self, stream):
+            CParser.__init__(self, stream)
+            Composer.__init__(self)
+            FullConstructor.__init__(self)
+            Resolver.__init__(self)
+
+
+else:
+    _StreamLoader = yaml.FullLoader
+
+
+def read_from_file(
+    filename: str, cluster_name: Optional[str], cache: ConfigCache = None
+) -> Alerts:
     """
     Читает данные из конфиг файла
     :param filename: имя файла
+    :param cluster_name: имя кластера для подстановки вместо {cluster}
+    :param cache: кэш разобранных конфигураций, ключ - содержимое файла и имя кластера
     :return: словарь конфигурации
     """
-    with codecs.open(filename, "r", encoding="UTF-8") as stream:
-        data = Alerts(**yaml.load(stream, Loader=yaml.FullLoader))
+    with open(filename, "rb") as stream:
+        if cache is None:
+            return _parse(stream, cluster_name)
+        content = stream.read()
+
+    key = cache.key(content, cluster_name)
+    data = cache.get(key)
+    if data is None:
+        data = _parse(content, cluster_name)
+        cache.put(key, data)
+    return data
+
+
+def _parse(content, cluster_name: Optional[str]) -> Alerts:
+    return ConfigReader(content, cluster_name).read()
+
+
+class ConfigReader:
+    """
+    Потоковое чтение конфигурации. Элементы секций triggers и alerting разбираются,
+    проверяются и получают prefix и cluster по одному, так что в памяти остаются
+    только модели, а не дерево всего документа.
+    Элементы выдаются по мере чтения, если version и prefix идут в файле раньше секций,
+    иначе - после чтения всего файла.
+    """
+
+    def __init__(self, stream, cluster_name: Optional[str]):
+        """
+        :param stream: файл, открытый в бинарном режиме, или его содержимое
+        :param cluster_name: имя кластера для подстановки вместо {cluster}
+        """
+        self.stream = stream
+        self.cluster_name = cluster_name
+        # version, prefix и прочие поля вне секций, известны после чтения файла
+        self.header = None
+        self._sections = set()
+
+    def __iter__(self) -> Iterator[Union[TriggerFile, Subscription]]:
+        """
+        :return: триггеры и подписки в порядке файла
+        """
+        loader = _StreamLoader(self.stream)
+        try:
+            yield from self._document(loader)
+        finally:
+            loader.dispose()
+
+    def read(self) -> Alerts:
+        """
+        Читает конфигурацию целиком
+        :return: то же, что Alerts(**yaml.load(...)) после применения prefix и cluster
+        """
+        triggers = []
+        alerting = []
+        for item in self:
+            (triggers if isinstance(item, TriggerFile) else alerting).append(item)
+        return Alerts.construct(
+            _fields_set=self.header.__fields_set__ | self._sections,
+            version=self.header.version,
+            prefix=self.header.prefix,
+            triggers=triggers,
+            alerting=alerting,
+        )
+
+    def _document(self, loader):
+        loader.get_event()
+        if loader.check_event(yaml.StreamEndEvent):
+            # пустой файл
+            yield from self._whole(None)
+            return
+        document = loader.get_event()
+        if _is_plain(
+            loader.peek_event(),
+            yaml.MappingStartEvent,
+            BaseResolver.DEFAULT_MAPPING_TAG,
+        ):
+            loader.get_event()
+            yield from self._mapping(loader)
+        else:
+            yield from self._whole(_construct(loader))
+        loader.get_event()
+        if not loader.check_event(yaml.StreamEndEvent):
+            event = loader.get_event()
+            raise ComposerError(
+                "expected a single document in the stream",
+                document.start_mark,
+                "but found another document",
+                event.start_mark,
+            )
+
+    def _mapping(self, loader):
+        header = {}
+        pending = []
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _construct(loader)
+            model = STREAMED_SECTIONS.get(key)
+            if model is None or not _is_plain(
+                loader.peek_event(),
+                yaml.SequenceStartEvent,
+                BaseResolver.DEFAULT_SEQUENCE_TAG,
+            ):
+                header[key] = _construct(loader)
+                continue
 
-        if data.version < 1.1:
-            return data
+            loader.get_event()
+            self._sections.add(key)
+            index = 0
+            while not loader.check_event(yaml.SequenceEndEvent):
+                item = _validate(model, _construct(loader), key, index)
+                index += 1
+                if self._is_header_known(header):
+                    yield self._render(item)
+                else:
+                    pending.append(item)
+            loader.get_event()
+        loader.get_event()
 
-        prefix = data.prefix
+        self.header = Alerts(**header)
+        # секции с якорем или тегом разобраны вместе с остальными полями
+        for item in pending + self.header.triggers + self.header.alerting:
+            yield self._render(item)
+
+    def _is_header_known(self, header: dict) -> bool:
+        # prefix не нужен конфигурациям версии ниже 1.1
+        if self.header is None and "version" in header:
+            data = Alerts(**header)
+            if data.version < 1.1 or "prefix" in header:
+                self.header = data
+        return self.header is not None
+
+    def _whole(self, value):
+        # документ не словарь или с якорем: разбирается целиком, как раньше
+        self.header = Alerts(**value)
+        for item in self.header.triggers + self.header.alerting:
+            yield self._render(item)
+
+    def _render(
+        self, item: Union[TriggerFile, Subscription]
+    ) -> Union[TriggerFile, Subscription]:
+        if self.header.version < 1.1:
+            return item
 
         # применяем prefix
+        prefix = self.header.prefix
         if len(prefix):
-            skip = ("ERROR", "WARN", "OK", "NODATA", "MONAD")
+            if isinstance(item, TriggerFile):
+                item.name = prefix + item.name
+            item.tags = _apply_prefix(item.tags, prefix)
 
-            for trigger in data.triggers:
-                trigger.name = prefix + trigger.name
-                trigger.tags = [
-                    prefix + tag for tag in trigger.tags if tag not in skip
-                ] + [tag for tag in trigger.tags if tag in skip]
+        # применяем cluster_name
+        _apply_cluster_name(item.tags, self.cluster_name)
+        if isinstance(item, TriggerFile):
+            _apply_cluster_name(item.targets, self.cluster_name)
+            if item.parents:
+                for parent in item.parents:
+                    _apply_cluster_name(parent.tags, self.cluster_name)
+        return item
 
-            for alerting in data.alerting:
-                alerting.tags = [
-                    prefix + tag for tag in alerting.tags if tag not in skip
-                ] + [tag for tag in alerting.tags if tag in skip]
 
-        # применяем cluster_name
-        for trigger in data.triggers:
-            _apply_cluster_name(trigger.tags, cluster_name)
-            _apply_cluster_name(trigger.targets, cluster_name)
-            if trigger.parents:
-                for parent in trigger.parents:
-                    _apply_cluster_name(parent.tags, cluster_name)
-        for alerting in data.alerting:
-            _apply_cluster_name(alerting.tags, cluster_name)
+def _is_plain(event, event_class, default_tag: str) -> bool:
+    # без якоря и явного тега узел можно не собирать целиком
+    return (
+        isinstance(event, event_class)
+        and event.anchor is None
+        and event.tag in (None, "!", default_tag)
+    )
+
+
+def _construct(loader):
+    return loader.construct_document(loader.compose_node(None, None))
+
+
+def _validate(model, value, section: str, index: int):
+    """Проверяет элемент секции,
+    ошибка указывает на него так же, как при проверке Alerts
+    """
+    try:
+        if not isinstance(value, dict):
+            raise DictError()
+        return model(**value)
+    except (ValidationError, DictError) as e:
+        raise ValidationError([ErrorWrapper(e, loc=(section, index))], Alerts)
+
 
-        return data
+def _apply_prefix(tags, prefix):
+    return [prefix + tag for tag in tags if tag not in PREFIX_SKIP_TAGS] + [
+        tag for tag in tags if tag in PREFIX_SKIP_TAGS
+    ]
 
 
 def _apply_cluster_name(strings, cluster_name):
@@ -56,6 +251,36 @@ def _apply_cluster_name(strings, cluster_name):
         if CLUSTER_NAME_PLACEHOLDER in strings[i]:
             if not cluster_name:
                 raise ValueError(
-                    "Config file uses {} but cluster name is not set".format(CLUSTER_NAME_PLACEHOLDER),
+                    "Config file uses {} but cluster name is not set".format(
+                        CLUSTER_NAME_PLACEHOLDER
+                    )
                 )
             strings[i] = strings[i].replace(CLUSTER_NAME_PLACEHOLDER, cluster_name)
+
+
+def config_digest(data: Alerts, version: str = "") -> str:
+    """
+    Возвращает дайджест конфигурации после применения prefix, cluster и defaults
+    :param data: конфигурация
+    :param version: версия alert-autoconf, при обновлении дайджест меняется
+    :return: sha256 в hex
+    """
+    digest = hashlib.sha256(version.encode("utf-8"))
+    digest.update(data.json(sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def read_manifest(filename: str) -> Manifest:
+    """
+    Читает список конфигураций для пакетного запуска.
+    Относительные пути к конфигурациям считаются от каталога манифеста
+    :param filename: имя файла
+    :return: манифест
+    """
+    with codecs.open(filename, "r", encoding="UTF-8") as stream:
+        manifest = Manifest(**(yaml.load(stream, Loader=YAML_LOADER) or {}))
+
+    base_dir = os.path.dirname(filename)
+    for entry in manifest.configs:
+        entry.config = os.path.join(base_dir, entry.config)
+    return manifest
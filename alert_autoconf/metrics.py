@@ -0,0 +1,227 @@
+import json
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from alert_autoconf.cache import atomic_write
+
+
+# Moira API paths of these objects are followed by an object id
+_ID_PREFIXES = ("trigger", "subscription", "contact")
+
+
+def api_endpoint(path: str) -> str:
+    """Moira API path with object ids replaced by {id}, e.g. trigger/{id}/state."""
+    parts = path.split("?")[0].strip("/").split("/")
+    if parts[0] in _ID_PREFIXES and len(parts) > 1:
+        parts[1] = "{id}"
+    return "/".join(parts)
+
+
+class RunMetrics:
+    """Durations and counters of one alert.py run.
+
+    Phases may nest (find_trigger_parents runs inside triggers_pass_2), so their
+    durations are not additive. Counters are thread-safe: Moira requests are
+    made from worker threads.
+    """
+
+    def __init__(self):
+        self.phase_seconds = Counter()
+        self.phase_calls = Counter()
+        self.api_calls = Counter()
+        self.redis_commands = Counter()
+        self.redis_round_trips = 0
+        self.objects = Counter()
+        self.started = time.time()
+        self.success = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.phase_seconds[name] += elapsed
+                self.phase_calls[name] += 1
+
+    def count_api_call(self, method: str, path: str):
+        """Counts a Moira request, the on_request hook of transport.PooledMoira."""
+        with self._lock:
+            self.api_calls[(method, api_endpoint(path))] += 1
+
+    def count_redis_commands(self, *commands: str, round_trips: int = 1):
+        with self._lock:
+            self.redis_commands.update(c.upper() for c in commands)
+            self.redis_round_trips += round_trips
+
+    def tally(self, kind: str, action: str, count: int = 1):
+        """Counts objects by outcome, e.g. tally("trigger", "create")."""
+        if count:
+            with self._lock:
+                self.objects[(kind, action)] += count
+
+    def to_dict(self) -> dict:
+        return {
+            "started": self.started,
+            "success": self.success,
+            "phases": {
+                name: {"seconds": seconds, "calls": self.phase_calls[name]}
+                for name, seconds in sorted(self.phase_seconds.items())
+            },
+            "api_calls": {
+                "{} {}".format(method, endpoint): count
+                for (method, endpoint), count in sorted(self.api_calls.items())
+            },
+            "redis_commands": dict(sorted(self.redis_commands.items())),
+            "redis_round_trips": self.redis_round_trips,
+            "objects": {
+                "{} {}".format(kind, action): count
+                for (kind, action), count in sorted(self.objects.items())
+            },
+        }
+
+    def to_prometheus(self, labels: Optional[Dict[str, str]] = None) -> str:
+        """Metrics in the Prometheus text format,
+        for the node_exporter textfile collector. Every file describes one run,
+        so counts are gauges of that run, not growing counters.
+        """
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples):
+            lines.append("# HELP alert_autoconf_{} {}".format(name, help_text))
+            lines.append("# TYPE alert_autoconf_{} {}".format(name, kind))
+            for sample_labels, value in samples:
+                sample_labels = _format_labels({**(labels or {}), **sample_labels})
+                lines.append(
+                    "alert_autoconf_{}{} {}".format(name, sample_labels, value)
+                )
+
+        metric(
+            "run_timestamp_seconds",
+            "gauge",
+            "Start time of the last run.",
+            [({}, self.started)],
+        )
+        if self.success is not None:
+            metric(
+                "run_success",
+                "gauge",
+                "Whether the last run succeeded.",
+                [({}, int(self.success))],
+            )
+        metric(
+            "phase_seconds",
+            "gauge",
+            "Time spent in a phase in the last run, phases may nest.",
+            [
+                ({"phase": name}, seconds)
+                for name, seconds in sorted(self.phase_seconds.items())
+            ],
+        )
+        metric(
+            "phase_calls",
+            "gauge",
+            "Times a phase was entered in the last run.",
+            [
+                ({"phase": name}, calls)
+                for name, calls in sorted(self.phase_calls.items())
+            ],
+        )
+        metric(
+            "moira_requests",
+            "gauge",
+            "Moira API requests in the last run by method and endpoint.",
+            [
+                ({"method": m, "endpoint": e}, count)
+                for (m, e), count in sorted(self.api_calls.items())
+            ],
+        )
+        metric(
+            "redis_commands",
+            "gauge",
+            "Redis commands in the last run by name.",
+            [
+                ({"command": c}, count)
+                for c, count in sorted(self.redis_commands.items())
+            ],
+        )
+        metric(
+            "redis_round_trips",
+            "gauge",
+            "Redis round trips in the last run, a pipeline is one.",
+            [({}, self.redis_round_trips)],
+        )
+        metric(
+            "objects",
+            "gauge",
+            "Triggers and subscriptions handled in the last run by outcome.",
+            [
+                ({"kind": k, "action": a}, count)
+                for (k, a), count in sorted(self.objects.items())
+            ],
+        )
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path: str):
+        atomic_write(
+            path, json.dumps(self.to_dict(), indent=2, sort_keys=True).encode("utf-8")
+        )
+
+    def write_prometheus(self, path: str, labels: Optional[Dict[str, str]] = None):
+        # the textfile collector may read at any moment,
+        # so the file is replaced atomically
+        atomic_write(path, self.to_prometheus(labels).encode("utf-8"))
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        '{}="{}"'.format(
+            k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for k, v in sorted(labels.items())
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def instrument_redis(redis, metrics: RunMetrics):
+    """Counts commands and round trips of a redis.Redis instance,
+    including its pipelines.
+    """
+    execute_command = redis.execute_command
+    pipeline = redis.pipeline
+
+    def counted_command(*args, **options):
+        metrics.count_redis_commands(str(args[0]))
+        return execute_command(*args, **options)
+
+    def counted_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        queued = []
+        pipe_execute_command = pipe.execute_command
+        pipe_execute = pipe.execute
+
+        def queue(*command_args, **options):
+            queued.append(str(command_args[0]))
+            return pipe_execute_command(*command_args, **options)
+
+        def execute(*execute_args, **execute_kwargs):
+            if queued:
+                metrics.count_redis_commands(*queued)
+                del queued[:]
+            return pipe_execute(*execute_args, **execute_kwargs)
+
+        pipe.execute_command = queue
+        pipe.execute = execute
+        return pipe
+
+    redis.execute_command = counted_command
+    redis.pipeline = counted_pipeline
@@ -1,8 +1,12 @@
+from collections import Counter
+from copy import copy
 from uuid import UUID
 from datetime import time
 from enum import Enum
 from typing import Dict, List, Optional
+from urllib import parse
 from pydantic import BaseModel, AnyHttpUrl, validator, root_validator
+from pydantic.fields import SHAPE_LIST
 
 
 class ContactTypeEnum(Enum):
@@ -51,7 +55,35 @@ class ParentTriggerRef(BaseModel):
         )
 
 
+class CanonicalForm:
+    """Hashable form of a model, equal for models which are compared as equal.
+    The hash is computed once, so comparing forms with different hashes costs O(1).
+    """
+
+    __slots__ = ("values", "_hash")
+
+    def __init__(self, values: tuple):
+        self.values = values
+        self._hash = hash(values)
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, CanonicalForm)
+            and self._hash == other._hash
+            and self.values == other.values
+        )
+
+    def __repr__(self):
+        return f"CanonicalForm({self.values!r})"
+
+
 class Saturation(BaseModel):
+    # the canonical form is kept in a slot, outside of the fields
+    __slots__ = ("_canonical",)
+
     type: str
     fallback: Optional[str] = None
     parameters: Optional[dict] = None
@@ -66,23 +98,62 @@ class Saturation(BaseModel):
             result["extra_parameters"] = self.parameters
         return result
 
+    @classmethod
+    def trusted(cls, values: dict) -> "Saturation":
+        """Like Saturation(**values), but without validation, see Trigger.trusted."""
+        return _construct(
+            cls,
+            {
+                "type": values["type"],
+                "fallback": values.get("fallback"),
+                "parameters": values.get("parameters"),
+            },
+            set(values),
+        )
+
     @classmethod
     def from_moira_client_model(cls, moira_saturation: "moira_client.models.trigger.Saturation"):
         d = moira_saturation.to_dict()
         d["parameters"] = d.pop("extra_parameters", None)
-        return cls(**d)
+        return cls.trusted(d)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        object.__setattr__(self, "_canonical", None)
+
+    def canonical(self) -> CanonicalForm:
+        """Fields as a CanonicalForm, computed once;
+        saturations with equal to_custom_dict() have equal forms.
+        """
+        canonical = getattr(self, "_canonical", None)
+        if canonical is None:
+            parameters = (
+                None if self.parameters is None else _freeze_dict(self.parameters)
+            )
+            canonical = CanonicalForm((self.type, self.fallback, parameters))
+            object.__setattr__(self, "_canonical", canonical)
+        return canonical
 
     def __hash__(self):
-        dct = self.to_custom_dict()
-        return hash(_freeze_dict(dct))
+        return hash(self.canonical())
 
     def __eq__(self, other):
         if isinstance(other, Saturation):
-            return self.to_custom_dict() == other.to_custom_dict()
+            return self.canonical() == other.canonical()
         else:
             raise ValueError("Incomparable types")
 
 
+def _construct(cls, fields: dict, fields_set: set):
+    """Like cls.construct, but __dict__ is `fields` as is: construct of pydantic 1.2
+    puts fields with defaults first, validation keeps the order of __fields__.
+    """
+    model = cls.__new__(cls)
+    object.__setattr__(model, "__dict__", fields)
+    object.__setattr__(model, "__fields_set__", fields_set)
+    return model
+
+
 def _freeze_dict(dct):
     """Tries to freeze a dict to make it hashable."""
     result = []
@@ -95,6 +166,9 @@ def _freeze_dict(dct):
 
 
 class Trigger(BaseModel):
+    # canonical forms with and without parents, kept in slots outside of the fields
+    __slots__ = ("_canonical", "_canonical_own")
+
     id: Optional[str] = None
     name: str
     tags: List[str]
@@ -144,6 +218,66 @@ class Trigger(BaseModel):
 
         return values
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        object.__setattr__(self, "_canonical", None)
+        object.__setattr__(self, "_canonical_own", None)
+
+    def canonical(self, ignore_inheritance: bool = False) -> CanonicalForm:
+        """Form in which the trigger is compared with Moira: every field but id,
+        lists as sets, dashboard urls by panelId and, if `ignore_inheritance`,
+        without parents. Computed once per trigger; assigning a field resets it,
+        changing a list in place does not.
+        """
+        slot = "_canonical_own" if ignore_inheritance else "_canonical"
+        canonical = getattr(self, slot, None)
+        if canonical is None:
+            fields = self.__dict__
+            values = list(map(fields.__getitem__, _CANONICAL_FIELDS))
+            for i in _LIST_INDEXES:
+                values[i] = _canonical_list(values[i])
+            values[_DASHBOARD_INDEX] = _canonical_dashboard(fields["dashboard"])
+            if not ignore_inheritance:
+                values.append(_canonical_list(fields["parents"]))
+            canonical = CanonicalForm(tuple(values))
+            object.__setattr__(self, slot, canonical)
+        return canonical
+
+    def canonical_fields(self, ignore_inheritance: bool = False) -> List[str]:
+        """Names of the fields in canonical().values."""
+        return (
+            list(_CANONICAL_FIELDS)
+            if ignore_inheritance
+            else list(_CANONICAL_FIELDS) + ["parents"]
+        )
+
+    @classmethod
+    def trusted(cls, values: dict) -> "Trigger":
+        """Like Trigger(**values), but without validation, for data which has already
+        been validated: triggers stored in Moira or in the local cache and copies
+        of triggers read from alert.yaml. Values are converted to the field types
+        the way validation converts them; dashboard urls, which need parsing,
+        still go through validation.
+        """
+        if values.get("dashboard"):
+            return cls(**values)
+        fields = {}
+        for name, field in cls.__fields__.items():
+            if name in values:
+                value = values[name]
+                convert = _TRUSTED_CONVERTERS.get(name)
+                fields[name] = (
+                    value if convert is None or value is None else convert(value)
+                )
+            else:
+                # only mutable defaults are copied,
+                # deepcopy of every default costs more than the rest
+                default = field.default
+                fields[name] = (
+                    copy(default) if isinstance(default, (list, dict)) else default
+                )
+        return _construct(cls, fields, set(values) & set(fields))
+
     def to_custom_dict(self) -> Dict:
         return {
             'name': self.name,
@@ -175,9 +309,73 @@ class Trigger(BaseModel):
         }
 
 
+# fields of Trigger.canonical, parents are appended unless inheritance is ignored
+_CANONICAL_FIELDS = tuple(
+    name for name in Trigger.__fields__ if name not in ("id", "parents")
+)
+
+
+_LIST_INDEXES = tuple(
+    i
+    for i, name in enumerate(_CANONICAL_FIELDS)
+    if Trigger.__fields__[name].shape == SHAPE_LIST
+)
+_DASHBOARD_INDEX = _CANONICAL_FIELDS.index("dashboard")
+
+
+def _canonical_list(value):
+    return frozenset(value) if type(value) is list else value
+
+
+def _canonical_dashboard(value) -> Optional[tuple]:
+    # dashboards are the same if they show the same panel
+    if not value:
+        return None
+    panel_id = parse.parse_qs(parse.urlsplit(value).query).get("panelId")
+    return None if panel_id is None else tuple(panel_id)
+
+
+def _to_time(value) -> time:
+    return value if isinstance(value, time) else time.fromisoformat(value)
+
+
+def _to_saturation(value) -> Saturation:
+    return value.copy() if isinstance(value, Saturation) else Saturation.trusted(value)
+
+
+# conversions done by validation of Trigger fields, other fields keep their values
+_TRUSTED_CONVERTERS = {
+    "tags": list,
+    "targets": list,
+    "warn_value": int,
+    "error_value": int,
+    "ttl": int,
+    "ttl_state": TtlStateEnum,
+    "pending_interval": int,
+    "day_disable": lambda days: [DaysEnum(day) for day in days],
+    "time_start": _to_time,
+    "time_end": _to_time,
+    "parents": list,
+    "saturation": lambda saturation: [_to_saturation(s) for s in saturation],
+}
+
+
 class TriggerFile(Trigger):
     parents: Optional[List[ParentTriggerRef]]
 
+    @classmethod
+    def trusted(cls, values: dict) -> "TriggerFile":
+        """Trigger.trusted for triggers of alert.yaml,
+        parents are references by name and tags.
+        """
+        trigger = super().trusted(values)
+        if trigger.parents:
+            trigger.__dict__["parents"] = [
+                p if isinstance(p, ParentTriggerRef) else ParentTriggerRef(**p)
+                for p in trigger.parents
+            ]
+        return trigger
+
 
 class Contact(BaseModel):
     id: Optional[str] = None
@@ -230,3 +428,31 @@ class Alerts(BaseModel):
     prefix: str = ""
     triggers: List[TriggerFile] = []
     alerting: List[Subscription] = []
+
+
+class ManifestEntry(BaseModel):
+    config: str
+    token: Optional[str] = None
+    cluster: Optional[str] = None
+
+    @root_validator
+    def check_token(cls, values):
+        if values.get('token') is None:
+            if values.get('cluster') is None:
+                raise ValueError('At least one of token and cluster is required')
+            values['token'] = 'kubernetes:{}'.format(values['cluster'])
+        return values
+
+
+class Manifest(BaseModel):
+    configs: List[ManifestEntry] = []
+
+    @validator('configs')
+    def check_tokens_unique(cls, v):
+        counts = Counter(entry.token for entry in v)
+        duplicates = sorted(token for token, count in counts.items() if count > 1)
+        if duplicates:
+            raise ValueError(
+                'Every token must be used once, duplicated: ' + ', '.join(duplicates)
+            )
+        return v
@@ -1,20 +1,45 @@
+import hashlib
+import json
 import logging
 import re
+import threading
 
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import time
-from typing import List
-from urllib import parse
+from typing import Callable, Dict, Iterator, List, Set, Tuple
 
 from redis import Redis
 
+from alert_autoconf.cache import SnapshotCache
+from alert_autoconf.metrics import RunMetrics
+from alert_autoconf.concurrency import (
+    bounded_apply,
+    bounded_map,
+    chunks,
+    raise_first_error,
+)
 from alert_autoconf.models import Alerts, Contact, Escalation, Subscription, Trigger, Saturation
+from alert_autoconf.reconcile import (
+    TriggerPlan,
+    plan_subscriptions,
+    plan_triggers,
+    plan_triggers_sharded,
+    render_trigger,
+    subscription_fingerprint,
+)
+from alert_autoconf.snapshot import MoiraSnapshot, TriggerCatalog, TriggerSnapshot
+from alert_autoconf import storage
 
 from moira_client import Moira
 from moira_client.models import (
     Subscription as MoiraSubscription,
     Trigger as MoiraTrigger,
 )
-from moira_client.models.subscription import SubscriptionManager
+
+
+# теги состояний Мойры, по ним не ищутся триггеры токена
+SKIP_TAGS = {"ERROR", "WARN", "OK", "NODATA", "MONAD"}
 
 
 def trigger_moira_to_model(trigger: MoiraTrigger) -> Trigger:
@@ -44,8 +69,9 @@ def trigger_moira_to_model(trigger: MoiraTrigger) -> Trigger:
     if trigger_dict["saturation"]:
         saturation = [Saturation.from_moira_client_model(s) for s in trigger_dict["saturation"]]
 
-    return Trigger(
-        **{
+    # Мойра хранит только проверенные триггеры, повторная валидация pydantic не нужна
+    return Trigger.trusted(
+        {
             **{k: trigger_dict[k] for k in keys if k in trigger_dict},
             "id": trigger_dict.get("_id", None),
             "time_start": time_start,
@@ -60,68 +86,286 @@ def trigger_moira_to_model(trigger: MoiraTrigger) -> Trigger:
     )
 
 
-def _is_same_trigger_but_changed(left: Trigger, right: Trigger):
-    """This only checks some fields of the two triggers.
-    If _is_same_trigger_but_changed(l, r) is True but _is_equal_trigger(l, r) is False,
-    we decide that `l` is actually `r` but with some fields changed,
-    so alert-autoconf will edit `l` to make it `r`.
+def trigger_json_to_model(data: dict) -> Trigger:
+    """
+    Как trigger_moira_to_model, но для триггера в том виде, в котором его возвращает
+    API Мойры
+    :param data: триггер из ответа API
+    :return: триггер
     """
-    return (
-        left.name == right.name
-        and set(left.tags) == set(right.tags)
-        and left.targets == right.targets
+    data = dict(data)
+
+    if "dashboard" in data and not data["dashboard"]:
+        data.pop("dashboard")
+
+    keys = Trigger.__fields__.keys()
+
+    sched = data.get("sched") or {}
+    start_offset = sched.get("startOffset", 0)
+    end_offset = sched.get("endOffset", 1439)
+    # та же проверка, что и в trigger_moira_to_model,
+    # чтобы оба способа давали одинаковый результат
+    _start_hour, _start_minute = divmod(start_offset, 60)
+    time_start = (
+        time(hour=_start_hour, minute=_start_minute)
+        if _start_hour and _start_minute
+        else Trigger.__fields__['time_start'].default
+    )
+    _end_hour, _end_minute = divmod(end_offset, 60)
+    time_end = (
+        time(hour=_end_hour, minute=_end_minute)
+        if _end_hour and _end_minute
+        else Trigger.__fields__['time_end'].default
+    )
+
+    saturation = list()
+    for s in data.get("saturation") or ():
+        s = dict(s)
+        s["parameters"] = s.pop("extra_parameters", None)
+        saturation.append(Saturation.trusted(s))
+
+    return Trigger.trusted(
+        {
+            **{k: data[k] for k in keys if k in data},
+            "time_start": time_start,
+            "time_end": time_end,
+            "day_disable": [
+                d["name"] for d in sched.get("days") or () if not d["enabled"]
+            ],
+            "saturation": saturation,
+        }
     )
 
 
-def _is_equal_trigger(left: Trigger, right: Trigger, ignore_inheritance: bool) -> bool:
-    """This checks ALL fields of the triggers for equality."""
+def render_triggers(
+    triggers_from_file: List[Trigger],
+    find_parents: Callable[[list], List[str]],
+    ignore_inheritance: bool,
+) -> List[Trigger]:
+    """
+    Готовит триггеры из файла к сравнению с Мойрой: ссылки на parent'ов заменяются их id
+    :param triggers_from_file: список триггеров из файла конфигурации
+    :param find_parents: функция, возвращающая id parent'ов по ссылкам
+    :param ignore_inheritance: не учитывать parent'ов триггеров
+    :return: список триггеров
+    """
+    parent_ids = resolve_parents(triggers_from_file, find_parents, ignore_inheritance)
+    return [render_trigger(t, ids) for t, ids in zip(triggers_from_file, parent_ids)]
 
-    trigger_id = getattr(left, "id", None) or getattr(right, "id", None)
 
-    attrs = left.__fields__.keys()
-    for attr in attrs:
-        if attr in ("id",):
-            continue
-        if ignore_inheritance and attr == "parents":
-            continue
+def resolve_parents(
+    triggers_from_file: List[Trigger],
+    find_parents: Callable[[list], List[str]],
+    ignore_inheritance: bool,
+) -> List[List[str]]:
+    """
+    Возвращает id parent'ов каждого триггера из файла
+    :param triggers_from_file: список триггеров из файла конфигурации
+    :param find_parents: функция, возвращающая id parent'ов по ссылкам
+    :param ignore_inheritance: не учитывать parent'ов триггеров
+    :return: списки id в порядке триггеров
+    """
+    return [
+        find_parents(trigger.parents)
+        if not ignore_inheritance and trigger.parents
+        else list()
+        for trigger in triggers_from_file
+    ]
 
-        lv = left.__getattribute__(attr)
-        rv = right.__getattribute__(attr)
 
-        # For fields: dashboard:
-        if attr == "dashboard":
-            l_dashboard = parse.parse_qs(parse.urlsplit(lv).query)
-            r_dashboard = parse.parse_qs(parse.urlsplit(rv).query)
-            if l_dashboard.get("panelId", None) == r_dashboard.get("panelId", None):
-                continue
+def filter_subscriptions_by_tags(
+    alerts: List[Subscription], subscriptions: list
+) -> list:
+    """
+    Возвращает подписки, у которых есть тег из конфиг файла
+    :param alerts: список оповещателей
+    :param subscriptions: подписки пользователя Мойры
+    :return:
+    """
+    tags = {t for s in alerts for t in s.tags}
+    excludes = [
+        "ERROR",
+        "OK",
+        "NODATA",
+        "CRITICAL",
+        "WARN",
+        "Critical",
+        "critical",
+        "MONAD",
+    ]
+
+    def filter_by_tags(s):
+        return (tags & set(s.tags)) - set(excludes)
+
+    return list(filter(filter_by_tags, subscriptions))
+
+
+def contact_key(contact_type, value: str, fallback_value) -> tuple:
+    # в файле тип контакта - ContactTypeEnum, в ответе Мойры - строка
+    return getattr(contact_type, "value", contact_type), value, fallback_value
+
+
+def registered_subscriptions(
+    subscription_ids: Set[str], subscriptions: list
+) -> Tuple[list, List[str]]:
+    """
+    Находит в Мойре подписки, зарегистрированные токеном в Redis
+    :param subscription_ids: id подписок токена, зарегистрированные в Redis
+    :param subscriptions: подписки пользователя Мойры
+    :return: найденные подписки и id отсутствующих в Мойре подписок
+    """
+    by_id = {s.id: s for s in subscriptions}
+    current = []
+    absent_ids = []
+    for subscription_id in subscription_ids:
+        subscription = by_id.get(subscription_id)
+        if subscription is None:
+            logging.debug("Moira subscription absent :: ({})".format(subscription_id))
+            absent_ids.append(subscription_id)
+        else:
+            current.append(subscription)
+    return current, absent_ids
+
+
+def deletable_subscriptions(subscriptions: list, protected: Dict[str, str]) -> list:
+    """
+    Возвращает подписки, которые можно удалить: подписки других токенов пропускаются
+    :param subscriptions: подписки из Мойры, которых нет в конфиг файле
+    :param protected: id подписки -> токен владельца, см. _get_protected_subscriptions
+    :return: список подписок
+    """
+    deletable = []
+    for subscription in subscriptions:
+        if subscription.id in protected:
+            log_text = (
+                "Not removing protected subscription :: {}, protected by token :: {}"
+            )
+            logging.debug(log_text.format(subscription.id, protected[subscription.id]))
+        else:
+            deletable.append(subscription)
+    return deletable
+
+
+def remote_fingerprint(
+    state: storage.TokenState, subscriptions: list, contacts: list
+) -> str:
+    """
+    Отпечаток удаленного состояния токена, одинаковый у MoiraAlert и AsyncMoiraAlert.
+    Подписки других токенов не учитываются, чтобы запись одного токена не сбрасывала
+    дайджесты остальных; токен без зарегистрированных подписок учитывает все подписки.
+    Триггеры не скачиваются, поэтому ручная правка триггера в Мойре будет исправлена
+    при изменении конфигурации, запуске с --force или по истечении
+    storage.CONFIG_DIGEST_TTL
+    :param state: состояние токена в Redis
+    :param subscriptions: подписки пользователя Мойры
+    :param contacts: контакты пользователя Мойры
+    :return: sha256 канонического вида состояния
+    """
 
-        # For fields: list (tags, targets, parents):
-        if type(lv) == list and set(lv) == set(rv):
+    # канонический вид, одинаковый у загруженных из Мойры
+    # и только что сохраненных объектов
+    def dump_subscription(s) -> str:
+        return json.dumps([s.id, subscription_fingerprint(s.__dict__)], default=sorted)
+
+    def dump_contact(c) -> str:
+        key = contact_key(c.type, c.value, getattr(c, "fallback_value", None))
+        return json.dumps([c.id, *key])
+
+    if state.subscription_ids:
+        subscriptions = [s for s in subscriptions if s.id in state.subscription_ids]
+    remote = {
+        "triggers": sorted(state.trigger_ids),
+        "alerting": sorted(state.subscription_ids),
+        "subscriptions": sorted(dump_subscription(s) for s in subscriptions),
+        "contacts": sorted(dump_contact(c) for c in contacts),
+    }
+    return hashlib.sha256(
+        json.dumps(remote, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def configured_alerting(alerts: List[Subscription]) -> Iterator[Subscription]:
+    """
+    Возвращает оповещатели, которые синхронизируются с Мойрой:
+    без контактов и с неподставленным шаблоном в первом контакте пропускаются
+    """
+    for item in alerts:
+        if not item.contacts:
             continue
 
-        # For fields: any
-        if lv == rv:
+        if re.search("{", item.contacts[0].value):
             continue
 
-        if attr != "name":
-            logging.info(f"Detected difference in trigger {trigger_id}, field {attr}: {lv} != {rv}")
-        break
-    else:
-        return True
+        yield item
+
 
-    return False
+def build_subscriptions(
+    alerts: List[Subscription], get_contacts: Callable[[List[Contact]], List[Contact]]
+) -> List[Subscription]:
+    """
+    Строит подписки из блока 'alerting' с контактами, найденными в Мойре
+    :param alerts: список оповещателей
+    :param get_contacts: функция, возвращающая контакты Мойры для контактов из файла
+    :return: список подписок
+    """
+    subscriptions = []
+    for item in configured_alerting(alerts):
+        escalations = []
+        for e in item.escalations:
+            escalations.append(
+                Escalation(
+                    contacts=get_contacts(e.contacts),
+                    offset_in_minutes=e.offset_in_minutes,
+                )
+            )
 
+        contacts = get_contacts(item.contacts)
 
-class MoiraAlert:
-    TRIGGER_TOKEN_PREFIX = "autoconf:token:"
-    ALERTING_TOKEN_PREFIX = "autoconf:token-alerting:"
+        if contacts:
+            subscriptions.append(
+                Subscription(
+                    tags=item.tags,
+                    contacts=contacts,
+                    escalations=escalations,
+                    day_disable=item.day_disable,
+                    time_start=item.time_start,
+                    time_end=item.time_end,
+                )
+            )
+    return subscriptions
 
-    def __init__(self, moira: Moira, redis: Redis, token: str):
+
+class MoiraAlert:
+    TRIGGER_TOKEN_PREFIX = storage.TRIGGER_TOKEN_PREFIX
+    ALERTING_TOKEN_PREFIX = storage.ALERTING_TOKEN_PREFIX
+
+    def __init__(
+        self,
+        moira: Moira,
+        redis: Redis,
+        token: str,
+        fetch_workers: int = 1,
+        write_workers: int = 1,
+        moira_snapshot: MoiraSnapshot = None,
+        plan_workers: int = 1,
+        snapshot_cache: SnapshotCache = None,
+        metrics: RunMetrics = None,
+    ):
         """
 
         :param moira: экземпляр объекта moira_client.Moira
         :param redis: экземпляр объекта redis.Redis
         :param token: уникальный ключ для синхронизации триггеров
+        :param fetch_workers: количество параллельных запросов при загрузке триггеров
+        :param write_workers: количество параллельных запросов при создании, изменении
+            и удалении триггеров
+        :param moira_snapshot: снимок Мойры, общий для нескольких токенов одного
+            запуска; по умолчанию каждый запуск setup загружает Мойру заново
+        :param plan_workers: количество процессов для сравнения триггеров файла
+            с триггерами Мойры
+        :param snapshot_cache: кэш снимка Мойры и триггеров токена между запусками,
+            без него все загружается из Мойры
+        :param metrics: куда записывать длительность этапов и количество изменений
         """
         if not isinstance(moira, Moira):
             raise TypeError("Input argument must be moira_client.Moira instance")
@@ -134,10 +378,31 @@ class MoiraAlert:
         if not isinstance(token, str):
             raise TypeError("Input argument must be str instance")
         self.base_token = token
-        self.trigger_token = self.TRIGGER_TOKEN_PREFIX + token
-        self.alerting_token = self.ALERTING_TOKEN_PREFIX + token
+        self.storage = storage.TokenStorage(redis, token)
+        self.trigger_token = self.storage.trigger_key
+        self.alerting_token = self.storage.alerting_key
+
+        if not isinstance(fetch_workers, int) or fetch_workers < 1:
+            raise ValueError("fetch_workers must be a positive integer")
+        self.fetch_workers = fetch_workers
+
+        if not isinstance(write_workers, int) or write_workers < 1:
+            raise ValueError("write_workers must be a positive integer")
+        self.write_workers = write_workers
+
+        if not isinstance(plan_workers, int) or plan_workers < 1:
+            raise ValueError("plan_workers must be a positive integer")
+        self.plan_workers = plan_workers
+        self._plan_executor = None
+        self._snapshot_cache = snapshot_cache
+        self._trigger_cache = snapshot_cache and snapshot_cache.trigger_cache(token)
+        self.metrics = metrics or RunMetrics()
 
         self._is_prefixed = False
+        self._shared_snapshot = moira_snapshot
+        self._remote = moira_snapshot or MoiraSnapshot(moira, cache=snapshot_cache)
+        # снимок еще не использовался setup, следующий setup его не загружает заново
+        self._remote_is_fresh = True
 
     def setup(self, data: Alerts):
         """
@@ -149,224 +414,415 @@ class MoiraAlert:
         """
 
         self._is_prefixed = data.version >= 1.1 and len(data.prefix)
-        self._triggers_worker(data.triggers, ignore_inheritance=True)
-        self._triggers_worker(data.triggers, ignore_inheritance=False)
-        self._create_alerting(data.alerting)
-
-    def _triggers_worker(self, triggers_from_file: List[Trigger], ignore_inheritance: bool):
+        # снимок, загруженный is_up_to_date перед этим запуском, используется повторно
+        if not self._remote_is_fresh:
+            self._refresh_remote()
+        self._remote_is_fresh = False
+        # Состояние токена читается из Redis за один запрос,
+        # изменения записываются пачками по мере работы
+        state = self.storage.load()
+        if state.digest is not None:
+            # прерванный запуск не должен оставить дайджест старой конфигурации
+            self.storage.clear_digest()
+        try:
+            with self.storage.batch(), self._planning_pool():
+                # Обе фазы работают с одним снимком триггеров,
+                # который обновляется по мере записи
+                with self.metrics.phase("load_triggers"):
+                    snapshot = self._load_trigger_snapshot(
+                        data.triggers, state.trigger_ids
+                    )
+                with self.metrics.phase("triggers_pass_1"):
+                    self._triggers_worker(
+                        data.triggers, snapshot, ignore_inheritance=True
+                    )
+                with self.metrics.phase("triggers_pass_2"):
+                    self._triggers_worker(
+                        data.triggers, snapshot, ignore_inheritance=False
+                    )
+                with self.metrics.phase("alerting"):
+                    self._create_alerting(data.alerting, state)
+        finally:
+            # в кэше только то, что было загружено или записано,
+            # даже если запуск прерван
+            if self._trigger_cache is not None:
+                self._trigger_cache.save()
+            self._remote.save()
+
+    def is_up_to_date(self, config_digest: str) -> bool:
         """
-        Проверяет соответствие триггеров в Мойре с описанными в alert.yaml
-        :param triggers: список триггеров
-        :param is_prefixed: наличие префикса в файле конфигурации
-        :return: None
+        Проверяет, что ни конфигурация, ни состояние Мойры и Redis не менялись
+        с последнего успешного запуска
+        :param config_digest: дайджест конфигурации, см. config.config_digest
+        :return: True, если синхронизацию можно пропустить
         """
+        with self.metrics.phase("is_up_to_date"):
+            state = self.storage.load()
+            if state.digest is None or not state.digest.startswith(config_digest + ":"):
+                return False
+            self._refresh_remote()
+            self._remote_is_fresh = True
+            up_to_date = state.digest == self._make_digest(config_digest, state)
+            self._remote.save()
+            return up_to_date
+
+    def save_digest(self, config_digest: str):
+        """
+        Запоминает дайджест конфигурации и состояния после успешного setup
+        :param config_digest: дайджест конфигурации, см. config.config_digest
+        """
+        with self.metrics.phase("save_digest"):
+            self.storage.save_digest(
+                self._make_digest(config_digest, self.storage.load())
+            )
 
-        # ищем parent'ов для триггеров из файла
-        triggers = []
-        _triggers_from_file_by_id = dict()
-        for trigger in triggers_from_file:
-            trigger_fields = trigger.dict()
-            if not ignore_inheritance and trigger.parents:
-                trigger_fields["parents"] = self._find_trigger_parents(trigger.parents)
-            else:
-                trigger_fields["parents"] = list()
-            del trigger_fields["id"]
-            triggers.append(Trigger(**trigger_fields))
+    def _refresh_remote(self):
+        # общий снимок обновляется только нашими записями,
+        # собственный загружается заново
+        if self._shared_snapshot is None:
+            self._remote = MoiraSnapshot(self.moira, cache=self._snapshot_cache)
 
+    def _make_digest(self, config_digest: str, state: storage.TokenState) -> str:
+        return "{}:{}".format(config_digest, self._remote_fingerprint(state))
+
+    def _remote_fingerprint(self, state: storage.TokenState) -> str:
+        """
+        Дешевый отпечаток удаленного состояния: id токена в Redis, подписки токена и
+        контакты пользователя Мойры (два запроса, с кэшем снимка - один запрос
+        tag/stats), см. remote_fingerprint
+        """
+        return remote_fingerprint(
+            state, self._remote.subscriptions(), self._remote.contacts()
+        )
+
+    def _load_trigger_snapshot(
+        self, triggers_from_file: List[Trigger], trigger_ids: Set[str]
+    ) -> TriggerSnapshot:
+        """
+        Загружает из Мойры триггеры, принадлежащие токену
+        :param triggers_from_file: список триггеров из файла конфигурации
+        :param trigger_ids: id триггеров токена, зарегистрированные в Redis
+        :return: снимок триггеров
+        """
         api_triggers = []
+        cached = {}
         # Ищем триггеры по токену в Redis
-        redis_has_triggers = self.redis.exists(self.trigger_token)
+        redis_has_triggers = bool(trigger_ids)
         if redis_has_triggers:
             logging.debug("Getting trigger IDs from redis")
-            trigger_ids = self.redis.smembers(self.trigger_token)
+            trigger_ids = list(trigger_ids)
             logging.debug("Trigger IDs: {!r}".format(sorted(trigger_ids)))
-            for trigger_id in trigger_ids:
-                tid = trigger_id.decode("utf-8")
-                api_trigger = self.moira.trigger.fetch_by_id(tid)
+            if self._trigger_cache is not None:
+                self._trigger_cache.retain(trigger_ids)
+                cached = self._trigger_cache.get(trigger_ids, self._remote.trigger_tags)
+                logging.debug(
+                    f"Triggers found in cache: {len(cached)} of {len(trigger_ids)}"
+                )
+            fetch_ids = [tid for tid in trigger_ids if tid not in cached]
+            missing_ids = []
+            for tid, api_trigger in zip(fetch_ids, self._fetch_triggers(fetch_ids)):
                 if not api_trigger:
                     text = "Trigger present in Redis but absent in Moira :: ({})"
                     logging.debug(text.format(tid))
-                    self.redis.srem(self.trigger_token, tid)
+                    missing_ids.append(tid)
                 else:
                     api_triggers.append(api_trigger)
+            self.storage.remove_triggers(missing_ids)
         # Триггеры в Redis не зарегистрированы, пробуем найти их по тегам
         else:
             # Актуально только для alert.yaml с указанным prefix
             if self._is_prefixed:
                 logging.debug("Getting trigger IDs from YAML tags")
-                custom_tags = {tag for trigger in triggers for tag in trigger.tags} - {
-                    "ERROR",
-                    "WARN",
-                    "OK",
-                    "NODATA",
-                    "MONAD",
-                }
+                custom_tags = {
+                    tag for trigger in triggers_from_file for tag in trigger.tags
+                } - SKIP_TAGS
                 api_triggers = self.moira.tag.fetch_assigned_triggers_by_tags(
                     custom_tags
                 )
-                api_triggers = [self.moira.trigger.fetch_by_id(t) for t in api_triggers]
+                api_triggers = self._fetch_triggers(api_triggers)
                 logging.debug("Tags: {!r}".format(sorted(custom_tags)))
                 _trigger_ids = [t.id for t in api_triggers]
                 logging.debug("Trigger IDs: {!r}".format(sorted(_trigger_ids)))
 
-        if not triggers_from_file and not redis_has_triggers:
+        # Конвертируем api_triggers в Trigger
+        triggers = [trigger_moira_to_model(t) for t in api_triggers]
+        if redis_has_triggers and self._trigger_cache is not None:
+            for trigger in triggers:
+                self._trigger_cache.put(trigger)
+            # порядок как без кэша: в порядке id из Redis
+            triggers = {t.id: t for t in triggers}
+            triggers.update(cached)
+            triggers = [triggers[tid] for tid in trigger_ids if tid in triggers]
+        return TriggerSnapshot(triggers, registered=bool(redis_has_triggers))
+
+    def _triggers_worker(
+        self,
+        triggers_from_file: List[Trigger],
+        snapshot: TriggerSnapshot,
+        ignore_inheritance: bool,
+    ):
+        """
+        Проверяет соответствие триггеров в Мойре с описанными в alert.yaml
+        :param triggers_from_file: список триггеров
+        :param snapshot: снимок триггеров токена, обновляется по мере изменений в Мойре
+        :param ignore_inheritance: не учитывать parent'ов триггеров
+        :return: None
+        """
+
+        if not triggers_from_file and not snapshot.registered:
             # если триггеров нет ни в файле, ни в Редисе -- выходим, чтобы не удалить лишнего
             return
 
+        alerts_api_triggers = snapshot.triggers()
+
         # Ни одного триггера не найдено
-        if not api_triggers:
+        if not alerts_api_triggers:
             # Создаем триггеры в Мойре
             logging.info(f"Triggers by RedisToken: {self.trigger_token} not found!")
-            self._create_trigger(triggers)
+            triggers = render_triggers(
+                triggers_from_file, self._find_trigger_parents, ignore_inheritance
+            )
+            snapshot.put_all(self._create_trigger(triggers))
             return
 
-        # Конвертируем api_triggers в Trigger
-        alerts_api_triggers = [trigger_moira_to_model(t) for t in api_triggers]
         # Что то да нашлось
-        # Исключаем триггеры, в которых ничего не поменялось
-        triggers_to_create = triggers.copy()
-        for l in triggers:
-            for r in alerts_api_triggers:
-                try:
-                    if triggers_to_create and _is_equal_trigger(l, r, ignore_inheritance):
-                        triggers_to_create.remove(l)
-                except Exception as e:
-                    logging.exception(e)
-
-        # Удаляем все триггеры, которые не соответствуют alert.yaml
-        for api_trigger in alerts_api_triggers:
-            if [
-                trigger
-                for trigger in triggers
-                if _is_same_trigger_but_changed(trigger, api_trigger)
-            ]:
-                for trigger in [
-                    trigger_to_create
-                    for trigger_to_create in triggers_to_create
-                    if _is_same_trigger_but_changed(trigger_to_create, api_trigger)
-                ]:
-                    # Триггер присутствует и в Мойре и в alert.yaml,
-                    # но какие то его поля были изменены.
-                    # Приведем триггер в Мойре к соотвествию с alert.yaml
-                    logging.info(f"Updating trigger: {api_trigger.id}")
-                    trigger.id = api_trigger.id
-                    if ignore_inheritance:
-                        trigger.parents = api_trigger.parents
-                    self._create_trigger([trigger])
-                    triggers_to_create.remove(trigger)
-                    break
-            else:
-                # Триггер присутствует в Редисе и в Мойре, но в alert.yaml его нет. Удаляем.
-                logging.debug(
-                    f"Delete trigger (id :: {api_trigger.id}; name :: {api_trigger.name}; tags :: {{{api_trigger.tags}}})"
-                )
-                if self.moira.trigger.delete(api_trigger.id):
-                    self.redis.srem(self.trigger_token, api_trigger.id)
+        plan = self._plan_triggers(
+            triggers_from_file, alerts_api_triggers, ignore_inheritance
+        )
+        if not ignore_inheritance:
+            # во второй фазе сравниваются все поля, ее результат и считаем итоговым
+            self.metrics.tally("trigger", "unchanged", len(plan.unchanged))
+
+        # Триггер присутствует и в Мойре и в alert.yaml,
+        # но какие то его поля были изменены.
+        # Приведем триггер в Мойре к соотвествию с alert.yaml
+        for trigger, api_trigger in plan.to_update:
+            logging.info(f"Updating trigger: {api_trigger.id}")
+            trigger.id = api_trigger.id
+            if ignore_inheritance:
+                trigger.parents = api_trigger.parents
+        snapshot.put_all(
+            self._create_trigger([trigger for trigger, _ in plan.to_update])
+        )
+
+        # Триггер присутствует в Редисе и в Мойре, но в alert.yaml его нет. Удаляем.
+        # Удаление начинается только после завершения всех изменений
+        self._delete_triggers(plan.to_delete, snapshot)
 
         # Создаем новые триггеры
-        self._create_trigger(triggers_to_create)
+        snapshot.put_all(self._create_trigger(plan.to_create))
+
+    @contextmanager
+    def _planning_pool(self):
+        """
+        Пул процессов для сравнения триггеров, общий для обеих фаз setup.
+        Процессы запускаются при первом использовании, т.е. только для больших
+        конфигураций
+        """
+        if self.plan_workers <= 1:
+            yield
+            return
+        with ProcessPoolExecutor(max_workers=self.plan_workers) as executor:
+            self._plan_executor = executor
+            try:
+                yield
+            finally:
+                self._plan_executor = None
+
+    def _plan_triggers(
+        self,
+        triggers_from_file: List[Trigger],
+        api_triggers: List[Trigger],
+        ignore_inheritance: bool,
+    ) -> TriggerPlan:
+        """
+        Ищет parent'ов для триггеров из файла и сравнивает их с триггерами Мойры,
+        см. reconcile.plan_triggers. При plan_workers > 1 подготовка и сравнение
+        триггеров делятся на части по имени и тегам триггера и выполняются в пуле
+        процессов
+        """
+        if self._plan_executor is None:
+            triggers = render_triggers(
+                triggers_from_file, self._find_trigger_parents, ignore_inheritance
+            )
+            return plan_triggers(triggers, api_triggers, ignore_inheritance)
+        parent_ids = resolve_parents(
+            triggers_from_file, self._find_trigger_parents, ignore_inheritance
+        )
+        return plan_triggers_sharded(
+            triggers_from_file,
+            parent_ids,
+            api_triggers,
+            ignore_inheritance,
+            self._plan_executor,
+            self.plan_workers,
+        )
+
+    def _fetch_triggers(self, trigger_ids: List[str]) -> List[MoiraTrigger]:
+        """
+        Загружает триггеры из Мойры, выполняя до fetch_workers запросов одновременно.
+        Порядок результатов совпадает с порядком trigger_ids,
+        на месте отсутствующих в Мойре триггеров возвращается None.
+        :param trigger_ids: список id триггеров
+        :return: список триггеров
+        """
+        return bounded_map(
+            self.moira.trigger.fetch_by_id, trigger_ids, self.fetch_workers
+        )
 
-    def _create_trigger(self, triggers: List[Trigger]):
+    def _create_trigger(self, triggers: List[Trigger]) -> List[Trigger]:
         """
-        Создает триггеры по конфигурационному файлу
+        Создает триггеры по конфигурационному файлу, выполняя до write_workers запросов
+        одновременно. Ошибка сохранения одного триггера не прерывает сохранение
+        остальных, после регистрации сохраненных триггеров в Redis выбрасывается первая
+        ошибка. Каждый триггер регистрируется сразу после записи, изменения пишутся
+        в Redis частями по storage.REGISTER_CHUNK_SIZE и при прерывании запуска,
+        так что прерванный запуск не создает дубликаты в следующем.
         :param triggers: список триггеров
-        :param is_prefixed: наличие префикса в файле конфигурации
-        :return: None
+        :return: сохраненные триггеры с проставленными id
         """
+        lock = threading.Lock()
 
-        for trigger in triggers:
+        def save(trigger: Trigger) -> MoiraTrigger:
             trigger_fields = trigger.to_custom_dict()
             if trigger.id:
                 trigger_fields["id"] = trigger.id
-                log_text = "Update trigger (id :: {}; name :: {}; tags :: {{{}}} )"
-            else:
-                log_text = "Create trigger (id :: {}; name :: {}; tags :: {{{}}} )"
             tr = self.moira.trigger.create(**trigger_fields)
             tr.save()
-            self.redis.sadd(self.trigger_token, tr.id)
-            logging.debug(log_text.format(tr.id, tr.name, tr.tags))
+            with lock:
+                self._register_trigger(trigger, tr)
+            return tr
+
+        outcomes = []
+        for chunk in chunks(triggers, storage.REGISTER_CHUNK_SIZE):
+            with self.storage.batch():
+                chunk_outcomes = bounded_apply(save, chunk, self.write_workers)
+            outcomes.extend(chunk_outcomes)
+
+        for trigger, (_, error) in zip(triggers, outcomes):
+            if error is not None:
+                logging.error(
+                    f"Failed to save trigger (id :: {trigger.id}; "
+                    f"name :: {trigger.name}; tags :: {{{trigger.tags}}}): {error!r}"
+                )
+                self.metrics.tally("trigger", "error")
+        raise_first_error(outcomes)
+        return triggers
+
+    def _register_trigger(self, trigger: Trigger, tr: MoiraTrigger):
+        """
+        Регистрирует сохраненный триггер в Redis (в буфере storage) и в снимках
+        :param trigger: триггер из файла конфигурации, получает id из Мойры
+        :param tr: сохраненный триггер Мойры
+        """
+        if trigger.id:
+            log_text = "Update trigger (id :: {}; name :: {}; tags :: {{{}}} )"
+            self.metrics.tally("trigger", "update")
+        else:
+            log_text = "Create trigger (id :: {}; name :: {}; tags :: {{{}}} )"
+            self.metrics.tally("trigger", "create")
+        self.storage.add_triggers([tr.id])
+        self._remote.put_trigger(tr.id, tr.name, tr.tags)
+        logging.debug(log_text.format(tr.id, tr.name, tr.tags))
+        trigger.id = tr.id
+        if self._trigger_cache is not None:
+            self._trigger_cache.put(trigger)
+
+    def _delete_triggers(self, triggers: List[Trigger], snapshot: TriggerSnapshot):
+        """
+        Удаляет триггеры из Мойры, выполняя до write_workers запросов одновременно,
+        и снимает их с регистрации в Redis одной транзакцией
+        :param triggers: список триггеров
+        :param snapshot: снимок триггеров токена
+        """
+
+        def delete(trigger: Trigger) -> bool:
+            logging.debug(
+                f"Delete trigger (id :: {trigger.id}; name :: {trigger.name}; "
+                f"tags :: {{{trigger.tags}}})"
+            )
+            return self.moira.trigger.delete(trigger.id)
+
+        outcomes = bounded_apply(delete, triggers, self.write_workers)
+
+        with self.storage.batch():
+            for trigger, (deleted, error) in zip(triggers, outcomes):
+                if error is not None:
+                    logging.error(
+                        f"Failed to delete trigger (id :: {trigger.id}; "
+                        f"name :: {trigger.name}): {error!r}"
+                    )
+                    self.metrics.tally("trigger", "error")
+                elif deleted:
+                    self.metrics.tally("trigger", "delete")
+                    self.storage.remove_triggers([trigger.id])
+                    snapshot.discard(trigger.id)
+                    self._remote.discard_trigger(trigger.id)
+                    if self._trigger_cache is not None:
+                        self._trigger_cache.discard(trigger.id)
+
+        raise_first_error(outcomes)
+
+    def _get_trigger_catalog(self) -> TriggerCatalog:
+        """
+        Возвращает индекс всех триггеров Мойры для поиска parent'ов.
+        Индекс строится один раз за запуск и обновляется при создании
+        и удалении триггеров.
+        :return: индекс триггеров
+        """
+        return self._remote.trigger_catalog()
 
     def _find_trigger_parents(self, parents: "moira_client.models.ParentTriggerRef") -> List[str]:
-        found_parent_ids = []
-        all_triggers = self.moira.trigger.fetch_all()
-        for parent_ref in parents:
-            parent_candidates = [
-                t for t in all_triggers
-                if t.name == parent_ref.name
-                and set(t.tags) == set(parent_ref.tags)
-            ]
-            if len(parent_candidates) == 0:
-                message = "Could not find trigger with name={name}, tags={tags}"
-                raise ValueError(message.format(
-                    name=parent_ref.name,
-                    tags=", ".join(parent_ref.tags),
-                ))
-            elif len(parent_candidates) > 1:
-                message = "Found {num} > 1 triggers with name={name}, tags={tags}"
-                raise ValueError(message.format(
-                    num=len(parent_candidates),
-                    name=parent_ref.name,
-                    tags=", ".join(parent_ref.tags),
-                ))
-            else:
-                found_parent_ids.append(parent_candidates[0].id)
-        return found_parent_ids
+        with self.metrics.phase("find_trigger_parents"):
+            return self._get_trigger_catalog().resolve(parents)
 
     def _get_remote_subscriptions(
-        self, alerts: List[Subscription], subscription_manager: SubscriptionManager
+        self, alerts: List[Subscription]
     ) -> List[MoiraSubscription]:
         """
         Возвращает список всех подписок, которые принадлежат пользователю и имеют тег из конфиг файла
         :param alerts: список оповещателей
         :return:
         """
-        tags = {t for s in alerts for t in s.tags}
-        excludes = [
-            "ERROR",
-            "OK",
-            "NODATA",
-            "CRITICAL",
-            "WARN",
-            "Critical",
-            "critical",
-            "MONAD",
-        ]
-
-        subscriptions = subscription_manager.fetch_all()
+        return filter_subscriptions_by_tags(alerts, self._remote.subscriptions())
 
-        def filter_by_tags(s):
-            return (tags & set(s.tags)) - set(excludes)
-
-        return list(filter(filter_by_tags, subscriptions))
+    def _index_contacts(self, contacts: list) -> Dict[tuple, object]:
+        """
+        Индексирует контакты Мойры по (type, value, fallback_value)
+        :param contacts: контакты текущего пользователя Мойры
+        :return: словарь ключ -> контакт
+        """
+        return {contact_key(c.type, c.value, c.fallback_value): c for c in contacts}
 
     def _get_contacts(
-        self, contacts: List[Contact], current_contacts: list
+        self, contacts: List[Contact], current_contacts: Dict[tuple, object]
     ) -> List[Contact]:
         """
         Функция возвращает список контактов из current_contacts. Если в
         current_contacts контакт отсутствует, посылается запрос на сервер на создание
-        нового контакта. (из ответа берется только поле id)
+        нового контакта (из ответа берется только поле id), созданный контакт
+        добавляется в current_contacts, поэтому за запуск каждый контакт создается
+        один раз.
         :param contacts: список контактов
+        :param current_contacts: контакты Мойры, проиндексированные _index_contacts
         :return:
         """
         contact_array = []
         for yaml_contact in contacts:
             if not yaml_contact.value:
                 continue
-            for current_contact in current_contacts:
-                if (
-                    current_contact.type == yaml_contact.type
-                    and current_contact.value == yaml_contact.value
-                    and current_contact.fallback_value == yaml_contact.fallback_value
-                ):
-                    contact = current_contact
-                    break
-            else:
+            key = contact_key(
+                yaml_contact.type, yaml_contact.value, yaml_contact.fallback_value
+            )
+            contact = current_contacts.get(key)
+            if contact is None:
                 contact = self.moira.contact.add(
                     contact_type=yaml_contact.type.value,
                     value=yaml_contact.value,
                     fallback_value=yaml_contact.fallback_value,
                 )
+                current_contacts[key] = contact
+                self._remote.put_contact(contact)
 
             contact_array.append(
                 Contact(
@@ -380,141 +836,112 @@ class MoiraAlert:
         return contact_array
 
     @staticmethod
-    def _escalations_to_set(escalations):
-        s = sorted(escalations, key=lambda e: e["offset_in_minutes"])
-        return set((e["offset_in_minutes"], tuple(sorted(e["contacts"]))) for e in s)
-
-    @classmethod
-    def _subscription_not_changed(cls, first, second):
-        changed = any(set(first[f]) != set(second[f]) for f in ("tags", "contacts"))
-
-        if changed:
-            return False
+    def _subscription_not_changed(first, second):
+        return subscription_fingerprint(first) == subscription_fingerprint(second)
 
-        changed = any(
-            first['sched'][f] != second['sched'][f]
-            for f in ("startOffset", "endOffset", "tzOffset")
-        )
-
-        if changed:
-            return False
-
-        if first['sched']['days'] != second['sched']['days']:
-            return False
-
-        return cls._escalations_to_set(first["escalations"]) == cls._escalations_to_set(
-            second["escalations"]
-        )
+    def _get_protected_subscriptions(
+        self, subscriptions: List[MoiraSubscription]
+    ) -> Dict[str, str]:
+        """
+        Возвращает подписки, зарегистрированные в Redis другими токенами
+        :param subscriptions: подписки из Мойры
+        :return: словарь id подписки -> токен владельца
+        """
+        owners = self.storage.get_subscription_owners(s.id for s in subscriptions)
+        return {
+            sub_id: token
+            for sub_id, token in owners.items()
+            if token != self.base_token
+        }
 
-    def _create_alerting(self, alerts: List[Subscription]):
+    def _create_alerting(self, alerts: List[Subscription], state: storage.TokenState):
         """
         Функция анализирует, какие контакты нужно удалить/добавить.
         При обновлении списка - те подписки, которые были установлены в Мойре и которые никак
         не меняют файл конфигурации и не удаляются. Сравнение происходит по списку контактов и тегов подписки.
         :param alerts: список оповещателей
+        :param state: состояние токена в Redis
         :return:
         """
-
-        redis_has_alerting = self.redis.exists(self.alerting_token)
-        if redis_has_alerting:
-            logging.debug("Subscription id's from redis")
-
-            all_subscriptions = self.moira.subscription.fetch_all()
-            all_subscriptions = {s.id: s for s in all_subscriptions}
-            current_subscriptions = []
-
-            for subscription_id in self.redis.smembers(self.alerting_token):
-                subscription_id = subscription_id.decode("utf-8")
-                api_subscription = all_subscriptions.get(subscription_id)
-                if not api_subscription:
-                    text = "Moira subscription absent :: ({})"
-                    logging.debug(text.format(subscription_id))
-                    self.redis.srem(self.alerting_token, subscription_id)
-                else:
-                    current_subscriptions.append(api_subscription)
-
-        else:
-            current_subscriptions = self._get_remote_subscriptions(
-                alerts, self.moira.subscription
-            )
-
-        if not alerts and not redis_has_alerting:
+        if not alerts and not state.subscription_ids:
             # if the file and Redis both don't have alerting then exit
             return
 
-        # protect all subscriptions that are already registered in Redis
-        # they should not be deleted
-        protected_sub_ids = dict()
-        for key in self.redis.keys(self.ALERTING_TOKEN_PREFIX + "*"):
-            if key != bytes(self.alerting_token, "ascii"):
-                protected_sub_ids.update({
-                    sub_id: key
-                    for sub_id in self.redis.smembers(key)
-                })
-        # convert bytes to str
-        protected_sub_ids = {k.decode(): v.decode() for k, v in protected_sub_ids.items()}
-
-        current_contacts = self.moira.contact.fetch_by_current_user()
-
-        # Список подписок, которые нужно создать в Мойре
-        new_subscriptions = []
-
-        for item in alerts:
-            if not item.contacts:
-                continue
+        current_subscriptions = self._current_subscriptions(
+            alerts, state.subscription_ids
+        )
+        current_contacts = self._index_contacts(self._remote.contacts())
 
-            if re.search("{", item.contacts[0].value):
-                continue
+        # Подписки из файла конфигурации
+        desired_subscriptions = build_subscriptions(
+            alerts, lambda contacts: self._get_contacts(contacts, current_contacts)
+        )
 
-            escalations = []
-            for e in item.escalations:
-                escalations.append(
-                    Escalation(
-                        contacts=self._get_contacts(e.contacts, current_contacts),
-                        offset_in_minutes=e.offset_in_minutes,
-                    )
-                )
+        plan = plan_subscriptions(desired_subscriptions, current_subscriptions)
+        self.metrics.tally("subscription", "unchanged", len(plan.unchanged))
+        self._delete_subscriptions(plan.to_delete)
+        self._create_subscriptions(plan.to_create)
 
-            contacts = self._get_contacts(item.contacts, current_contacts)
+    def _current_subscriptions(
+        self, alerts: List[Subscription], subscription_ids: Set[str]
+    ) -> List[MoiraSubscription]:
+        """
+        Возвращает подписки токена из Мойры: зарегистрированные в Redis,
+        а если их нет - подписки с тегами из конфиг файла.
+        Отсутствующие в Мойре подписки снимаются с регистрации в Redis
+        :param alerts: список оповещателей
+        :param subscription_ids: id подписок токена, зарегистрированные в Redis
+        :return: список подписок
+        """
+        if not subscription_ids:
+            return self._get_remote_subscriptions(alerts)
+        logging.debug("Subscription id's from redis")
+        current, absent_ids = registered_subscriptions(
+            subscription_ids, self._remote.subscriptions()
+        )
+        self.storage.remove_subscriptions(absent_ids)
+        return current
 
-            if contacts:
-                subscription = Subscription(
-                    tags=item.tags,
-                    contacts=contacts,
-                    escalations=escalations,
-                    day_disable=item.day_disable,
-                    time_start=item.time_start,
-                    time_end=item.time_end,
+    def _delete_subscriptions(self, subscriptions: List[MoiraSubscription]):
+        """
+        Удаляет подписки из Мойры и снимает их с регистрации в Redis.
+        Подписки, зарегистрированные в Redis другими токенами, не удаляются
+        :param subscriptions: подписки из Мойры
+        """
+        deletable = deletable_subscriptions(
+            subscriptions, self._get_protected_subscriptions(subscriptions)
+        )
+        protected_count = len(subscriptions) - len(deletable)
+        self.metrics.tally("subscription", "protected", protected_count)
+
+        with self.storage.batch():
+            for subscription in deletable:
+                if self.moira.subscription.delete(subscription.id):
+                    self.metrics.tally("subscription", "delete")
+                    self.storage.remove_subscriptions([subscription.id])
+                    self._remote.discard_subscription(subscription.id)
+                logging.debug("Remove subscription :: {}".format(subscription.id))
+
+    def _create_subscriptions(self, subscriptions: List[Subscription]):
+        """
+        Создает подписки в Мойре и регистрирует их в Redis
+        :param subscriptions: подписки из файла конфигурации
+        """
+        with self.storage.batch():
+            for new_subscription in subscriptions:
+                sub_id = self.moira.subscription.create(
+                    **new_subscription.to_custom_dict()
                 )
+                sub_id.save()
+                self.storage.add_subscriptions([sub_id.id])
+                self.metrics.tally("subscription", "create")
+                self._remote.put_subscription(sub_id)
 
-                for i, current_subscription in enumerate(current_subscriptions):
-                    if self._subscription_not_changed(
-                        subscription.to_custom_dict(), current_subscription.__dict__
-                    ):
-                        del current_subscriptions[i]
-                        break
-                else:
-                    new_subscriptions.append(subscription)
-
-        for current_subscription in current_subscriptions:
-            if current_subscription.id not in protected_sub_ids:
-                if self.moira.subscription.delete(current_subscription.id):
-                    self.redis.srem(self.alerting_token, current_subscription.id)
-                log_text = "Remove subscription :: {}"
-            else:
-                log_text = "Not removing protected subscription :: {}, protected by token :: %s" % protected_sub_ids[current_subscription.id]
-            logging.debug(log_text.format(current_subscription.id))
-
-        for new_subscription in new_subscriptions:
-            sub_id = self.moira.subscription.create(**new_subscription.to_custom_dict())
-            sub_id.save()
-            self.redis.sadd(self.alerting_token, sub_id.id)
-
-            log_text = (
-                "Save subscription (id :: {}; contacts :: {{{}}}; tags :: {{{}}} )"
-            )
-            logging.debug(
-                log_text.format(
-                    sub_id.id, new_subscription.contacts, new_subscription.tags
+                log_text = (
+                    "Save subscription (id :: {}; contacts :: {{{}}}; tags :: {{{}}} )"
+                )
+                logging.debug(
+                    log_text.format(
+                        sub_id.id, new_subscription.contacts, new_subscription.tags
+                    )
                 )
-            )
@@ -0,0 +1,341 @@
+import logging
+
+from collections import defaultdict, deque
+from concurrent.futures import Executor
+from itertools import repeat
+from typing import Callable, Dict, Hashable, Iterable, List, NamedTuple, Tuple
+
+from alert_autoconf.models import Subscription, Trigger
+
+
+class TriggerPlan(NamedTuple):
+    """Result of comparing triggers from alert.yaml with triggers from Moira.
+    `to_update` holds pairs of (trigger from file, trigger from Moira it replaces).
+    """
+
+    unchanged: List[Trigger]
+    to_update: List[Tuple[Trigger, Trigger]]
+    to_create: List[Trigger]
+    to_delete: List[Trigger]
+
+
+def _is_same_trigger_but_changed(left: Trigger, right: Trigger):
+    """This only checks some fields of the two triggers.
+    If _is_same_trigger_but_changed(l, r) is True but _is_equal_trigger(l, r) is False,
+    we decide that `l` is actually `r` but with some fields changed,
+    so alert-autoconf will edit `l` to make it `r`.
+    """
+    return (
+        left.name == right.name
+        and set(left.tags) == set(right.tags)
+        and left.targets == right.targets
+    )
+
+
+def _is_equal_trigger(left: Trigger, right: Trigger, ignore_inheritance: bool) -> bool:
+    """This checks ALL fields of the triggers for equality, see Trigger.canonical."""
+    if left.canonical(ignore_inheritance) == right.canonical(ignore_inheritance):
+        return True
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        _log_difference(left, right, ignore_inheritance)
+    return False
+
+
+def _log_difference(left: Trigger, right: Trigger, ignore_inheritance: bool):
+    """Logs the first field in which the triggers differ, unless it is the name."""
+    trigger_id = getattr(left, "id", None) or getattr(right, "id", None)
+    fields = zip(
+        left.canonical_fields(ignore_inheritance),
+        left.canonical(ignore_inheritance).values,
+        right.canonical(ignore_inheritance).values,
+    )
+    for attr, left_value, right_value in fields:
+        if left_value != right_value:
+            if attr != "name":
+                lv, rv = getattr(left, attr), getattr(right, attr)
+                logging.info(
+                    f"Detected difference in trigger {trigger_id}, "
+                    f"field {attr}: {lv} != {rv}"
+                )
+            return
+
+
+def _identity_key(trigger: Trigger) -> Hashable:
+    """Key under which _is_same_trigger_but_changed holds."""
+    return trigger.name, frozenset(trigger.tags), tuple(trigger.targets)
+
+
+def _equality_key(trigger: Trigger) -> Hashable:
+    """Key shared by all triggers which may be equal by _is_equal_trigger.
+    Targets are compared as sets there, so their order is not a part of the key.
+    """
+    return trigger.name, frozenset(trigger.tags), frozenset(trigger.targets)
+
+
+def plan_triggers(
+    file_triggers: Iterable[Trigger],
+    api_triggers: Iterable[Trigger],
+    ignore_inheritance: bool,
+) -> TriggerPlan:
+    """Splits triggers into unchanged, updated, created and deleted ones.
+
+    Both sides are indexed by key, so only triggers with the same name,
+    tags and targets are compared, by their canonical forms:
+    * a file trigger equal to any Moira trigger is unchanged;
+    * a Moira trigger with the same identity as a changed file trigger is updated,
+      every file trigger replaces at most one Moira trigger;
+    * a Moira trigger whose identity is absent in the file is deleted;
+    * the remaining file triggers are created.
+    """
+    file_triggers = list(file_triggers)
+    api_triggers = list(api_triggers)
+
+    api_by_equality = _index_by(api_triggers, _equality_key)
+    unchanged = []
+    changed = []
+    for trigger in file_triggers:
+        candidates = api_by_equality.get(_equality_key(trigger), ())
+        if _has_equal_trigger(trigger, candidates, ignore_inheritance):
+            unchanged.append(trigger)
+        else:
+            changed.append(trigger)
+
+    file_identities = {_identity_key(trigger) for trigger in file_triggers}
+    pending_by_identity = _index_by(changed, _identity_key)
+    to_update = []
+    to_delete = []
+    for api_trigger in api_triggers:
+        key = _identity_key(api_trigger)
+        if key not in file_identities:
+            to_delete.append(api_trigger)
+        elif pending_by_identity.get(key):
+            to_update.append((pending_by_identity[key].popleft(), api_trigger))
+
+    updated = {id(trigger) for trigger, _ in to_update}
+    to_create = [trigger for trigger in changed if id(trigger) not in updated]
+
+    return TriggerPlan(
+        unchanged=unchanged,
+        to_update=to_update,
+        to_create=to_create,
+        to_delete=to_delete,
+    )
+
+
+def _index_by(
+    triggers: List[Trigger], key: Callable[[Trigger], Hashable]
+) -> Dict[Hashable, deque]:
+    """Groups triggers by key, keeping their order within a group."""
+    index = defaultdict(deque)
+    for trigger in triggers:
+        index[key(trigger)].append(trigger)
+    return index
+
+
+def _has_equal_trigger(
+    trigger: Trigger, candidates: Iterable[Trigger], ignore_inheritance: bool
+) -> bool:
+    """Whether any of the Moira triggers is equal to the file one,
+    see _is_equal_trigger.
+    """
+    for api_trigger in candidates:
+        try:
+            if _is_equal_trigger(trigger, api_trigger, ignore_inheritance):
+                return True
+        except Exception as e:
+            logging.exception(e)
+    return False
+
+
+def render_trigger(trigger: Trigger, parent_ids: List[str]) -> Trigger:
+    """Copy of a trigger from alert.yaml in the form it is compared with Moira:
+    without id and with `parents` replaced by ids of the parent triggers.
+    """
+    # the trigger has been validated when alert.yaml was read
+    trigger_fields = {
+        name: getattr(trigger, name) for name in Trigger.__fields__ if name != "id"
+    }
+    trigger_fields["parents"] = parent_ids
+    return Trigger.trusted(trigger_fields)
+
+
+# Below this number of triggers pickling them to other processes costs more
+# than the work itself
+SHARDED_PLAN_MIN_TRIGGERS = 1000
+
+
+def _shard_key(trigger: Trigger) -> Hashable:
+    """Part of both _identity_key and _equality_key: triggers compared by plan_triggers
+    always share it, so they always get into the same shard.
+    """
+    return trigger.name, frozenset(trigger.tags)
+
+
+def _plan_shard(
+    file_triggers: List[Trigger],
+    parent_ids: List[List[str]],
+    api_triggers: List[Trigger],
+    ignore_inheritance: bool,
+) -> Tuple[List[int], List[Tuple[int, int]], List[int], List[int], Dict[int, Trigger]]:
+    """Renders and plans one shard, usually in a worker process.
+    Triggers are referred to by position in the shard; only rendered triggers which
+    are going to be saved are returned, the rest is not pickled back.
+    """
+    rendered = [render_trigger(t, ids) for t, ids in zip(file_triggers, parent_ids)]
+    plan = plan_triggers(rendered, api_triggers, ignore_inheritance)
+    file_index = {id(trigger): i for i, trigger in enumerate(rendered)}
+    api_index = {id(trigger): i for i, trigger in enumerate(api_triggers)}
+    to_update = [
+        (file_index[id(t)], api_index[id(api_t)]) for t, api_t in plan.to_update
+    ]
+    to_create = [file_index[id(t)] for t in plan.to_create]
+    return (
+        [file_index[id(t)] for t in plan.unchanged],
+        to_update,
+        to_create,
+        [api_index[id(t)] for t in plan.to_delete],
+        {i: rendered[i] for i in [i for i, _ in to_update] + to_create},
+    )
+
+
+def plan_triggers_sharded(
+    file_triggers: Iterable[Trigger],
+    parent_ids: Iterable[List[str]],
+    api_triggers: Iterable[Trigger],
+    ignore_inheritance: bool,
+    executor: Executor,
+    shards: int,
+) -> TriggerPlan:
+    """Renders triggers from alert.yaml with render_trigger and plans them like
+    plan_triggers, in `shards` parts on `executor`, usually a ProcessPoolExecutor.
+    Triggers are split by name and tags, so every shard is planned independently;
+    the merged plan keeps the order of plan_triggers. `to_update` and `to_create` hold
+    rendered triggers, `unchanged` holds triggers as they were passed.
+    Small inputs are processed in the calling process.
+    :param file_triggers: triggers from alert.yaml
+    :param parent_ids: ids of parents of every file trigger
+    :param api_triggers: triggers from Moira
+    """
+    file_triggers = list(file_triggers)
+    parent_ids = list(parent_ids)
+    api_triggers = list(api_triggers)
+    if len(file_triggers) + len(api_triggers) < SHARDED_PLAN_MIN_TRIGGERS:
+        shards = 1
+
+    file_shards = [[] for _ in range(shards)]
+    parent_shards = [[] for _ in range(shards)]
+    api_shards = [[] for _ in range(shards)]
+    # positions of shard members in the input lists
+    file_positions = [[] for _ in range(shards)]
+    api_positions = [[] for _ in range(shards)]
+    for position, (trigger, ids) in enumerate(zip(file_triggers, parent_ids)):
+        shard = hash(_shard_key(trigger)) % shards
+        file_shards[shard].append(trigger)
+        parent_shards[shard].append(ids)
+        file_positions[shard].append(position)
+    for position, trigger in enumerate(api_triggers):
+        shard = hash(_shard_key(trigger)) % shards
+        api_shards[shard].append(trigger)
+        api_positions[shard].append(position)
+
+    if shards == 1:
+        results = [
+            _plan_shard(file_triggers, parent_ids, api_triggers, ignore_inheritance)
+        ]
+    else:
+        results = executor.map(
+            _plan_shard,
+            file_shards,
+            parent_shards,
+            api_shards,
+            repeat(ignore_inheritance),
+        )
+
+    unchanged, to_update, to_create, to_delete = [], [], [], []
+    rendered = {}
+    for (
+        shard,
+        (shard_unchanged, shard_update, shard_create, shard_delete, shard_rendered),
+    ) in enumerate(results):
+        file_position = file_positions[shard]
+        api_position = api_positions[shard]
+        unchanged.extend(file_position[i] for i in shard_unchanged)
+        to_update.extend((api_position[j], file_position[i]) for i, j in shard_update)
+        to_create.extend(file_position[i] for i in shard_create)
+        to_delete.extend(api_position[j] for j in shard_delete)
+        rendered.update(
+            (file_position[i], trigger) for i, trigger in shard_rendered.items()
+        )
+
+    # plan_triggers lists file triggers in file order and Moira triggers in Moira order
+    return TriggerPlan(
+        unchanged=[file_triggers[i] for i in sorted(unchanged)],
+        to_update=[(rendered[i], api_triggers[j]) for j, i in sorted(to_update)],
+        to_create=[rendered[i] for i in sorted(to_create)],
+        to_delete=[api_triggers[j] for j in sorted(to_delete)],
+    )
+
+
+class SubscriptionPlan(NamedTuple):
+    """Result of comparing subscriptions from alert.yaml with those from Moira."""
+
+    unchanged: List[Subscription]
+    to_create: List[Subscription]
+    to_delete: list
+
+
+def subscription_fingerprint(subscription: Dict) -> Hashable:
+    """Canonical form of a subscription dict, either Subscription.to_custom_dict()
+    or the __dict__ of a moira_client subscription.
+    Two subscriptions have equal fingerprints iff neither of them needs to be changed:
+    tags, contacts and escalations are compared as sets, sched fields and days as is.
+    """
+    sched = subscription["sched"]
+    return (
+        frozenset(subscription["tags"]),
+        frozenset(subscription["contacts"]),
+        sched["startOffset"],
+        sched["endOffset"],
+        sched["tzOffset"],
+        tuple(tuple(sorted(day.items())) for day in sched["days"]),
+        frozenset(
+            (e["offset_in_minutes"], tuple(sorted(e["contacts"])))
+            for e in subscription["escalations"]
+        ),
+    )
+
+
+def plan_subscriptions(
+    desired: Iterable[Subscription], current: Iterable
+) -> SubscriptionPlan:
+    """Splits subscriptions into unchanged, created and deleted ones.
+    Every desired subscription keeps at most one current subscription with the same
+    fingerprint, the first one in `current` order; the rest of `current` is deleted.
+    :param desired: subscriptions from alert.yaml with contact ids resolved
+    :param current: moira_client subscriptions
+    """
+    current = list(current)
+    current_by_fingerprint = defaultdict(deque)
+    for index, subscription in enumerate(current):
+        current_by_fingerprint[subscription_fingerprint(subscription.__dict__)].append(
+            index
+        )
+
+    unchanged = []
+    to_create = []
+    kept = set()
+    for subscription in desired:
+        matches = current_by_fingerprint.get(
+            subscription_fingerprint(subscription.to_custom_dict())
+        )
+        if matches:
+            kept.add(matches.popleft())
+            unchanged.append(subscription)
+        else:
+            to_create.append(subscription)
+
+    return SubscriptionPlan(
+        unchanged=unchanged,
+        to_create=to_create,
+        to_delete=[s for index, s in enumerate(current) if index not in kept],
+    )
@@ -0,0 +1,297 @@
+import json
+import time
+
+from collections import OrderedDict, defaultdict
+from types import SimpleNamespace
+from typing import Dict, FrozenSet, Hashable, Iterable, List, Optional
+
+from alert_autoconf.cache import SnapshotCache
+from alert_autoconf.models import Trigger
+
+
+class TriggerCatalog:
+    """Ids of all Moira triggers indexed by name and set of tags.
+    Used to resolve `parents` references, kept in sync with our own writes.
+    """
+
+    def __init__(self, triggers: Iterable = ()):
+        """
+        :param triggers: Moira triggers, either moira_client or alert_autoconf models
+        """
+        self._ids_by_key = defaultdict(list)
+        self._key_by_id = dict()
+        for trigger in triggers:
+            self.put(trigger.id, trigger.name, trigger.tags)
+
+    @staticmethod
+    def _key(name: str, tags: Iterable[str]) -> Hashable:
+        return name, frozenset(tags)
+
+    def put(self, trigger_id: str, name: str, tags: Iterable[str]):
+        """Adds a trigger or moves it under its new name and tags."""
+        self.discard(trigger_id)
+        key = self._key(name, tags)
+        self._ids_by_key[key].append(trigger_id)
+        self._key_by_id[trigger_id] = key
+
+    def discard(self, trigger_id: str):
+        key = self._key_by_id.pop(trigger_id, None)
+        if key is not None:
+            self._ids_by_key[key].remove(trigger_id)
+
+    def find(self, name: str, tags: Iterable[str]) -> List[str]:
+        """Returns ids of all triggers with exactly this name and set of tags."""
+        return list(self._ids_by_key.get(self._key(name, tags), ()))
+
+    def resolve(self, parents: Iterable) -> List[str]:
+        """Returns ids of parent triggers,
+        every reference must match exactly one trigger.
+        :param parents: ParentTriggerRef list
+        """
+        found_parent_ids = []
+        for parent_ref in parents:
+            parent_candidates = self.find(parent_ref.name, parent_ref.tags)
+            if len(parent_candidates) == 0:
+                message = "Could not find trigger with name={name}, tags={tags}"
+                raise ValueError(
+                    message.format(
+                        name=parent_ref.name, tags=", ".join(parent_ref.tags)
+                    )
+                )
+            elif len(parent_candidates) > 1:
+                message = "Found {num} > 1 triggers with name={name}, tags={tags}"
+                raise ValueError(
+                    message.format(
+                        num=len(parent_candidates),
+                        name=parent_ref.name,
+                        tags=", ".join(parent_ref.tags),
+                    )
+                )
+            else:
+                found_parent_ids.append(parent_candidates[0])
+        return found_parent_ids
+
+    def entries(self) -> List[list]:
+        """[id, name, tags] of every trigger, TriggerCatalog.from_entries takes them."""
+        return [
+            [trigger_id, name, sorted(tags)]
+            for trigger_id, (name, tags) in self._key_by_id.items()
+        ]
+
+    @classmethod
+    def from_entries(cls, entries: Iterable[list]) -> "TriggerCatalog":
+        return cls(
+            SimpleNamespace(id=trigger_id, name=name, tags=tags)
+            for trigger_id, name, tags in entries
+        )
+
+    def __len__(self):
+        return len(self._key_by_id)
+
+
+class TriggerSnapshot:
+    """Triggers of one token as they were in Moira at the start of a run.
+    Our own writes are applied to it in memory, so both setup passes share one download.
+    """
+
+    def __init__(self, triggers: Iterable[Trigger], registered: bool):
+        """
+        :param triggers: triggers converted with moira.trigger_moira_to_model
+        :param registered: whether the token has triggers registered in Redis
+        """
+        self.registered = registered
+        self._triggers = OrderedDict((trigger.id, trigger) for trigger in triggers)
+
+    def triggers(self) -> List[Trigger]:
+        return list(self._triggers.values())
+
+    def put(self, trigger: Trigger):
+        """Adds a saved trigger, replacing the previous version with the same id."""
+        self._triggers[trigger.id] = trigger
+        self.registered = True
+
+    def put_all(self, triggers: Iterable[Trigger]):
+        for trigger in triggers:
+            self.put(trigger)
+
+    def discard(self, trigger_id: str):
+        self._triggers.pop(trigger_id, None)
+
+    def __len__(self):
+        return len(self._triggers)
+
+
+def _public_fields(obj) -> dict:
+    """Fields of a moira_client object as its constructor takes them."""
+    fields = {k: v for k, v in vars(obj).items() if not k.startswith("_")}
+    fields["id"] = obj.id
+    return fields
+
+
+def _subscription_json(subscription) -> dict:
+    fields = _public_fields(subscription)
+    # computed from sched by the constructor
+    fields.pop("disabled_days", None)
+    return fields
+
+
+def _subscription_key(subscription) -> str:
+    return json.dumps(_subscription_json(subscription), sort_keys=True)
+
+
+class MoiraSnapshot:
+    """State of Moira shared by every token synchronized in one run: subscriptions and
+    contacts of the current user and the catalog of all triggers.
+    Every part is fetched on first use, our own writes are applied to it in memory.
+
+    With a SnapshotCache the parts are taken from the previous run instead, when
+    one tag/stats request shows they have not changed: the catalog if every trigger
+    has the same tags, subscriptions if those with contacts of the user are the same.
+    Contacts are only limited by the age of the cache. save() writes them back.
+    """
+
+    def __init__(self, moira, cache: SnapshotCache = None):
+        """
+        :param moira: moira_client.Moira instance
+        :param cache: cache of the previous run, none by default
+        """
+        self._moira = moira
+        self._cache = cache
+        self._subscriptions = None
+        self._contacts = None
+        self._trigger_catalog = None
+        self._tag_stats = None
+        self._trigger_tags = None
+        # fetch time and changed parts for save()
+        self._fetched_at = {}
+        self._changed = set()
+
+    def _loaded(self, part: str, at: float = None):
+        self._fetched_at[part] = at or time.time()
+        if at is None:
+            self._changed.add(part)
+
+    def _cached(self, part: str) -> Optional[dict]:
+        return self._cache.get(part) if self._cache is not None else None
+
+    def _stats(self) -> list:
+        if self._tag_stats is None:
+            self._tag_stats = self._moira.tag.stats()
+        return self._tag_stats
+
+    def trigger_tags(self) -> Dict[str, FrozenSet[str]]:
+        """Tags of every Moira trigger by id, from one tag/stats request."""
+        if self._trigger_tags is None:
+            tags = defaultdict(set)
+            for stat in self._stats():
+                for trigger_id in stat.triggers or ():
+                    tags[trigger_id].add(stat.name)
+            self._trigger_tags = {k: frozenset(v) for k, v in tags.items()}
+        return self._trigger_tags
+
+    def subscriptions(self) -> List:
+        """Returns all subscriptions of the current user."""
+        if self._subscriptions is None:
+            subscriptions = self._cached_subscriptions()
+            if subscriptions is None:
+                subscriptions = self._moira.subscription.fetch_all()
+                self._loaded("subscriptions")
+            self._subscriptions = OrderedDict((s.id, s) for s in subscriptions)
+        return list(self._subscriptions.values())
+
+    def _cached_subscriptions(self) -> Optional[List]:
+        """Subscriptions of tag/stats in the order of the cache, if the ones with
+        contacts of the user are exactly the cached ones.
+        """
+        cached = self._cached("subscriptions")
+        if cached is None:
+            return None
+        contact_ids = {c.id for c in self.contacts()}
+        remote = {
+            s.id: s
+            for stat in self._stats()
+            for s in stat.subscriptions or ()
+            if contact_ids.intersection(s.contacts)
+        }
+        remote_keys = {_subscription_key(s) for s in remote.values()}
+        cached_keys = {json.dumps(s, sort_keys=True) for s in cached["items"]}
+        if remote_keys != cached_keys:
+            return None
+        self._loaded("subscriptions", cached["at"])
+        return [remote[s["id"]] for s in cached["items"]]
+
+    def put_subscription(self, subscription):
+        if self._subscriptions is not None:
+            self._subscriptions[subscription.id] = subscription
+            self._changed.add("subscriptions")
+
+    def discard_subscription(self, subscription_id: str):
+        if self._subscriptions is not None:
+            self._subscriptions.pop(subscription_id, None)
+            self._changed.add("subscriptions")
+
+    def contacts(self) -> List:
+        """Returns all contacts of the current user."""
+        if self._contacts is None:
+            cached = self._cached("contacts")
+            if cached is not None:
+                from moira_client.models.contact import Contact
+
+                self._contacts = [Contact(**c) for c in cached["items"]]
+                self._loaded("contacts", cached["at"])
+            else:
+                self._contacts = list(self._moira.contact.fetch_by_current_user())
+                self._loaded("contacts")
+        return list(self._contacts)
+
+    def put_contact(self, contact):
+        if self._contacts is not None:
+            self._contacts.append(contact)
+            self._changed.add("contacts")
+
+    def trigger_catalog(self) -> TriggerCatalog:
+        """Returns the catalog of all Moira triggers, see TriggerCatalog."""
+        if self._trigger_catalog is None:
+            cached = self._cached("catalog")
+            if cached is not None:
+                catalog = TriggerCatalog.from_entries(cached["items"])
+                tags = {tid: frozenset(t) for tid, _, t in catalog.entries()}
+                if tags == self.trigger_tags():
+                    self._trigger_catalog = catalog
+                    self._loaded("catalog", cached["at"])
+            if self._trigger_catalog is None:
+                self._trigger_catalog = TriggerCatalog(self._moira.trigger.fetch_all())
+                self._loaded("catalog")
+        return self._trigger_catalog
+
+    def put_trigger(self, trigger_id: str, name: str, tags: Iterable[str]):
+        """Updates the catalog if it has been fetched,
+        a later fetch sees the trigger anyway.
+        """
+        if self._trigger_tags is not None:
+            self._trigger_tags[trigger_id] = frozenset(tags)
+        if self._trigger_catalog is not None:
+            self._trigger_catalog.put(trigger_id, name, tags)
+            self._changed.add("catalog")
+
+    def discard_trigger(self, trigger_id: str):
+        if self._trigger_tags is not None:
+            self._trigger_tags.pop(trigger_id, None)
+        if self._trigger_catalog is not None:
+            self._trigger_catalog.discard(trigger_id)
+            self._changed.add("catalog")
+
+    def save(self):
+        """Writes fetched and changed parts to the cache."""
+        if self._cache is None:
+            return
+        for part in self._changed:
+            if part == "subscriptions":
+                items = [_subscription_json(s) for s in self._subscriptions.values()]
+            elif part == "contacts":
+                items = [_public_fields(c) for c in self._contacts]
+            else:
+                items = self._trigger_catalog.entries()
+            self._cache.put(part, items, self._fetched_at[part])
+        self._changed.clear()
+        self._cache.save()
@@ -0,0 +1,283 @@
+import logging
+
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+from redis import Redis
+
+
+TRIGGER_TOKEN_PREFIX = "autoconf:token:"
+ALERTING_TOKEN_PREFIX = "autoconf:token-alerting:"
+# hash: subscription id -> token, whose alerting set holds the subscription
+SUBSCRIPTION_OWNERS_KEY = "autoconf:subscription-owners"
+# string: digest of the rendered config and of the remote state
+# after the last successful run
+CONFIG_DIGEST_PREFIX = "autoconf:config-digest:"
+# a full reconciliation happens at least this often, even if nothing has changed
+CONFIG_DIGEST_TTL = 24 * 60 * 60
+# ids of objects written to Moira are registered at least every this many writes,
+# so a run killed mid-way loses the ids of at most one chunk
+REGISTER_CHUNK_SIZE = 50
+
+
+class TokenState(NamedTuple):
+    trigger_ids: Set[str]
+    subscription_ids: Set[str]
+    digest: Optional[str]
+
+
+def _decode(ids) -> Set[str]:
+    return {i.decode("utf-8") if isinstance(i, bytes) else i for i in ids}
+
+
+class TokenStorage:
+    """Trigger and subscription ids registered in Redis for one token.
+
+    The whole state is read in one pipelined round trip. Changes are buffered
+    and written by flush() in one MULTI/EXEC transaction, so either all buffered
+    ids are (un)registered or none of them are. The subscription owners index
+    is updated in the same transaction as the alerting set; owners of removed
+    subscriptions are read under WATCH, so an index entry taken over by another
+    token in the meantime is not deleted.
+    """
+
+    def __init__(self, redis: Redis, token: str):
+        """
+        :param redis: redis.Redis instance
+        :param token: unique key the triggers and subscriptions are synchronized by
+        """
+        self.redis = redis
+        self.token = token
+        self.trigger_key = TRIGGER_TOKEN_PREFIX + token
+        self.alerting_key = ALERTING_TOKEN_PREFIX + token
+        self.digest_key = CONFIG_DIGEST_PREFIX + token
+        self._pending = []
+
+    def load(self) -> TokenState:
+        """Reads ids of triggers and subscriptions of the token.
+        A set which is absent in Redis is returned empty.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        self._queue_load(pipe)
+        return self._parse_load(pipe.execute())
+
+    def _queue_load(self, pipe):
+        pipe.smembers(self.trigger_key)
+        pipe.smembers(self.alerting_key)
+        pipe.get(self.digest_key)
+
+    @staticmethod
+    def _parse_load(results) -> TokenState:
+        trigger_ids, subscription_ids, digest = results
+        return TokenState(
+            _decode(trigger_ids),
+            _decode(subscription_ids),
+            digest.decode("utf-8") if digest is not None else None,
+        )
+
+    def save_digest(self, digest: str):
+        self.redis.set(self.digest_key, digest, ex=CONFIG_DIGEST_TTL)
+
+    def clear_digest(self):
+        self.redis.delete(self.digest_key)
+
+    def get_subscription_owners(
+        self, subscription_ids: Iterable[str]
+    ) -> Dict[str, str]:
+        """Returns tokens owning the subscriptions, ids without an owner are omitted.
+        Ids missing from the index are looked up in the alerting sets
+        of the other tokens: the index may not be backfilled yet,
+        and alert.py of an older version registers subscriptions without indexing them.
+        """
+        subscription_ids = list(subscription_ids)
+        if not subscription_ids:
+            return {}
+        owners = _parse_owners(
+            subscription_ids,
+            self.redis.hmget(SUBSCRIPTION_OWNERS_KEY, subscription_ids),
+        )
+        missing = [i for i in subscription_ids if i not in owners]
+        if missing:
+            _log_scan(len(missing))
+            owners.update(
+                find_subscription_owners(self.redis, missing, exclude_token=self.token)
+            )
+        return owners
+
+    def add_triggers(self, trigger_ids: Iterable[str]):
+        self._buffer("sadd", self.trigger_key, trigger_ids)
+
+    def remove_triggers(self, trigger_ids: Iterable[str]):
+        self._buffer("srem", self.trigger_key, trigger_ids)
+
+    def add_subscriptions(self, subscription_ids: Iterable[str]):
+        self._buffer("sadd", self.alerting_key, subscription_ids)
+
+    def remove_subscriptions(self, subscription_ids: Iterable[str]):
+        self._buffer("srem", self.alerting_key, subscription_ids)
+
+    def _buffer(self, command: str, key: str, ids: Iterable[str]):
+        ids = list(ids)
+        if not ids:
+            return
+        # consecutive changes of the same kind are merged into one command
+        if self._pending and self._pending[-1][:2] == (command, key):
+            self._pending[-1][2].extend(ids)
+        else:
+            self._pending.append((command, key, ids))
+
+    def flush(self):
+        """Writes all buffered changes in one transaction.
+        The transaction is repeated if the owners of removed subscriptions change
+        between reading them and EXEC.
+        """
+        if not self._pending:
+            return
+        pending = self._pending
+        removed = self._removed_subscriptions(pending)
+
+        def queue(pipe):
+            # immediate while the pipeline is watching
+            indexed = pipe.hmget(SUBSCRIPTION_OWNERS_KEY, removed) if removed else []
+            pipe.multi()
+            self._queue_flush(pipe, indexed, pending)
+
+        watches = [SUBSCRIPTION_OWNERS_KEY] if removed else []
+        self.redis.transaction(queue, *watches)
+        self._pending = []
+
+    def _removed_subscriptions(self, pending: list) -> List[str]:
+        return [
+            subscription_id
+            for command, key, ids in pending
+            if command == "srem" and key == self.alerting_key
+            for subscription_id in ids
+        ]
+
+    def _queue_flush(self, pipe, indexed: list, pending: list):
+        """
+        :param indexed: index entries of _removed_subscriptions(pending)
+            read before the transaction, only entries of the own token are deleted,
+            entries of other tokens are kept
+        :param pending: buffered changes, self._pending when the entries were read
+        """
+        owners = _parse_owners(self._removed_subscriptions(pending), indexed)
+        for command, key, ids in pending:
+            getattr(pipe, command)(key, *ids)
+            if key == self.alerting_key and command == "sadd":
+                for subscription_id in ids:
+                    pipe.hset(SUBSCRIPTION_OWNERS_KEY, subscription_id, self.token)
+                    owners[subscription_id] = self.token
+            elif key == self.alerting_key and command == "srem":
+                owned = [i for i in ids if owners.get(i) == self.token]
+                if owned:
+                    pipe.hdel(SUBSCRIPTION_OWNERS_KEY, *owned)
+
+    @contextmanager
+    def batch(self):
+        """Flushes buffered changes on exit, also when the block is interrupted,
+        so ids of objects already written to Moira are always registered.
+        """
+        try:
+            yield self
+        finally:
+            self.flush()
+
+
+def _parse_owners(subscription_ids: List[str], owners: list) -> Dict[str, str]:
+    return {
+        subscription_id: owner.decode("utf-8")
+        for subscription_id, owner in zip(subscription_ids, owners)
+        if owner is not None
+    }
+
+
+def _log_scan(count: int):
+    logging.info(
+        "Owners of {} subscriptions are not in the index, scanning all tokens. "
+        "Run backfill_owners.py to build it.".format(count)
+    )
+
+
+def scan_subscription_owners(
+    redis: Redis, exclude_token: Optional[str] = None
+) -> Dict[str, str]:
+    """Collects subscription owners from the alerting sets of all tokens.
+    Uses SCAN, so Redis is not blocked, but still reads every alerting set.
+    A subscription registered by several tokens
+    is given to the first one in sorted order.
+    """
+    keys = sorted(redis.scan_iter(match=ALERTING_TOKEN_PREFIX + "*"))
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.smembers(key)
+    return _merge_owners(keys, pipe.execute(), exclude_token)
+
+
+def find_subscription_owners(
+    redis: Redis, subscription_ids: List[str], exclude_token: Optional[str] = None
+) -> Dict[str, str]:
+    """Looks up owners of a few subscriptions in the alerting sets of all tokens.
+    Unlike scan_subscription_owners the sets are not read, only membership
+    of these ids is checked, in one pipelined round trip after SCAN.
+    """
+    if not subscription_ids:
+        return {}
+    excluded_key = exclude_token and _alerting_key(exclude_token)
+    keys = sorted(
+        key
+        for key in redis.scan_iter(match=ALERTING_TOKEN_PREFIX + "*")
+        if key != excluded_key
+    )
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        for subscription_id in subscription_ids:
+            pipe.sismember(key, subscription_id)
+    return _merge_owners(keys, _found_ids(subscription_ids, pipe.execute()), None)
+
+
+def _alerting_key(token: str) -> bytes:
+    return (ALERTING_TOKEN_PREFIX + token).encode("utf-8")
+
+
+def _found_ids(subscription_ids: List[str], found: list) -> List[Set[str]]:
+    """Splits SISMEMBER results, len(subscription_ids) per key, into sets of ids."""
+    step = len(subscription_ids)
+    return [
+        {i for i, is_member in zip(subscription_ids, found[n : n + step]) if is_member}
+        for n in range(0, len(found), step)
+    ]
+
+
+def _merge_owners(
+    keys: list, sets: list, exclude_token: Optional[str]
+) -> Dict[str, str]:
+    owners = defaultdict(list)
+    for key, subscription_ids in zip(keys, sets):
+        token = key.decode("utf-8")[len(ALERTING_TOKEN_PREFIX) :]
+        if token == exclude_token:
+            continue
+        for subscription_id in _decode(subscription_ids):
+            owners[subscription_id].append(token)
+
+    for subscription_id, tokens in owners.items():
+        if len(tokens) > 1:
+            logging.warning(
+                f"Subscription {subscription_id} "
+                f"is registered by several tokens: {tokens}"
+            )
+    return {subscription_id: tokens[0] for subscription_id, tokens in owners.items()}
+
+
+def rebuild_subscription_owners(redis: Redis) -> int:
+    """Fills the subscription owners index from the alerting sets of all tokens.
+    Existing entries are overwritten, so it is safe to run next to alert.py.
+    :return: number of indexed subscriptions
+    """
+    owners = scan_subscription_owners(redis)
+    pipe = redis.pipeline(transaction=True)
+    for subscription_id, token in owners.items():
+        pipe.hset(SUBSCRIPTION_OWNERS_KEY, subscription_id, token)
+    pipe.execute()
+    return len(owners)
@@ -1,5 +1,4 @@
 import os
-import xml.etree.ElementTree as etree
 
 
 def get_teamcity_build_id():
@@ -7,6 +6,9 @@ def get_teamcity_build_id():
     if properties_path is None:
         # not running in Teamcity
         return None
+    # the XML parser is only imported when running in TeamCity
+    import xml.etree.ElementTree as etree
+
     path = properties_path + ".xml"
     xml_tree = etree.parse(path)
     for tag in xml_tree.getroot():
@@ -0,0 +1,198 @@
+import logging
+import time
+
+from typing import Callable, Optional, Tuple
+
+import requests
+
+from moira_client import Moira
+from moira_client.client import Client, InvalidJSONError
+from requests.adapters import HTTPAdapter
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 60.0
+
+# statuses worth another attempt,
+# like the retries of alert_autoconf.aio.AsyncMoiraClient
+RETRY_STATUSES = frozenset((500, 502, 503, 504))
+
+
+class HttpTransport:
+    """HTTP transport of moira_client.
+
+    moira_client sends every request with a new connection and waits for a response
+    forever. The transport sends requests through one requests.Session: connections
+    are kept alive and reused by all worker threads, responses are gzip-compressed
+    if the server supports it, connecting and reading have separate timeouts, and
+    failed requests are retried by the retry policy. Use it through PooledMoira.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        connect_timeout: Optional[float] = DEFAULT_CONNECT_TIMEOUT,
+        read_timeout: Optional[float] = DEFAULT_READ_TIMEOUT,
+        gzip: bool = True,
+        retry_policy=None,
+    ):
+        """
+        :param pool_size: connections kept alive,
+            at least the number of concurrent requests; a request waits
+            for a free connection rather than opening an extra one
+        :param connect_timeout: seconds to connect, None to wait forever
+        :param read_timeout: seconds to wait for each chunk of a response,
+            None to wait forever
+        :param gzip: ask for gzip-compressed responses
+        :param retry_policy: moira_client.RetryPolicy, its max_tries, delay
+            and backoff apply to connection errors, timeouts and 5xx responses;
+            None sends every request once
+        """
+        if pool_size < 1:
+            raise ValueError("pool_size must be at least 1")
+        if retry_policy is not None and retry_policy.max_tries < 1:
+            raise ValueError("max_tries must be at least 1")
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.gzip = gzip
+        self.retry_policy = retry_policy
+        self._session = None
+
+    @property
+    def timeout(self) -> Tuple[Optional[float], Optional[float]]:
+        return self.connect_timeout, self.read_timeout
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.pool_size, pool_block=True
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["Accept-Encoding"] = "gzip" if self.gzip else "identity"
+            self._session = session
+        return self._session
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def request(self, method: str, url: str, **kwargs):
+        """Same as the request methods of moira_client.client.Client.
+        :return: decoded JSON response
+        :raises: HTTPError
+        :raises: InvalidJSONError
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        policy = self.retry_policy
+        max_tries = policy.max_tries if policy is not None else 1
+        delay = policy.delay if policy is not None else 0
+        for attempt in range(1, max_tries + 1):
+            try:
+                response = self.session.request(method, url, **kwargs)
+                response.raise_for_status()
+                break
+            except requests.HTTPError as e:
+                if e.response.status_code not in RETRY_STATUSES or attempt == max_tries:
+                    raise
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == max_tries:
+                    raise
+            logging.debug(
+                f"Retrying {method} {url} in {delay}s, "
+                f"attempt {attempt} of {max_tries} failed"
+            )
+            time.sleep(delay)
+            delay *= policy.backoff
+
+        try:
+            return response.json()
+        except ValueError:
+            raise InvalidJSONError(response.content)
+
+
+class PooledClient(Client):
+    """moira_client.client.Client sending its requests through an HttpTransport."""
+
+    def __init__(
+        self,
+        api_url,
+        transport: HttpTransport,
+        on_request: Optional[Callable[[str, str], None]] = None,
+        **kwargs,
+    ):
+        """
+        :param api_url: str Moira API URL
+        :param transport: HttpTransport, may be shared by several clients
+        :param on_request: called with the method and path of every request,
+            e.g. RunMetrics.count_api_call; retries of a request are not counted
+        :param kwargs: auth_custom, auth_user, auth_pass and login of Client
+        """
+        super().__init__(api_url, **kwargs)
+        self.transport = transport
+        self.on_request = on_request
+
+    def get(self, path="", **kwargs):
+        return self._request("GET", path, **kwargs)
+
+    def put(self, path="", **kwargs):
+        return self._request("PUT", path, **kwargs)
+
+    def post(self, path="", **kwargs):
+        return self._request("POST", path, **kwargs)
+
+    def delete(self, path="", **kwargs):
+        return self._request("DELETE", path, **kwargs)
+
+    def _request(self, method: str, path: str, **kwargs):
+        if self.on_request is not None:
+            self.on_request(method, path)
+        return self.transport.request(
+            method, self.api_url + path, headers=self.headers, auth=self.auth, **kwargs
+        )
+
+
+class PooledMoira(Moira):
+    """moira_client.Moira sending its requests through an HttpTransport."""
+
+    def __init__(
+        self,
+        api_url,
+        transport: HttpTransport,
+        auth_custom=None,
+        auth_user=None,
+        auth_pass=None,
+        login=None,
+        on_request: Optional[Callable[[str, str], None]] = None,
+    ):
+        """
+        :param api_url: str API URL
+        :param transport: HttpTransport, may be shared by several clients
+        :param auth_custom: dict auth custom headers
+        :param auth_user: str auth user
+        :param auth_pass: str auth password
+        :param login: str auth login
+        :param on_request: called with the method and path of every request
+        """
+        super().__init__(api_url, auth_custom, auth_user, auth_pass, login)
+        # the managers of Moira are created lazily over self._client
+        self._client = PooledClient(
+            api_url,
+            transport,
+            auth_custom=auth_custom,
+            auth_user=auth_user,
+            auth_pass=auth_pass,
+            login=login,
+            on_request=on_request,
+        )
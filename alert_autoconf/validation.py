@@ -0,0 +1,254 @@
+import glob
+import logging
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from alert_autoconf.cache import ValidationCache
+from alert_autoconf.concurrency import bounded_map
+from alert_autoconf.config import read_from_file
+from alert_autoconf.models import Alerts
+
+
+# configs found in directories given to validate.py, matched case-insensitively
+CONFIG_FILENAME = "alert.yaml"
+
+
+class TargetCheck(NamedTuple):
+    """Result of rendering one target: the response text if it is not JSON,
+    or the exception raised by the request or made of a non-2xx status.
+    A valid target has neither.
+    """
+
+    text: Optional[str] = None
+    exception: Optional[Exception] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.text is None and self.exception is None
+
+
+def render_params(targets: List[str]) -> List[tuple]:
+    """Query of a render request,
+    for a single target the same as validate.py always sent.
+    """
+    return (
+        [("format", "json")]
+        + [("target", target) for target in targets]
+        + [("from", "-1min"), ("noNullPoints", "true"), ("maxDataPoints", 1)]
+    )
+
+
+class TargetValidator:
+    """Checks that the render API of Graphite accepts targets.
+
+    Every distinct target is checked once, `workers` requests run concurrently
+    over one keep-alive session. With `batch_size` > 1 up to that many targets are
+    rendered by one request (Graphite accepts several `target=` parameters); if the
+    batch fails, its targets are checked one by one, so errors are reported per target.
+    Results found in `cache` are not requested again, new ones are put into it.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        session,
+        workers: int = 1,
+        batch_size: int = 1,
+        timeout=None,
+        cache: ValidationCache = None,
+    ):
+        """
+        :param url: render API url
+        :param session: requests.Session, its pool should fit `workers` connections
+        :param workers: concurrent requests
+        :param batch_size: targets per request
+        :param timeout: requests timeout, a number or (connect, read)
+        :param cache: results of earlier runs against the same url
+        """
+        if workers < 1 or batch_size < 1:
+            raise ValueError("workers and batch_size must be at least 1")
+        self.url = url
+        self.session = session
+        self.workers = workers
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.cache = cache
+
+    def check(self, targets: Iterable[str]) -> Dict[str, TargetCheck]:
+        """
+        :param targets: targets, possibly repeated
+        :return: result of every distinct target
+        """
+        unique = list(dict.fromkeys(targets))
+        results = {}
+        if self.cache is not None:
+            results = {
+                target: TargetCheck(text=text)
+                for target, text in self.cache.get(unique).items()
+            }
+            unique = [target for target in unique if target not in results]
+
+        batches = [
+            unique[i : i + self.batch_size]
+            for i in range(0, len(unique), self.batch_size)
+        ]
+        for checked in bounded_map(self._check_batch, batches, self.workers):
+            results.update(checked)
+            if self.cache is not None:
+                for target, result in checked.items():
+                    # failed requests say nothing about the target
+                    if result.exception is None:
+                        self.cache.put(target, result.text)
+        return results
+
+    def _check_batch(self, targets: List[str]) -> Dict[str, TargetCheck]:
+        if len(targets) == 1:
+            return {targets[0]: self._render(targets)}
+        if self._render(targets).ok:
+            return dict.fromkeys(targets, TargetCheck())
+        logging.debug(
+            f"Batch of {len(targets)} targets failed, checking them one by one"
+        )
+        return {target: self._render([target]) for target in targets}
+
+    def _render(self, targets: List[str]) -> TargetCheck:
+        try:
+            response = self.session.get(
+                self.url, params=render_params(targets), timeout=self.timeout
+            )
+        except Exception as e:
+            return TargetCheck(exception=e)
+        if not 200 <= response.status_code < 300:
+            # an error of Graphite or of a proxy in front of it, like a 502,
+            # says nothing about the targets
+            return TargetCheck(
+                exception=RuntimeError(
+                    f"Render API responded with status {response.status_code}"
+                )
+            )
+        try:
+            response.json()
+        except ValueError:
+            return TargetCheck(text=response.text)
+        except Exception as e:
+            return TargetCheck(exception=e)
+        return TargetCheck()
+
+
+def validate_config(
+    data: Alerts, validator: TargetValidator, logger: logging.Logger
+) -> bool:
+    """Checks targets of all triggers
+    and logs the result of every target of every trigger.
+    :return: True if all targets are valid
+    """
+    return report_config(data, validator.check(_targets(data)), logger)
+
+
+def _targets(data: Alerts) -> Iterable[str]:
+    return (target for trigger in data.triggers for target in trigger.targets)
+
+
+def report_config(
+    data: Alerts, results: Dict[str, TargetCheck], logger: logging.Logger
+) -> bool:
+    """Logs the result of every target of every trigger.
+    :param results: results of all targets of the config
+    :return: True if all targets are valid
+    """
+    is_valid = True
+    for trigger in data.triggers:
+        for n, target in enumerate(trigger.targets):
+            result = results[target]
+            if result.ok:
+                logger.info('Trigger: "%s", target: "%s" OK' % (trigger.name, n))
+            elif result.text is not None:
+                is_valid = False
+                logger.error(
+                    'Trigger: "%s", target: "%s" ERROR: %s'
+                    % (trigger.name, n, result.text)
+                )
+            else:
+                is_valid = False
+                logger.error(
+                    'Trigger: "%s", target: "%s", exception: "%s"'
+                    % (trigger.name, n, result.exception)
+                )
+    return is_valid
+
+
+class ConfigFile(NamedTuple):
+    """A config read by read_configs: either `data` or the `error` message is set."""
+
+    filename: str
+    data: Optional[Alerts]
+    error: Optional[str]
+
+
+def find_configs(paths: Iterable[str]) -> List[str]:
+    """Config files given as files, glob patterns (** included) or directories,
+    which are searched for alert.yaml. Every file is listed once, in the order found.
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = sorted(
+                os.path.join(directory, name)
+                for directory, _, names in os.walk(path)
+                for name in names
+                if name.lower() == CONFIG_FILENAME
+            )
+        elif glob.has_magic(path):
+            matches = sorted(glob.glob(path, recursive=True))
+        else:
+            matches = [path]
+        found.extend(matches)
+    return list(dict.fromkeys(found))
+
+
+def _read_config(filename: str, cluster_name: Optional[str]) -> ConfigFile:
+    # exceptions of pydantic do not survive pickling, so the worker returns the message
+    try:
+        return ConfigFile(filename, read_from_file(filename, cluster_name), None)
+    except Exception as e:
+        return ConfigFile(filename, None, "{}: {}".format(type(e).__name__, e))
+
+
+def read_configs(
+    filenames: List[str], cluster_name: Optional[str], workers: int
+) -> List[ConfigFile]:
+    """Reads configs in up to `workers` processes,
+    parsing and validating them is CPU-bound.
+    A config that cannot be read does not stop the others.
+    """
+    if workers <= 1 or len(filenames) <= 1:
+        return [_read_config(filename, cluster_name) for filename in filenames]
+    with ProcessPoolExecutor(max_workers=min(workers, len(filenames))) as executor:
+        return list(
+            executor.map(_read_config, filenames, [cluster_name] * len(filenames))
+        )
+
+
+def validate_configs(
+    configs: List[ConfigFile], validator: TargetValidator, logger: logging.Logger
+) -> Dict[str, bool]:
+    """Checks targets of all configs at once, so a target used by several configs is
+    rendered once, and logs results of every config after its name.
+    :return: whether each config is valid, by file name
+    """
+    results = validator.check(
+        target for config in configs if config.data for target in _targets(config.data)
+    )
+    status = {}
+    for config in configs:
+        logger.info('Config: "%s"' % config.filename)
+        if config.error is not None:
+            logger.error(
+                'Config: "%s" cannot be read: %s' % (config.filename, config.error)
+            )
+            status[config.filename] = False
+        else:
+            status[config.filename] = report_config(config.data, results, logger)
+    return status
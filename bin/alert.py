@@ -1,21 +1,16 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import argparse
 import logging
-import pkg_resources
 
 from collections import ChainMap
 
-from redis import Redis
+from alert_autoconf import DISTRIBUTION_NAME, LOG_FORMAT, LOG_LEVEL, get_version
 
-from alert_autoconf import LOG_FORMAT, LOG_LEVEL
-from alert_autoconf import config
-from alert_autoconf import defaults
-from alert_autoconf import teamcity
-from alert_autoconf.moira import MoiraAlert
-from moira_client import Moira
-from moira_client import RetryPolicy
+# everything else is imported where it is used, so that --help and runs which do not
+# need some of the dependencies (asyncio, TeamCity, the caches) start faster
 
 
 def parse_params() -> dict:
@@ -32,6 +27,23 @@ def parse_params() -> dict:
         "password": None,
         "token": None,
         "redis_token_storage": None,
+        "fetch_workers": 1,
+        "write_workers": 1,
+        "plan_workers": 1,
+        "force": False,
+        "async_engine": False,
+        "concurrency": 8,
+        "manifest": None,
+        "no_snapshot": False,
+        "snapshot_max_age": None,
+        "snapshot_dir": None,
+        "config_cache": False,
+        "metrics_json": None,
+        "metrics_prom": None,
+        "pool_size": None,
+        "connect_timeout": None,
+        "read_timeout": None,
+        "no_gzip": False,
     }
 
     parser.add_argument(
@@ -50,9 +62,124 @@ def parse_params() -> dict:
         help="Cluster name. If specified, {cluster} will be replaced with this name.",
         required=False,
     )
+    parser.add_argument(
+        "-w",
+        "--fetch-workers",
+        help="Number of concurrent requests used to fetch triggers from Moira.",
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "-W",
+        "--write-workers",
+        help="Number of concurrent requests used to create, update and delete triggers "
+        "in Moira.",
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "-P",
+        "--plan-workers",
+        help="Number of processes used to compare triggers from the config "
+        "with triggers from Moira, worth it for configs with thousands of triggers.",
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "-a",
+        "--async",
+        dest="async_engine",
+        help="Use the asyncio engine, requires the `aio` extra.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--concurrency",
+        help="Max number of concurrent Moira requests of one kind "
+        "in the asyncio engine.",
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "--pool-size",
+        help="Number of keep-alive connections to Moira, by default the largest number "
+        "of concurrent requests.",
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        help="Seconds to wait for a connection to Moira, 5 by default.",
+        type=float,
+        required=False,
+    )
+    parser.add_argument(
+        "--read-timeout",
+        help="Seconds to wait for each chunk of a Moira response, 60 by default.",
+        type=float,
+        required=False,
+    )
+    parser.add_argument(
+        "--no-gzip",
+        help="Do not ask Moira for gzip-compressed responses.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        help="Synchronize even if neither the config nor the remote state has changed "
+        "since the last run.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no-snapshot",
+        help="Do not keep triggers, subscriptions and contacts in a local cache "
+        "between runs, fetch everything from Moira.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--snapshot-max-age",
+        help="Seconds after which cached objects are fetched from Moira again even if "
+        "tag/stats shows no change, 86400 by default.",
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "--snapshot-dir",
+        help="Directory of the local snapshot and config caches, "
+        "$XDG_CACHE_HOME/alert-autoconf by default.",
+        required=False,
+    )
+    parser.add_argument(
+        "--config-cache",
+        help="Keep the parsed and validated config in a local cache and use it "
+        "while the file is unchanged.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        help="Write durations of the run phases, Moira requests, Redis commands "
+        "and changed objects to this JSON file.",
+        required=False,
+    )
+    parser.add_argument(
+        "--metrics-prom",
+        help="Write the same metrics to this file in the Prometheus text format "
+        "(for the node_exporter textfile collector).",
+        required=False,
+    )
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        help="YAML file with a list of configs (config, token, cluster) synchronized "
+        "in one run over one snapshot of Moira. Replaces -c, -t and -C.",
+        required=False,
+    )
 
     namespace = parser.parse_args()
-    if namespace.token is None:
+    if namespace.manifest is not None:
+        if namespace.async_engine:
+            parser.error("-m/--manifest is not supported by the asyncio engine")
+    elif namespace.token is None:
         if namespace.cluster is None:
             parser.error("At least one of -t/--token and -C/--cluster is required")
         namespace.token = "kubernetes:{}".format(namespace.cluster)
@@ -81,33 +208,256 @@ def main():
     if not params["url"].startswith("http://"):
         params["url"] = "{}{}".format("http://", params["url"])
 
-    moira = Moira(
+    from alert_autoconf.metrics import RunMetrics
+
+    metrics = RunMetrics()
+    status = 1
+    try:
+        with metrics.phase("run"):
+            status = _run(params, metrics)
+    finally:
+        metrics.success = status == 0
+        _write_metrics(params, metrics)
+    if status:
+        sys.exit(status)
+
+
+def _run(params, metrics) -> int:
+    from redis import Redis
+    from alert_autoconf import config, defaults
+    from alert_autoconf.metrics import instrument_redis
+
+    redis = Redis.from_url(params["redis_token_storage"])
+    instrument_redis(redis, metrics)
+
+    if params["manifest"]:
+        return _run_manifest(params, redis, metrics)
+
+    with metrics.phase("read_config"):
+        data = config.read_from_file(
+            params["config"],
+            cluster_name=params.get("cluster"),
+            cache=_make_config_cache(params),
+        )
+    with metrics.phase("apply_defaults"):
+        defaults.apply_defaults(data, redis)
+
+    digest = config.config_digest(data, version=get_version())
+
+    if params["async_engine"]:
+        import asyncio
+
+        # Moira requests and Redis commands of the asyncio engine are not counted
+        with metrics.phase("setup_async"):
+            asyncio.run(_setup_async(params, data, digest))
+        return 0
+
+    from alert_autoconf.moira import MoiraAlert
+
+    alert = MoiraAlert(
+        moira=_make_moira(params, metrics),
+        redis=redis,
+        token=params["token"],
+        fetch_workers=int(params["fetch_workers"]),
+        write_workers=int(params["write_workers"]),
+        plan_workers=int(params["plan_workers"]),
+        snapshot_cache=_make_snapshot_cache(params),
+        metrics=metrics,
+    )
+    _synchronize(alert, data, digest, params["force"])
+    return 0
+
+
+def _run_manifest(params, redis, metrics) -> int:
+    """
+    Synchronizes every config of the manifest over one snapshot of Moira:
+    subscriptions, contacts and the trigger catalog are downloaded once per run.
+    A failed config is logged and does not stop the others.
+    :return: exit status
+    """
+    from alert_autoconf import config, defaults
+    from alert_autoconf.moira import MoiraAlert
+    from alert_autoconf.snapshot import MoiraSnapshot
+
+    logger = logging.getLogger("alert")
+    manifest = config.read_manifest(params["manifest"])
+    moira = _make_moira(params, metrics)
+    snapshot_cache = _make_snapshot_cache(params)
+    snapshot = MoiraSnapshot(moira, cache=snapshot_cache)
+    version = get_version()
+    config_cache = _make_config_cache(params)
+
+    failed = 0
+    for entry in manifest.configs:
+        logger.info("Synchronizing %s (token %s)", entry.config, entry.token)
+        try:
+            with metrics.phase("read_config"):
+                data = config.read_from_file(
+                    entry.config, cluster_name=entry.cluster, cache=config_cache
+                )
+            with metrics.phase("apply_defaults"):
+                defaults.apply_defaults(data, redis)
+            alert = MoiraAlert(
+                moira=moira,
+                redis=redis,
+                token=entry.token,
+                fetch_workers=int(params["fetch_workers"]),
+                write_workers=int(params["write_workers"]),
+                plan_workers=int(params["plan_workers"]),
+                moira_snapshot=snapshot,
+                snapshot_cache=snapshot_cache,
+                metrics=metrics,
+            )
+            _synchronize(
+                alert,
+                data,
+                config.config_digest(data, version=version),
+                params["force"],
+            )
+        except Exception:
+            logger.exception(
+                "Failed to synchronize %s (token %s)", entry.config, entry.token
+            )
+            failed += 1
+
+    if failed:
+        logger.error("%d of %d configs failed", failed, len(manifest.configs))
+        return 1
+    return 0
+
+
+def _synchronize(alert, data, digest, force):
+    if not force and alert.is_up_to_date(digest):
+        logging.getLogger("alert").info(
+            "Config and remote state are unchanged since the last run, nothing to do"
+        )
+        return
+
+    alert.setup(data)
+    alert.save_digest(digest)
+
+
+def _make_snapshot_cache(params):
+    if params["no_snapshot"]:
+        return None
+    from alert_autoconf.cache import SNAPSHOT_MAX_AGE, SnapshotCache
+
+    max_age = int(params["snapshot_max_age"] or SNAPSHOT_MAX_AGE)
+    if params["force"]:
+        # everything is fetched again and the cache is refreshed
+        max_age = 0
+    return SnapshotCache.for_user(
+        params["url"], params["user"], directory=params["snapshot_dir"], max_age=max_age
+    )
+
+
+def _make_config_cache(params):
+    if not params["config_cache"]:
+        return None
+    from alert_autoconf.cache import ConfigCache
+
+    directory = params["snapshot_dir"] and os.path.join(
+        params["snapshot_dir"], "configs"
+    )
+    return ConfigCache(directory, version=get_version())
+
+
+def _write_metrics(params, metrics):
+    if params["metrics_json"]:
+        metrics.write_json(params["metrics_json"])
+    if params["metrics_prom"]:
+        if params["manifest"]:
+            labels = {"manifest": params["manifest"]}
+        else:
+            labels = {"token": params["token"]}
+        metrics.write_prometheus(params["metrics_prom"], labels)
+
+
+def _make_moira(params, metrics):
+    from moira_client import RetryPolicy
+    from alert_autoconf.transport import HttpTransport, PooledMoira
+
+    connect_timeout, read_timeout = _timeouts(params)
+    pool_size = params["pool_size"] or max(
+        int(params["fetch_workers"]), int(params["write_workers"])
+    )
+    transport = HttpTransport(
+        pool_size=int(pool_size),
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        gzip=not params["no_gzip"],
+        retry_policy=RetryPolicy(max_tries=3, delay=1, backoff=1.5),
+    )
+    moira = PooledMoira(
         params["url"],
+        transport,
         auth_user=params["user"],
         auth_pass=params["password"],
-        auth_custom={
-            "User-Agent": _make_user_agent(),
-        },
-        retry_policy=RetryPolicy(
-            max_tries=3,
-            delay=1,
-            backoff=1.5,
-        ),
+        auth_custom={"User-Agent": _make_user_agent()},
+        on_request=metrics.count_api_call,
     )
+    return moira
 
-    redis = Redis.from_url(params["redis_token_storage"])
 
-    alert = MoiraAlert(moira=moira, redis=redis, token=params["token"])
+async def _setup_async(params, data, digest):
+    from alert_autoconf.aio import connect_redis
 
-    data = config.read_from_file(params["config"], cluster_name=params.get("cluster"))
-    defaults.apply_defaults(data, redis)
+    redis = connect_redis(params["redis_token_storage"])
+    try:
+        await _run_async(params, data, digest, redis)
+    finally:
+        # redis.asyncio >= 5 renamed close() to aclose()
+        await (redis.aclose() if hasattr(redis, "aclose") else redis.close())
 
-    alert.setup(data)
+
+async def _run_async(params, data, digest, redis):
+    from alert_autoconf.aio import AsyncMoiraAlert, AsyncMoiraClient
+
+    connect_timeout, read_timeout = _timeouts(params)
+    async with AsyncMoiraClient(
+        params["url"],
+        auth_user=params["user"],
+        auth_pass=params["password"],
+        auth_custom={"User-Agent": _make_user_agent()},
+        connections=int(params["pool_size"] or params["concurrency"]),
+        max_tries=3,
+        delay=1,
+        backoff=1.5,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        gzip=not params["no_gzip"],
+    ) as client:
+        alert = AsyncMoiraAlert(
+            client=client,
+            redis=redis,
+            token=params["token"],
+            concurrency=int(params["concurrency"]),
+        )
+
+        if not params["force"] and await alert.is_up_to_date(digest):
+            logging.getLogger("alert").info(
+                "Config and remote state are unchanged since the last run, "
+                "nothing to do"
+            )
+            return
+
+        await alert.setup(data)
+        await alert.save_digest(digest)
+
+
+def _timeouts(params):
+    from alert_autoconf.transport import DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+
+    return (
+        float(params["connect_timeout"] or DEFAULT_CONNECT_TIMEOUT),
+        float(params["read_timeout"] or DEFAULT_READ_TIMEOUT),
+    )
 
 
 def _make_user_agent():
-    distribution = pkg_resources.get_distribution("alert-autoconf")
-    user_agent = f'{distribution.project_name}/{distribution.version}'
+    from alert_autoconf import teamcity
+
+    user_agent = f'{DISTRIBUTION_NAME}/{get_version()}'
     teamcity_build_id = teamcity.get_teamcity_build_id()
     if teamcity_build_id is not None:
         user_agent = f'{user_agent} (TeamCity; https://tmct.yourdomain.ru/viewLog.html?buildId={teamcity_build_id})'
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+
+from redis import Redis
+
+from alert_autoconf import LOG_FORMAT
+from alert_autoconf import storage
+
+
+def parse_params() -> dict:
+    parser = argparse.ArgumentParser(
+        add_help=True,
+        description="Builds the subscription owners index "
+        "from the alerting sets of all tokens.",
+    )
+    parser.add_argument(
+        "-s", "--redis_token_storage", help="Token storage.", required=True
+    )
+
+    namespace = parser.parse_args()
+    command_line_args = {k: v for k, v in vars(namespace).items() if v}
+    return command_line_args
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    params = parse_params()
+    redis = Redis.from_url(params["redis_token_storage"])
+    count = storage.rebuild_subscription_owners(redis)
+    logging.info("Indexed owners of {} subscriptions".format(count))
+
+
+if __name__ == "__main__":
+    main()
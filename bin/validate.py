@@ -2,12 +2,9 @@
 
 import argparse
 import logging
-import requests
+import os
 import sys
 
-from alert_autoconf.config import read_from_file
-from json import JSONDecodeError
-
 LOG_LEVEL = "DEBUG"
 
 
@@ -21,13 +18,70 @@ def parse_params() -> dict:
         required=False,
     )
     parser.add_argument(
-        "-c", "--config", help="Path to trigger description", required=True
+        "-c",
+        "--config",
+        nargs="+",
+        help="Paths to trigger descriptions: files, glob patterns "
+        "(quoted, ** matches directories) or directories searched for alert.yaml. "
+        "Several configs are validated in one run.",
+        required=True,
+    )
+    parser.add_argument(
+        "-j",
+        "--parse-workers",
+        default=os.cpu_count() or 1,
+        type=int,
+        help="Number of processes reading several configs, "
+        "the number of CPUs by default.",
+        required=False,
     )
     parser.add_argument(
         "-l", "--log-level", default=LOG_LEVEL, help="Log level.", required=False
     )
     parser.add_argument(
-        "-C", "--cluster",
+        "-w",
+        "--workers",
+        default=1,
+        type=int,
+        help="Number of concurrent render requests.",
+        required=False,
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        default=1,
+        type=int,
+        help="Number of targets rendered by one request, "
+        "if the render API accepts several targets.",
+        required=False,
+    )
+    parser.add_argument(
+        "--no-cache",
+        help="Render every target, do not use or update the cache of earlier results.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Directory of the result cache, "
+        "$XDG_CACHE_HOME/alert-autoconf by default.",
+        required=False,
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=int,
+        help="Seconds a valid target is not rendered again, a day by default.",
+        required=False,
+    )
+    parser.add_argument(
+        "--negative-cache-ttl",
+        type=int,
+        help="Seconds an invalid target is reported from the cache, "
+        "10 minutes by default.",
+        required=False,
+    )
+    parser.add_argument(
+        "-C",
+        "--cluster",
         help="Cluster name. If specified, {cluster} will be replaced with this name.",
         required=False,
     )
@@ -53,35 +107,51 @@ def main():
         logging.getLogger().setLevel(logging.getLevelName(log_level))
         _logger.setLevel(logging.getLevelName(log_level))
 
-    is_valid = True
-    data = read_from_file(params.config, params.cluster)
-
-    for trigger in data.triggers:
-        for n, target in enumerate(trigger.targets):
-            request_params = {
-                "format": "json",
-                "target": target,
-                "from": "-1min",
-                "noNullPoints": "true",
-                "maxDataPoints": 1,
-            }
-            try:
-                r = requests.get(params.url, params=request_params)
-                r.json()
-                _logger.info('Trigger: "%s", target: "%s" OK' % (trigger.name, n))
-            except JSONDecodeError as e:
-                is_valid = False
-                _logger.error(
-                    'Trigger: "%s", target: "%s" ERROR: %s' % (trigger.name, n, r.text)
-                )
-            except Exception as e:
-                is_valid = False
-                _logger.error(
-                    'Trigger: "%s", target: "%s", exception: "%s"'
-                    % (trigger.name, n, e)
-                )
-
-    if not is_valid:
+    # imported after parsing the arguments, so that --help starts faster
+    from alert_autoconf.cache import ValidationCache
+    from alert_autoconf.transport import HttpTransport
+    from alert_autoconf.validation import (
+        TargetValidator,
+        find_configs,
+        read_configs,
+        validate_configs,
+    )
+
+    filenames = find_configs(params.config)
+    if not filenames:
+        _logger.error("No configs found in %s" % ", ".join(params.config))
+        sys.exit(1)
+    configs = read_configs(filenames, params.cluster, params.parse_workers)
+
+    cache = None
+    if not params.no_cache:
+        ttls = {"ttl": params.cache_ttl, "negative_ttl": params.negative_cache_ttl}
+        cache = ValidationCache.for_url(
+            params.url,
+            directory=params.cache_dir,
+            **{k: v for k, v in ttls.items() if v is not None},
+        )
+
+    with HttpTransport(pool_size=params.workers) as transport:
+        validator = TargetValidator(
+            params.url,
+            transport.session,
+            workers=params.workers,
+            batch_size=params.batch_size,
+            timeout=transport.timeout,
+            cache=cache,
+        )
+        status = validate_configs(configs, validator, _logger)
+
+    if cache is not None:
+        cache.save()
+        _logger.info(cache.summary())
+
+    for filename, valid in status.items():
+        _logger.info('Config: "%s" %s' % (filename, "OK" if valid else "FAILED"))
+    _logger.info("%d of %d configs are valid" % (sum(status.values()), len(status)))
+
+    if not all(status.values()):
         sys.exit(1)
 
 
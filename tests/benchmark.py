@@ -0,0 +1,357 @@
+r"""Measures how synchronization scales against FakeMoiraServer and FakeRedis.
+
+    PYTHONPATH=.:tests python tests/benchmark.py --triggers 100 1000 \
+        --latency 0.02 --error-rate 0.01
+
+For every size and engine a synthetic alert.yaml is written and synchronized through
+these scenarios, one after another against the same Moira and Redis:
+
+    create  into an empty Moira
+    noop    once more with nothing changed
+    update  with the description of every tenth trigger changed
+    delete  with every tenth trigger and subscription removed
+
+Wall time, Moira requests, injected errors, opened connections, kilobytes of responses
+and Redis commands are printed per scenario, `--json FILE` saves them together with
+requests by endpoint. The `plain` engine is the sync engine with the transport of
+moira_client itself: a new connection per request and no retries. When it runs along
+with `sync`, the two are compared scenario by scenario; `--scenario` limits the run
+to some of the scenarios.
+
+Before the scenarios the modules a real run of every engine imports are timed with
+`-X importtime` in a fresh interpreter, `--import-budget SECONDS` makes the benchmark
+exit with status 1 when an engine takes longer.
+"""
+import argparse
+import asyncio
+import copy
+import functools
+import json
+import os
+import sys
+import tempfile
+import time
+
+from types import SimpleNamespace
+
+import yaml
+
+from alert_autoconf import config
+from alert_autoconf.cache import SnapshotCache
+from alert_autoconf.moira import MoiraAlert
+from alert_autoconf.transport import HttpTransport, PooledMoira
+
+from benchmark_import import run_import_times, seconds
+from fakes import AsyncFakeRedis, FakeMoiraServer, FakeRedis
+
+
+SCENARIOS = ('create', 'noop', 'update', 'delete')
+
+
+def make_config(triggers: int, subscriptions: int) -> dict:
+    return {
+        'triggers': [
+            {
+                'name': 'trigger {}'.format(i),
+                'tags': ['service', 'group {}'.format(i % max(subscriptions, 1))],
+                'targets': ['stats.service.{}'.format(i)],
+                'warn_value': 10,
+                'error_value': 20,
+            }
+            for i in range(triggers)
+        ],
+        'alerting': [
+            {
+                'tags': ['group {}'.format(i)],
+                'contacts': [
+                    {'type': 'mail', 'value': 'team-{}@example.com'.format(i % 5)}
+                ],
+            }
+            for i in range(subscriptions)
+        ],
+    }
+
+
+def change_config(data: dict, scenario: str) -> dict:
+    data = copy.deepcopy(data)
+    if scenario == 'update':
+        for trigger in data['triggers'][::10]:
+            trigger['desc'] = 'changed'
+    elif scenario == 'delete':
+        del data['triggers'][::10]
+        del data['alerting'][::10]
+    return data
+
+
+def write_config(directory: str, data: dict) -> str:
+    filename = os.path.join(directory, 'alert.yaml')
+    with open(filename, 'w') as stream:
+        yaml.safe_dump(data, stream)
+    return filename
+
+
+def sync_engine(server: FakeMoiraServer, args, cache_dir: str, pooled: bool = True):
+    from moira_client import Moira
+
+    redis = FakeRedis()
+    if not pooled:
+        moira = Moira(server.url)
+    else:
+        # the fields of moira_client.RetryPolicy
+        retry_policy = SimpleNamespace(max_tries=args.max_tries, delay=0, backoff=1)
+        transport = HttpTransport(
+            pool_size=args.pool_size or args.workers,
+            gzip=not args.no_gzip,
+            retry_policy=retry_policy,
+        )
+        moira = PooledMoira(server.url, transport)
+
+    def setup(data):
+        snapshot_cache = SnapshotCache(cache_dir) if args.cache else None
+        MoiraAlert(
+            moira,
+            redis,
+            'benchmark',
+            fetch_workers=args.workers,
+            write_workers=args.workers,
+            plan_workers=args.plan_workers,
+            snapshot_cache=snapshot_cache,
+        ).setup(data)
+
+    return redis, setup
+
+
+def async_engine(server: FakeMoiraServer, args, cache_dir: str):
+    from alert_autoconf.aio import AsyncMoiraAlert, AsyncMoiraClient
+
+    redis = AsyncFakeRedis()
+
+    async def run(data):
+        async with AsyncMoiraClient(
+            server.url,
+            connections=args.pool_size or args.workers,
+            max_tries=args.max_tries,
+            gzip=not args.no_gzip,
+        ) as client:
+            await AsyncMoiraAlert(
+                client, redis, 'benchmark', concurrency=args.workers
+            ).setup(data)
+
+    return redis, lambda data: asyncio.run(run(data))
+
+
+ENGINES = {
+    'sync': sync_engine,
+    'plain': functools.partial(sync_engine, pooled=False),
+    'async': async_engine,
+}
+# runs of benchmark_import.RUN_IMPORTS by engine
+ENGINE_IMPORTS = {
+    'sync': 'alert.py sync',
+    'plain': 'alert.py sync',
+    'async': 'alert.py async',
+}
+
+
+def run_scenarios(
+    engine: str, triggers: int, subscriptions: int, scenarios: list, args
+) -> list:
+    results = []
+    base = make_config(triggers, subscriptions)
+    with FakeMoiraServer(
+        latency=args.latency, error_rate=args.error_rate, seed=args.seed
+    ) as server, tempfile.TemporaryDirectory() as directory:
+        redis, setup = ENGINES[engine](server, args, directory)
+        for scenario in scenarios:
+            filename = write_config(directory, change_config(base, scenario))
+            server.requests.clear()
+            server.errors.clear()
+            server.connections = server.response_bytes = 0
+            redis.commands.clear()
+
+            started = time.perf_counter()
+            data = config.read_from_file(filename, cluster_name=None)
+            parsed = time.perf_counter()
+            setup(data)
+            finished = time.perf_counter()
+
+            results.append(
+                {
+                    'engine': engine,
+                    'triggers': triggers,
+                    'subscriptions': subscriptions,
+                    'scenario': scenario,
+                    'seconds': finished - started,
+                    'parse_seconds': parsed - started,
+                    'requests': sum(server.requests.values()),
+                    'errors': sum(server.errors.values()),
+                    'connections': server.connections,
+                    'response_bytes': server.response_bytes,
+                    'redis_commands': sum(redis.commands.values()),
+                    'requests_by_endpoint': {
+                        '{} {}'.format(method, endpoint): count
+                        for (method, endpoint), count in sorted(server.requests.items())
+                    },
+                }
+            )
+    return results
+
+
+def compare_transports(results: list):
+    """Prints wall time, requests and connections of the sync engine with and without
+    the connection pool of alert_autoconf.transport for every size and scenario.
+    """
+    plain = {
+        (r['triggers'], r['scenario']): r for r in results if r['engine'] == 'plain'
+    }
+    columns = '{:>8} {:<8} {:>9} {:>9} {:>9} {:>9} {:>11} {:>11} {:>8}'
+    print('sync engine with (pooled) and without (plain) the connection pool')
+    print(
+        columns.format(
+            'triggers',
+            'scenario',
+            'pooled s',
+            'plain s',
+            'pooled rq',
+            'plain rq',
+            'pooled conn',
+            'plain conn',
+            'speedup',
+        )
+    )
+    for pooled in results:
+        other = plain.get((pooled['triggers'], pooled['scenario']))
+        if pooled['engine'] != 'sync' or other is None:
+            continue
+        print(
+            columns.format(
+                pooled['triggers'],
+                pooled['scenario'],
+                '{:.3f}'.format(pooled['seconds']),
+                '{:.3f}'.format(other['seconds']),
+                pooled['requests'],
+                other['requests'],
+                pooled['connections'],
+                other['connections'],
+                '{:.2f}x'.format(other['seconds'] / pooled['seconds']),
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--triggers', type=int, nargs='+', default=[200])
+    parser.add_argument('--subscriptions', type=int, default=20)
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.01,
+        help='seconds added to every Moira response',
+    )
+    parser.add_argument(
+        '--error-rate',
+        type=float,
+        default=0.0,
+        help='share of Moira requests failed with 503',
+    )
+    parser.add_argument(
+        '--max-tries',
+        type=int,
+        default=5,
+        help='attempts per Moira request of both engines',
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--workers', type=int, default=8, help='concurrent requests of both engines'
+    )
+    parser.add_argument(
+        '--pool-size',
+        type=int,
+        help='keep-alive connections of both engines, --workers by default',
+    )
+    parser.add_argument(
+        '--no-gzip',
+        action='store_true',
+        help='ask for uncompressed responses, both engines',
+    )
+    parser.add_argument(
+        '--plan-workers',
+        type=int,
+        default=1,
+        help='processes comparing triggers, sync engine',
+    )
+    parser.add_argument(
+        '--cache',
+        action='store_true',
+        help='keep a snapshot of Moira in a local cache, sync engine',
+    )
+    parser.add_argument('--engine', choices=list(ENGINES), action='append')
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append')
+    parser.add_argument('--json', help='file to save the results to')
+    parser.add_argument(
+        '--import-budget',
+        type=float,
+        help='seconds a run of every engine may spend importing modules',
+    )
+    args = parser.parse_args()
+    engines = args.engine or list(ENGINES)
+    scenarios = [s for s in SCENARIOS if s in (args.scenario or SCENARIOS)]
+
+    over_budget = []
+    for engine in engines:
+        import_seconds = seconds(run_import_times(ENGINE_IMPORTS[engine]))
+        print('{} imports: {:.3f}s'.format(engine, import_seconds))
+        if args.import_budget is not None and import_seconds > args.import_budget:
+            over_budget.append(engine)
+
+    columns = '{:<6} {:>8} {:<8} {:>9} {:>9} {:>7} {:>12} {:>9} {:>7}'
+    print(
+        columns.format(
+            'engine',
+            'triggers',
+            'scenario',
+            'seconds',
+            'requests',
+            'errors',
+            'connections',
+            'kbytes',
+            'redis',
+        )
+    )
+    results = []
+    for triggers in args.triggers:
+        for engine in engines:
+            for result in run_scenarios(
+                engine, triggers, args.subscriptions, scenarios, args
+            ):
+                results.append(result)
+                print(
+                    columns.format(
+                        engine,
+                        triggers,
+                        result['scenario'],
+                        '{:.3f}'.format(result['seconds']),
+                        result['requests'],
+                        result['errors'],
+                        result['connections'],
+                        '{:.1f}'.format(result['response_bytes'] / 1024),
+                        result['redis_commands'],
+                    )
+                )
+
+    if 'sync' in engines and 'plain' in engines:
+        compare_transports(results)
+
+    if args.json:
+        with open(args.json, 'w') as stream:
+            json.dump(results, stream, indent=2)
+
+    if over_budget:
+        print('over the import budget: {}'.format(', '.join(over_budget)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
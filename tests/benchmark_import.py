@@ -0,0 +1,154 @@
+"""Measures how long the command line tools take to start.
+
+    python tests/benchmark_import.py --runs 20
+
+Every entry point is started with `--help` in a fresh interpreter: wall time is
+the median of the runs, import time is the sum of `-X importtime` self times of
+modules an empty interpreter does not import. The modules a real run imports
+after parsing the arguments are measured the same way, for the sync and async
+engines of alert.py and for validate.py. The slowest imports are listed too,
+tests/test_import_time.py keeps the import times within the budgets below.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS = ('bin/alert.py', 'bin/validate.py')
+# modules the entry points import where they are used,
+# see bin/alert.py and bin/validate.py
+RUN_IMPORTS = {
+    'alert.py sync': (
+        'redis',
+        'moira_client',
+        'alert_autoconf.config',
+        'alert_autoconf.defaults',
+        'alert_autoconf.metrics',
+        'alert_autoconf.moira',
+        'alert_autoconf.snapshot',
+        'alert_autoconf.cache',
+        'alert_autoconf.transport',
+        'alert_autoconf.teamcity',
+    ),
+    'alert.py async': (
+        'redis',
+        'alert_autoconf.config',
+        'alert_autoconf.defaults',
+        'alert_autoconf.metrics',
+        'alert_autoconf.aio',
+        'alert_autoconf.teamcity',
+    ),
+    'validate.py': (
+        'alert_autoconf.cache',
+        'alert_autoconf.config',
+        'alert_autoconf.transport',
+        'alert_autoconf.validation',
+    ),
+}
+
+
+# seconds of importing before the arguments are parsed
+HELP_IMPORT_BUDGET = 0.05
+# seconds of importing by a run, about twice the time measured on a developer machine
+RUN_IMPORT_BUDGETS = {'alert.py sync': 1.0, 'alert.py async': 1.5, 'validate.py': 0.75}
+# modules not needed to parse arguments
+HEAVY_MODULES = (
+    'pkg_resources',
+    'redis',
+    'moira_client',
+    'pydantic',
+    'yaml',
+    'requests',
+    'aiohttp',
+    'xml.etree',
+)
+
+
+def _run(args):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.run(
+        [sys.executable, '-X', 'importtime'] + args,
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+
+def _parse(stderr: str) -> dict:
+    """Self and cumulative microseconds by module, from the `-X importtime` output."""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:') :].split('|')
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def import_times(script: str, *args: str) -> dict:
+    """Self and cumulative microseconds of modules the script imports
+    on top of an empty interpreter.
+    """
+    baseline = _parse(_run(['-c', 'pass']).stderr)
+    modules = _parse(_run([script] + list(args)).stderr)
+    return {name: times for name, times in modules.items() if name not in baseline}
+
+
+def run_import_times(run: str) -> dict:
+    """The same as `import_times` for the modules of a run from `RUN_IMPORTS`."""
+    return import_times('-c', 'import ' + ', '.join(RUN_IMPORTS[run]))
+
+
+def seconds(modules: dict) -> float:
+    return sum(s for s, _ in modules.values()) / 1e6
+
+
+def _print_slowest(modules: dict, top: int):
+    slowest = sorted(modules.items(), key=lambda item: item[1][1], reverse=True)[:top]
+    for name, (_, cumulative) in slowest:
+        print('    {:>8.1f}ms {}'.format(cumulative / 1e3, name))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument(
+        '--top', type=int, default=10, help='number of the slowest imports to list'
+    )
+    args = parser.parse_args()
+
+    for script in ENTRY_POINTS:
+        wall = []
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            _run([script, '--help'])
+            wall.append(time.perf_counter() - started)
+        modules = import_times(script, '--help')
+        print(
+            '{} --help: {:.3f}s wall, {:.3f}s importing {} modules'.format(
+                script, statistics.median(wall), seconds(modules), len(modules)
+            )
+        )
+        _print_slowest(modules, args.top)
+
+    for run in RUN_IMPORTS:
+        modules = run_import_times(run)
+        print(
+            '{} run: {:.3f}s importing {} modules, budget {:.3f}s'.format(
+                run, seconds(modules), len(modules), RUN_IMPORT_BUDGETS[run]
+            )
+        )
+        _print_slowest(modules, args.top)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""Measures the per-trigger cost of building models
+with and without pydantic validation.
+
+    PYTHONPATH=.:tests python tests/benchmark_models.py --triggers 5000
+
+    moira json      trigger_json_to_model on triggers as the Moira API returns them
+    cache entry     a trigger stored in the local trigger cache
+    render          render_trigger on triggers read from alert.yaml
+
+Every case is timed with validation (Trigger(**values), as before)
+and with Trigger.trusted.
+"""
+import argparse
+import json
+import time
+import uuid
+
+from unittest.mock import patch
+
+from alert_autoconf import moira
+from alert_autoconf.models import Saturation, Trigger, TriggerFile
+from alert_autoconf.reconcile import render_trigger
+
+
+def _validated(values):
+    return Trigger(**values)
+
+
+def _validated_saturation(values):
+    return Saturation(**values)
+
+
+def _render_validated(trigger, parent_ids):
+    fields = trigger.dict()
+    fields['parents'] = parent_ids
+    del fields['id']
+    return Trigger(**fields)
+
+
+def make_api_triggers(count: int) -> list:
+    return [
+        {
+            'id': str(uuid.uuid4()),
+            'name': 'trigger {}'.format(i),
+            'tags': ['service', 'group {}'.format(i % 20)],
+            'targets': ['stats.service.{}'.format(i)],
+            'warn_value': 10.0,
+            'error_value': 20.0,
+            'ttl': 600,
+            'ttl_state': 'NODATA',
+            'desc': 'description',
+            'expression': '',
+            'is_pull_type': False,
+            'dashboard': '',
+            'pending_interval': 0,
+            'sched': {
+                'startOffset': 0,
+                'endOffset': 1439,
+                'tzOffset': 0,
+                'days': [
+                    {'name': d, 'enabled': d != 'Sun'}
+                    for d in ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+                ],
+            },
+            'parents': [],
+            'saturation': [{'type': 'check-first-target', 'extra_parameters': None}],
+        }
+        for i in range(count)
+    ]
+
+
+def _best(func, repeat: int) -> float:
+    """Seconds of the fastest of `repeat` calls."""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--triggers', type=int, default=5000)
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=5,
+        help='the fastest of this many runs is reported',
+    )
+    args = parser.parse_args()
+
+    api_triggers = make_api_triggers(args.triggers)
+    models = [moira.trigger_json_to_model(t) for t in api_triggers]
+    cache_entries = [json.loads(t.json()) for t in models]
+    file_triggers = [
+        TriggerFile(**{k: v for k, v in t.dict().items() if k not in ('id', 'parents')})
+        for t in models
+    ]
+
+    def json_validated(data):
+        with patch.object(Trigger, 'trusted', _validated), patch.object(
+            Saturation, 'trusted', _validated_saturation
+        ):
+            return [moira.trigger_json_to_model(t) for t in data]
+
+    cases = [
+        (
+            'moira json',
+            lambda: json_validated(api_triggers),
+            lambda: [moira.trigger_json_to_model(t) for t in api_triggers],
+        ),
+        (
+            'cache entry',
+            lambda: [Trigger(**t) for t in cache_entries],
+            lambda: [Trigger.trusted(t) for t in cache_entries],
+        ),
+        (
+            'render',
+            lambda: [_render_validated(t, ['1']) for t in file_triggers],
+            lambda: [render_trigger(t, ['1']) for t in file_triggers],
+        ),
+    ]
+
+    columns = '{:<12} {:>14} {:>14} {:>8}'
+    print(columns.format('case', 'validated, us', 'trusted, us', 'speedup'))
+    for name, validated, trusted in cases:
+        validated_seconds = _best(validated, args.repeat)
+        trusted_seconds = _best(trusted, args.repeat)
+        print(
+            columns.format(
+                name,
+                '{:.1f}'.format(validated_seconds / args.triggers * 1e6),
+                '{:.1f}'.format(trusted_seconds / args.triggers * 1e6),
+                '{:.1f}x'.format(validated_seconds / trusted_seconds),
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,459 @@
+import fnmatch
+import gzip
+import json
+import random
+import threading
+import time
+import uuid
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import Mock
+
+from redis import Redis
+from redis.exceptions import WatchError
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+
+def mock_trigger(**fields):
+    """Stand-in for the trigger returned by moira-client TriggerManager.create:
+    a Mock with the given fields and a new id unless one is given.
+    """
+    trigger = Mock(**{k: v for k, v in fields.items() if k != 'id'})
+    trigger.id = fields.get('id') or str(uuid.uuid4())
+    return trigger
+
+
+class FakeRedis(Redis):
+    """In-memory Redis with the commands used by alert-autoconf.
+    Counts executed commands and round trips (a pipeline is one round trip).
+    Every write bumps the version of its key, which WATCH of FakePipeline checks.
+    """
+
+    WRITES = {'DEL', 'SET', 'SADD', 'SREM', 'HSET', 'HDEL'}
+
+    def __init__(self):
+        self.data = {}
+        self.versions = Counter()
+        self.commands = Counter()
+        self.round_trips = 0
+        self.log = []
+
+    def close(self):
+        pass
+
+    def __del__(self):
+        pass
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return FakePipeline(self, transaction)
+
+    def execute_command(self, *args, **options):
+        self.round_trips += 1
+        return self._execute(*args)
+
+    def _execute(self, command, *args):
+        command = command.upper()
+        self.commands[command] += 1
+        self.log.append((command, args))
+        if command in self.WRITES:
+            names = args if command == 'DEL' else args[:1]
+            self.versions.update(_to_bytes(name) for name in names)
+        return getattr(self, '_cmd_' + command.lower())(*args)
+
+    def sent(self, command, key):
+        """Returns all values sent with `command` to `key`, in order."""
+        key = _to_bytes(key)
+        return [
+            value
+            for name, args in self.log
+            if name == command and args and _to_bytes(args[0]) == key
+            for value in args[1:]
+        ]
+
+    def members(self, name):
+        """Returns a set as str, without counting a command."""
+        return {value.decode('utf-8') for value in self._set(name)}
+
+    def _set(self, name, create=False):
+        name = _to_bytes(name)
+        if create:
+            return self.data.setdefault(name, set())
+        return self.data.get(name, set())
+
+    def _hash(self, name, create=False):
+        name = _to_bytes(name)
+        if create:
+            return self.data.setdefault(name, {})
+        return self.data.get(name, {})
+
+    def _drop_empty(self, name):
+        name = _to_bytes(name)
+        if name in self.data and not self.data[name]:
+            del self.data[name]
+
+    def _cmd_exists(self, *names):
+        return sum(_to_bytes(name) in self.data for name in names)
+
+    def _cmd_watch(self, *names):
+        return True
+
+    def _cmd_del(self, *names):
+        return sum(self.data.pop(_to_bytes(name), None) is not None for name in names)
+
+    def _cmd_keys(self, pattern='*'):
+        pattern = _to_bytes(pattern).decode('utf-8')
+        return [
+            key
+            for key in self.data
+            if fnmatch.fnmatchcase(key.decode('utf-8'), pattern)
+        ]
+
+    def _cmd_scan(self, cursor, *args):
+        options = {
+            _to_bytes(name).upper(): value for name, value in zip(args[::2], args[1::2])
+        }
+        return 0, self._cmd_keys(options.get(b'MATCH', '*'))
+
+    def _cmd_get(self, name):
+        return self.data.get(_to_bytes(name))
+
+    def _cmd_set(self, name, value, *options):
+        self.data[_to_bytes(name)] = _to_bytes(value)
+        return True
+
+    def _cmd_sadd(self, name, *values):
+        members = self._set(name, create=True)
+        before = len(members)
+        members.update(_to_bytes(v) for v in values)
+        return len(members) - before
+
+    def _cmd_srem(self, name, *values):
+        members = self._set(name)
+        before = len(members)
+        members.difference_update(_to_bytes(v) for v in values)
+        self._drop_empty(name)
+        return before - len(members)
+
+    def _cmd_smembers(self, name):
+        return set(self._set(name))
+
+    def _cmd_sismember(self, name, value):
+        return int(_to_bytes(value) in self._set(name))
+
+    def _cmd_scard(self, name):
+        return len(self._set(name))
+
+    def _cmd_hset(self, name, *pairs):
+        fields = self._hash(name, create=True)
+        added = 0
+        for key, value in zip(pairs[::2], pairs[1::2]):
+            added += _to_bytes(key) not in fields
+            fields[_to_bytes(key)] = _to_bytes(value)
+        return added
+
+    def _cmd_hget(self, name, key):
+        return self._hash(name).get(_to_bytes(key))
+
+    def _cmd_hmget(self, name, *keys):
+        fields = self._hash(name)
+        return [fields.get(_to_bytes(key)) for key in keys]
+
+    def _cmd_hdel(self, name, *keys):
+        fields = self._hash(name)
+        removed = sum(fields.pop(_to_bytes(key), None) is not None for key in keys)
+        self._drop_empty(name)
+        return removed
+
+    def _cmd_hgetall(self, name):
+        return dict(self._hash(name))
+
+    def _cmd_hlen(self, name):
+        return len(self._hash(name))
+
+
+class FakePipeline(Redis):
+    def __init__(self, redis, transaction):
+        self._redis = redis
+        self.transaction = transaction
+        self._stack = []
+        # versions of watched keys, commands are immediate until multi()
+        self._watched = None
+        self._immediate = False
+
+    def close(self):
+        pass
+
+    def __del__(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stack = []
+        self._watched = None
+        self._immediate = False
+
+    def __len__(self):
+        return len(self._stack)
+
+    def watch(self, *names):
+        self._redis.execute_command('WATCH', *names)
+        self._watched = {
+            _to_bytes(name): self._redis.versions[_to_bytes(name)] for name in names
+        }
+        self._immediate = True
+
+    def multi(self):
+        self._immediate = False
+
+    def execute_command(self, *args, **options):
+        if self._immediate:
+            return self._redis.execute_command(*args)
+        self._stack.append(args)
+        return self
+
+    def execute(self, raise_on_error=True):
+        stack, self._stack = self._stack, []
+        watched, self._watched = self._watched, None
+        self._immediate = False
+        if not stack:
+            return []
+        self._redis.round_trips += 1
+        if watched and any(
+            self._redis.versions[name] != version for name, version in watched.items()
+        ):
+            raise WatchError('Watched variable changed.')
+        return [self._redis._execute(*args) for args in stack]
+
+
+class AsyncFakeRedis(FakeRedis):
+    """FakeRedis with the interface of redis.asyncio.Redis."""
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return AsyncFakePipeline(self, transaction)
+
+    async def execute_command(self, *args, **options):
+        return super().execute_command(*args, **options)
+
+
+class AsyncFakePipeline(FakePipeline):
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._stack = []
+
+    async def execute(self, raise_on_error=True):
+        return super().execute(raise_on_error)
+
+
+class FakeMoiraServer:
+    """Moira API stand-in served over HTTP from a background thread.
+    Keeps triggers, subscriptions and contacts in memory, counts requests by endpoint,
+    can delay every response by `latency` seconds and fail a share of requests
+    with 503 before handling them (`error_rate`, reproducible with `seed`).
+    Responses larger than GZIP_MIN_LENGTH are gzip-compressed if the client accepts it.
+    Accepted connections and bytes of response bodies are counted as well.
+    """
+
+    GZIP_MIN_LENGTH = 1024
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.triggers = {}
+        self.subscriptions = {}
+        self.contacts = {}
+        self.requests = Counter()
+        self.errors = Counter()
+        self.connections = 0
+        self.response_bytes = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, args=(0.01,), daemon=True
+        )
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/api/'.format(self._server.server_address[1])
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, method, endpoint=None):
+        return sum(
+            n
+            for (m, e), n in self.requests.items()
+            if m == method and endpoint in (None, e)
+        )
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body leave in one packet, otherwise delayed ACKs dominate the timings
+            wbufsize = 64 * 1024
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connections += 1
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_PUT(self):
+                self._handle('PUT')
+
+            def do_DELETE(self):
+                self._handle('DELETE')
+
+            def _handle(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                parts = self.path.split('?')[0].strip('/').split('/')[1:]
+                if server.latency:
+                    time.sleep(server.latency)
+                with server._lock:
+                    status, result = server._route(method, parts, body)
+                payload = b'' if result is None else json.dumps(result).encode('utf-8')
+                gzipped = len(
+                    payload
+                ) > server.GZIP_MIN_LENGTH and 'gzip' in self.headers.get(
+                    'Accept-Encoding', ''
+                )
+                if gzipped:
+                    payload = gzip.compress(payload)
+                with server._lock:
+                    server.response_bytes += len(payload)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                if gzipped:
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+    def _route(self, method, parts, body):
+        args = []
+        if parts[0] in ('trigger', 'subscription', 'contact') and len(parts) > 1:
+            args = [parts[1]]
+            parts = [parts[0], '{id}'] + parts[2:]
+        endpoint = '/'.join(parts)
+        self.requests[(method, endpoint)] += 1
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors[(method, endpoint)] += 1
+            return 503, {'error': 'injected'}
+        handler = getattr(
+            self,
+            '_{}_{}'.format(method, endpoint.replace('{id}', 'id'))
+            .lower()
+            .replace('/', '_'),
+            None,
+        )
+        if handler is None:
+            return 404, {'error': 'not found'}
+        return handler(*args, body=body)
+
+    def _save(self, objects, body, object_id=None):
+        object_id = object_id or body.get('id') or str(uuid.uuid4())
+        objects[object_id] = dict(body, id=object_id)
+        return 200, {'id': object_id}
+
+    def _delete(self, objects, object_id):
+        objects.pop(object_id, None)
+        return 200, None
+
+    def _get_trigger(self, body):
+        return 200, {'list': list(self.triggers.values())}
+
+    def _put_trigger(self, body):
+        return self._save(self.triggers, body)
+
+    def _get_trigger_id(self, trigger_id, body):
+        return 200, self.triggers[trigger_id]
+
+    def _put_trigger_id(self, trigger_id, body):
+        return self._save(self.triggers, body, trigger_id)
+
+    def _delete_trigger_id(self, trigger_id, body):
+        return self._delete(self.triggers, trigger_id)
+
+    def _get_trigger_id_state(self, trigger_id, body):
+        if trigger_id in self.triggers:
+            return 200, {'trigger_id': trigger_id, 'state': 'OK'}
+        return 200, {'trigger_id': trigger_id}
+
+    def _get_tag_stats(self, body):
+        tags = {}
+        for trigger in self.triggers.values():
+            for tag in trigger['tags']:
+                tags.setdefault(tag, ([], []))[0].append(trigger['id'])
+        for subscription in self.subscriptions.values():
+            for tag in subscription['tags']:
+                tags.setdefault(tag, ([], []))[1].append(subscription)
+        return (
+            200,
+            {
+                'list': [
+                    {'name': tag, 'triggers': ids, 'subscriptions': subscriptions}
+                    for tag, (ids, subscriptions) in tags.items()
+                ]
+            },
+        )
+
+    def _get_user_settings(self, body):
+        return (
+            200,
+            {
+                'login': 'test',
+                'contacts': list(self.contacts.values()),
+                'subscriptions': list(self.subscriptions.values()),
+            },
+        )
+
+    def _get_contact(self, body):
+        return 200, {'list': list(self.contacts.values())}
+
+    def _put_contact(self, body):
+        return self._save(self.contacts, body)
+
+    def _get_subscription(self, body):
+        return 200, {'list': list(self.subscriptions.values())}
+
+    def _put_subscription(self, body):
+        return self._save(self.subscriptions, body)
+
+    def _put_subscription_id(self, subscription_id, body):
+        return self._save(self.subscriptions, body, subscription_id)
+
+    def _delete_subscription_id(self, subscription_id, body):
+        return self._delete(self.subscriptions, subscription_id)
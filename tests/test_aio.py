@@ -0,0 +1,197 @@
+import asyncio
+
+from unittest import TestCase
+
+from moira_client import Moira
+
+from alert_autoconf.aio import AsyncMoiraAlert, AsyncMoiraClient, AsyncTokenStorage
+from alert_autoconf.models import Alerts
+from alert_autoconf.moira import MoiraAlert
+
+from fakes import AsyncFakeRedis, FakeMoiraServer, FakeRedis
+
+
+def _config(triggers=3, with_parents=True):
+    return {
+        'triggers': [
+            {'name': 'parent', 'tags': ['global'], 'targets': ['stats.parent']}
+        ]
+        + [
+            {
+                'name': 'trigger {}'.format(i),
+                'tags': ['service'],
+                'targets': ['stats.{}'.format(i)],
+                'warn_value': 10,
+                'error_value': 20,
+                'parents': [{'name': 'parent', 'tags': ['global']}]
+                if with_parents
+                else None,
+            }
+            for i in range(triggers)
+        ],
+        'alerting': [
+            {
+                'tags': ['service'],
+                'contacts': [{'type': 'mail', 'value': 'team@example.com'}],
+            },
+            {
+                'tags': ['global'],
+                'contacts': [{'type': 'mail', 'value': 'team@example.com'}],
+                'escalations': [
+                    {
+                        'offset_in_minutes': 10,
+                        'contacts': [{'type': 'slack', 'value': '#oncall'}],
+                    }
+                ],
+            },
+        ],
+    }
+
+
+class AsyncMoiraAlertTest(TestCase):
+    def setUp(self):
+        self.server = FakeMoiraServer(seed=1).start()
+        self.addCleanup(self.server.stop)
+        self.redis = AsyncFakeRedis()
+
+    def _setup(self, config, max_tries=1):
+        async def run():
+            async with AsyncMoiraClient(self.server.url, max_tries=max_tries) as client:
+                alert = AsyncMoiraAlert(client, self.redis, 'test', concurrency=4)
+                await alert.setup(Alerts(**config))
+                return alert
+
+        return asyncio.run(run())
+
+    def test_create_then_noop(self):
+        alert = self._setup(_config())
+
+        self.assertEqual(len(self.server.triggers), 4)
+        parent_id = next(
+            t['id'] for t in self.server.triggers.values() if t['name'] == 'parent'
+        )
+        for trigger in self.server.triggers.values():
+            self.assertEqual(
+                trigger['parents'], [] if trigger['name'] == 'parent' else [parent_id]
+            )
+        self.assertEqual(len(self.server.subscriptions), 2)
+        self.assertEqual(self.server.count('PUT', 'contact'), 2)
+        self.assertEqual(
+            self.redis.members(alert.trigger_token), set(self.server.triggers)
+        )
+        self.assertEqual(
+            self.redis.members(alert.alerting_token), set(self.server.subscriptions)
+        )
+
+        self.server.requests.clear()
+        self._setup(_config())
+        self.assertEqual(self.server.count('PUT') + self.server.count('DELETE'), 0)
+
+    def test_digest_matches_sync_engine(self):
+        # subscriptions of the moira-client installed here have no escalations,
+        # so the sync engine only reads triggers and contacts
+        config = _config()
+        config['alerting'] = []
+        self.server.contacts['c1'] = {
+            'id': 'c1',
+            'type': 'mail',
+            'value': 'team@example.com',
+        }
+
+        async def run():
+            async with AsyncMoiraClient(self.server.url) as client:
+                alert = AsyncMoiraAlert(client, self.redis, 'test')
+                await alert.setup(Alerts(**config))
+                await alert.save_digest('config')
+                return await alert.is_up_to_date('config')
+
+        self.assertTrue(asyncio.run(run()))
+        redis = FakeRedis()
+        redis.data = self.redis.data
+        alert = MoiraAlert(Moira(self.server.url), redis, 'test')
+        self.assertTrue(alert.is_up_to_date('config'))
+
+    def test_setup_reuses_remote_state(self):
+        async def run():
+            async with AsyncMoiraClient(self.server.url) as client:
+                alert = AsyncMoiraAlert(client, self.redis, 'test')
+                await alert.setup(Alerts(**_config()))
+                await alert.save_digest('config')
+                self.server.subscriptions.clear()
+                self.server.requests.clear()
+                self.assertFalse(await alert.is_up_to_date('config'))
+                await alert.setup(Alerts(**_config()))
+
+        asyncio.run(run())
+        self.assertEqual(self.server.count('GET', 'subscription'), 1)
+        self.assertEqual(self.server.count('GET', 'user/settings'), 1)
+
+    def test_removed_objects_are_deleted(self):
+        self._setup(_config(triggers=3))
+        config = _config(triggers=1)
+        config['alerting'] = config['alerting'][:1]
+        alert = self._setup(config)
+
+        self.assertEqual(
+            sorted(t['name'] for t in self.server.triggers.values()),
+            ['parent', 'trigger 0'],
+        )
+        self.assertEqual(len(self.server.subscriptions), 1)
+        self.assertEqual(len(self.redis.members(alert.trigger_token)), 2)
+        self.assertEqual(len(self.redis.members(alert.alerting_token)), 1)
+
+    def test_changed_trigger_is_updated(self):
+        self._setup(_config(triggers=1, with_parents=False))
+        trigger_ids = set(self.server.triggers)
+        config = _config(triggers=1, with_parents=False)
+        config['triggers'][1]['warn_value'] = 15
+        self.server.requests.clear()
+        self._setup(config)
+
+        self.assertEqual(set(self.server.triggers), trigger_ids)
+        self.assertEqual(self.server.count('PUT', 'trigger/{id}'), 1)
+        self.assertEqual(self.server.count('DELETE'), 0)
+
+    def test_contacts_created_once(self):
+        config = _config(triggers=0)
+        config['alerting'] *= 3
+        self._setup(config)
+        self.assertEqual(self.server.count('PUT', 'contact'), 2)
+
+    def test_injected_errors_are_retried(self):
+        self.server.error_rate = 0.3
+        self._setup(_config(), max_tries=10)
+        self.assertTrue(self.server.errors)
+
+        self.server.error_rate = 0
+        self.server.requests.clear()
+        self._setup(_config())
+        self.assertEqual(self.server.count('PUT') + self.server.count('DELETE'), 0)
+
+
+class _YieldingRedis(AsyncFakeRedis):
+    """Lets other coroutines run during every command, like a real connection."""
+
+    async def execute_command(self, *args, **options):
+        await asyncio.sleep(0)
+        return await super().execute_command(*args, **options)
+
+
+class AsyncTokenStorageTest(TestCase):
+    def test_concurrent_flushes(self):
+        redis = _YieldingRedis()
+        storage = AsyncTokenStorage(redis, 'test')
+
+        async def remove(subscription_id):
+            storage.remove_subscriptions([subscription_id])
+            await storage.flush()
+
+        async def run():
+            storage.add_subscriptions(['s1', 's2'])
+            await storage.flush()
+            # 's2' is buffered while the first flush waits for the owners of 's1'
+            await asyncio.gather(remove('s1'), remove('s2'))
+
+        asyncio.run(run())
+        self.assertEqual(redis.members(storage.alerting_key), set())
+        self.assertEqual(redis._hash('autoconf:subscription-owners'), {})
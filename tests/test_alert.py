@@ -2,6 +2,7 @@ import logging
 
 import uuid
 
+from types import SimpleNamespace
 from unittest import TestCase
 from unittest.mock import patch
 from unittest.mock import Mock
@@ -15,12 +16,13 @@ from moira_client.models.trigger import TriggerManager, Trigger
 from moira_client.models.contact import ContactManager, Contact
 from moira_client.models.subscription import SubscriptionManager
 
-from redis import Redis
-
+from alert_autoconf import models
 from alert_autoconf.moira import MoiraAlert
 from alert_autoconf.config import read_from_file
 from alert_autoconf import LOG_FORMAT
 
+from fakes import FakeRedis
+
 logging.basicConfig(level=logging.ERROR, format=LOG_FORMAT)
 
 logger = logging.getLogger('alert')
@@ -62,10 +64,9 @@ class MoiraAlertTest(TestCase):
     def setUp(self):
         self.url = 'http://localhost:1234/api/'
         self.token = 'test'
-        self.redis_token_storage = 'redis://localhost:5678/10'
 
         self.moira = Moira(self.url)
-        self.redis = Redis.from_url(self.redis_token_storage)
+        self.redis = FakeRedis()
 
     def createCustomTriggers(self):
         current_triggers = {}
@@ -116,7 +117,7 @@ class MoiraAlertTest(TestCase):
         invalid_config = 'tests/invalid_config.yaml'
 
         with self.assertRaises(ValidationError):
-            read_from_file(invalid_config)
+            read_from_file(invalid_config, cluster_name=None)
 
     def test_invalid_constructor_call_raises_TypeError(self):
         with self.assertRaises(TypeError):
@@ -129,7 +130,7 @@ class MoiraAlertTest(TestCase):
             alert.setup('')
 
     def test_config_prefix(self):
-        data = read_from_file('tests/valid_config_second.yaml')
+        data = read_from_file('tests/valid_config_second.yaml', cluster_name=None)
         prefix = data.prefix
         for trigger in data.triggers:
             self.assertTrue(trigger.name.startswith(prefix), 'Trigger name with prefix')
@@ -144,7 +145,7 @@ class MoiraAlertTest(TestCase):
         self
     ):
         valid_config = 'tests/valid_config.yaml'
-        data = read_from_file(valid_config)
+        data = read_from_file(valid_config, cluster_name=None)
         client = Client(self.url)
 
         with patch.object(client, 'get', return_value={'list': []}), patch.object(
@@ -163,15 +164,14 @@ class MoiraAlertTest(TestCase):
                 self.moira, '_tag', return_value=tag_manager
             ) as _tag_mock, patch.object(
                 self.moira, '_subscription', return_value=subscription_manager
-            ), patch.object(
-                self.redis, 'exists', return_value=0
-            ), patch.object(
-                self.redis, 'sadd', return_value=1
-            ) as _redis_sadd_mock:
+            ):
                 _contact_mock.fetch_by_current_user.return_value = []
                 _contact_mock.add = Mock(
-                    side_effect=lambda value, contact_type: Contact(
-                        id=str(uuid.uuid4()), type=contact_type, value=value
+                    side_effect=lambda value, contact_type, fallback_value=None: Contact(
+                        id=str(uuid.uuid4()),
+                        type=contact_type,
+                        value=value,
+                        fallback_value=fallback_value,
                     )
                 )
                 trigger_orig = MoiraAlert(self.moira, self.redis, self.token)
@@ -179,10 +179,10 @@ class MoiraAlertTest(TestCase):
 
             args, kwargs = _trigger_mock.create.call_args_list[0]
             kwargs.pop('name')
-            count_contacts_in_alerting_block = self._get_count_key_by_dict(
-                data.alerting, 'contacts'
+            # each distinct contact of alerting blocks and escalations is created once
+            count_contacts_in_alerting_block = self._get_count_unique_contacts(
+                data.alerting
             )
-            count_contacts_in_alerting_block += 2  # + 2 contacts from escalations
 
             self.assertFalse(_tag_mock.fetch_assigned_triggers_by_tags.called)
             self.assertDictKeysEqual(
@@ -199,13 +199,16 @@ class MoiraAlertTest(TestCase):
                 _contact_mock.add.call_count, count_contacts_in_alerting_block
             )
             self.assertEqual(_trigger_mock.create.call_count, len(data.triggers))
-            self.assertEqual(_redis_sadd_mock.call_count, len(data.triggers))
+            self.assertEqual(
+                len(self.redis.sent('SADD', trigger_orig.trigger_token)),
+                len(data.triggers),
+            )
 
     def test_create_fake_moira_trigger_and_alerting_prefix_exists_token_not_exists(
         self
     ):
         valid_config = 'tests/valid_config_second.yaml'
-        data = read_from_file(valid_config)
+        data = read_from_file(valid_config, cluster_name=None)
         trigger_count = len(data.triggers)
         client = Client(self.url)
 
@@ -225,15 +228,14 @@ class MoiraAlertTest(TestCase):
                 self.moira, '_tag', return_value=tag_manager
             ) as _tag_mock, patch.object(
                 self.moira, '_subscription', return_value=subscription_manager
-            ), patch.object(
-                self.redis, 'exists', return_value=0
-            ) as _redis_exists, patch.object(
-                self.redis, 'sadd', return_value=1
-            ) as _redis_sadd:
+            ):
                 _contact_mock.fetch_by_current_user.return_value = []
                 _contact_mock.add = Mock(
-                    side_effect=lambda value, contact_type: Contact(
-                        id=str(uuid.uuid4()), type=contact_type, value=value
+                    side_effect=lambda value, contact_type, fallback_value=None: Contact(
+                        id=str(uuid.uuid4()),
+                        type=contact_type,
+                        value=value,
+                        fallback_value=fallback_value,
                     )
                 )
                 trigger_orig = MoiraAlert(self.moira, self.redis, self.token)
@@ -241,10 +243,10 @@ class MoiraAlertTest(TestCase):
 
             args, kwargs = _trigger_mock.create.call_args_list[0]
             kwargs.pop('name')
-            count_contacts_in_alerting_block = self._get_count_key_by_dict(
-                data.alerting, 'contacts'
+            # each distinct contact of alerting blocks and escalations is created once
+            count_contacts_in_alerting_block = self._get_count_unique_contacts(
+                data.alerting
             )
-            count_contacts_in_alerting_block += 2  # + 2 contacts from escalations
 
             self.assertTrue(_tag_mock.fetch_assigned_triggers_by_tags.called)
             self.assertDictKeysEqual(
@@ -261,12 +263,14 @@ class MoiraAlertTest(TestCase):
                 _contact_mock.add.call_count, count_contacts_in_alerting_block
             )
             self.assertEqual(_trigger_mock.create.call_count, trigger_count)
-            self.assertEqual(_redis_exists.call_count, 1)
-            self.assertEqual(_redis_sadd.call_count, trigger_count)
+            self.assertEqual(self.redis.commands['SMEMBERS'], 2)
+            self.assertEqual(
+                len(self.redis.sent('SADD', trigger_orig.trigger_token)), trigger_count
+            )
 
     def test_create_fake_moira_trigger_and_alerting_token_exists_and_empty(self):
         valid_config = 'tests/valid_config.yaml'
-        data = read_from_file(valid_config)
+        data = read_from_file(valid_config, cluster_name=None)
         trigger_count = len(data.triggers)
         client = Client(self.url)
 
@@ -286,17 +290,14 @@ class MoiraAlertTest(TestCase):
                 self.moira, '_tag', return_value=tag_manager
             ) as _tag_mock, patch.object(
                 self.moira, '_subscription', return_value=subscription_manager
-            ), patch.object(
-                self.redis, 'exists', return_value=1
-            ) as _redis_exists_mock, patch.object(
-                self.redis, 'smembers', return_value=set()
-            ), patch.object(
-                self.redis, 'sadd', return_value=1
-            ) as _redis_sadd_mock:
+            ):
                 _contact_mock.fetch_by_current_user.return_value = []
                 _contact_mock.add = Mock(
-                    side_effect=lambda value, contact_type: Contact(
-                        id=str(uuid.uuid4()), type=contact_type, value=value
+                    side_effect=lambda value, contact_type, fallback_value=None: Contact(
+                        id=str(uuid.uuid4()),
+                        type=contact_type,
+                        value=value,
+                        fallback_value=fallback_value,
                     )
                 )
                 trigger_orig = MoiraAlert(self.moira, self.redis, self.token)
@@ -304,10 +305,10 @@ class MoiraAlertTest(TestCase):
 
             args, kwargs = _trigger_mock.create.call_args_list[0]
             kwargs.pop('name')
-            count_contacts_in_alerting_block = self._get_count_key_by_dict(
-                data.alerting, 'contacts'
+            # each distinct contact of alerting blocks and escalations is created once
+            count_contacts_in_alerting_block = self._get_count_unique_contacts(
+                data.alerting
             )
-            count_contacts_in_alerting_block += 2  # + 2 contacts from escalations
 
             self.assertFalse(_tag_mock.fetch_assigned_triggers_by_tags.called)
             self.assertDictKeysEqual(
@@ -325,18 +326,23 @@ class MoiraAlertTest(TestCase):
                 _contact_mock.add.call_count, count_contacts_in_alerting_block
             )
             self.assertEqual(_trigger_mock.create.call_count, trigger_count)
-            self.assertTrue(_redis_exists_mock.called)
-            self.assertEqual(_redis_sadd_mock.call_count, trigger_count)
+            self.assertTrue(self.redis.commands['SMEMBERS'])
+            self.assertEqual(
+                len(self.redis.sent('SADD', trigger_orig.trigger_token)), trigger_count
+            )
 
     def test_create_fake_moira_trigger_and_alerting_token_exists_and_not_empty(self):
         valid_config = 'tests/valid_config.yaml'
-        data = read_from_file(valid_config)
+        data = read_from_file(valid_config, cluster_name=None)
         current_triggers = self.createCustomTriggers()
         moira_triggers = dict([current_triggers.popitem()])
         client = Client(self.url)
 
-        redis_trigger_ids = set(i.encode('utf-8') for i in moira_triggers.keys())
-        redis_trigger_ids = redis_trigger_ids | {str(uuid.uuid4()).encode('utf-8')}
+        redis_trigger_ids = set(moira_triggers.keys()) | {str(uuid.uuid4())}
+        self.redis.sadd(
+            MoiraAlert.TRIGGER_TOKEN_PREFIX + self.token, *redis_trigger_ids
+        )
+        self.redis.log.clear()
 
         with patch.object(client, 'get', return_value={'list': []}), patch.object(
             client, 'put', return_value={}
@@ -354,22 +360,17 @@ class MoiraAlertTest(TestCase):
                 self.moira, '_tag', return_value=tag_manager
             ) as _tag_mock, patch.object(
                 self.moira, '_subscription', return_value=subscription_manager
-            ), patch.object(
-                self.redis, 'exists', return_value=1
-            ) as _redis_exists_mock, patch.object(
-                self.redis, 'smembers', return_value=redis_trigger_ids
-            ) as _redis_smembers_mock, patch.object(
-                self.redis, 'sadd', return_value=1
-            ) as _redis_sadd_mock, patch.object(
-                self.redis, 'srem', return_value=1
-            ) as _redis_srem_mock:
+            ):
                 _trigger_mock.fetch_by_id = Mock(
                     side_effect=lambda id: moira_triggers.get(id, None)
                 )
                 _contact_mock.fetch_by_current_user.return_value = []
                 _contact_mock.add = Mock(
-                    side_effect=lambda value, contact_type: Contact(
-                        id=str(uuid.uuid4()), type=contact_type, value=value
+                    side_effect=lambda value, contact_type, fallback_value=None: Contact(
+                        id=str(uuid.uuid4()),
+                        type=contact_type,
+                        value=value,
+                        fallback_value=fallback_value,
                     )
                 )
                 trigger_orig = MoiraAlert(self.moira, self.redis, self.token)
@@ -377,10 +378,10 @@ class MoiraAlertTest(TestCase):
 
             args, kwargs = _trigger_mock.create.call_args_list[0]
             kwargs.pop('name')
-            count_contacts_in_alerting_block = self._get_count_key_by_dict(
-                data.alerting, 'contacts'
+            # each distinct contact of alerting blocks and escalations is created once
+            count_contacts_in_alerting_block = self._get_count_unique_contacts(
+                data.alerting
             )
-            count_contacts_in_alerting_block += 2  # + 2 contacts from escalations
 
             self.assertFalse(_tag_mock.fetch_assigned_triggers_by_tags.called)
             self.assertDictKeysEqual(
@@ -398,15 +399,73 @@ class MoiraAlertTest(TestCase):
                 _contact_mock.add.call_count, count_contacts_in_alerting_block
             )
             self.assertEqual(_trigger_mock.create.call_count, 1)
-            self.assertTrue(_redis_exists_mock.call_count)
-            self.assertTrue(_redis_smembers_mock.call_count)
-            self.assertEqual(_redis_sadd_mock.call_count, 1)
-            self.assertEqual(_redis_srem_mock.call_count, 1)
+            self.assertTrue(self.redis.commands['SMEMBERS'])
+            self.assertEqual(
+                len(self.redis.sent('SADD', trigger_orig.trigger_token)), 1
+            )
+            self.assertEqual(
+                len(self.redis.sent('SREM', trigger_orig.trigger_token)), 1
+            )
 
-    def _get_count_key_by_dict(self, data: list, key: str) -> int:
-        cnt = 0
+    def _get_count_unique_contacts(self, data: list) -> int:
+        contacts = set()
         for alert in data:
-            contacts = alert.__getattribute__(key)
-            if contacts:
-                cnt += len(contacts)
-        return cnt
+            for contact in alert.contacts + [
+                c for e in alert.escalations for c in e.contacts
+            ]:
+                contacts.add((contact.type, contact.value, contact.fallback_value))
+        return len(contacts)
+
+
+class GetContactsTest(TestCase):
+    def setUp(self):
+        self.moira = Moira('http://localhost:1234/api/')
+        self.redis = FakeRedis()
+        self.existing = SimpleNamespace(
+            id='1', type='mail', value='a@b.c', fallback_value=None
+        )
+
+    def _add(self, contact_type, value, fallback_value=None):
+        return SimpleNamespace(
+            id=str(uuid.uuid4()),
+            type=contact_type,
+            value=value,
+            fallback_value=fallback_value,
+        )
+
+    def test_existing_and_missing_contacts(self):
+        with patch.object(self.moira, '_contact') as _contact_mock:
+            _contact_mock.add = Mock(side_effect=self._add)
+            alert = MoiraAlert(self.moira, self.redis, 'test')
+            index = alert._index_contacts([self.existing])
+            first = alert._get_contacts(
+                [
+                    models.Contact(type='mail', value='a@b.c'),
+                    models.Contact(type='slack', value='#chan'),
+                ],
+                index,
+            )
+            second = alert._get_contacts(
+                [
+                    models.Contact(type='slack', value='#chan'),
+                    models.Contact(type='slack', value=''),
+                ],
+                index,
+            )
+
+        self.assertEqual(_contact_mock.add.call_count, 1)
+        self.assertEqual(first[0].id, '1')
+        self.assertEqual(second, [first[1]])
+
+    def test_fallback_value_is_part_of_key(self):
+        with patch.object(self.moira, '_contact') as _contact_mock:
+            _contact_mock.add = Mock(side_effect=self._add)
+            alert = MoiraAlert(self.moira, self.redis, 'test')
+            alert._get_contacts(
+                [models.Contact(type='mail', value='a@b.c', fallback_value='x@b.c')],
+                alert._index_contacts([self.existing]),
+            )
+
+        _contact_mock.add.assert_called_once_with(
+            contact_type='mail', value='a@b.c', fallback_value='x@b.c'
+        )
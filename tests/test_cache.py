@@ -0,0 +1,390 @@
+import json
+import os
+import tempfile
+import uuid
+import zlib
+
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from moira_client import Moira
+from moira_client.models.tag import TagStats
+
+from alert_autoconf import cache, config
+from alert_autoconf.cache import (
+    ConfigCache,
+    SnapshotCache,
+    TriggerCache,
+    ValidationCache,
+)
+from alert_autoconf.models import Alerts, Trigger
+from alert_autoconf.moira import MoiraAlert
+from alert_autoconf.snapshot import MoiraSnapshot
+
+from fakes import FakeMoiraServer, FakeRedis, mock_trigger
+
+
+CONFIG = '''
+version: 1.1
+prefix: svc-
+triggers:
+  - name: a
+    tags: ['{cluster}']
+    targets: ['stats.{cluster}.errors']
+    warn_value: 1
+    error_value: 2
+  - name: b
+    tags: [t]
+    targets: [x]
+    dashboard: http://grafana/d/1?panelId=2
+    parents:
+      - name: a
+        tags: ['{cluster}']
+    day_disable: [Sun]
+    time_start: '10:00'
+alerting:
+  - tags: ['{cluster}']
+    contacts:
+      - type: mail
+        value: team@example.com
+'''
+
+
+def _trigger(**kwargs):
+    fields = {'id': str(uuid.uuid4()), 'name': 'a', 'tags': ['t'], 'targets': ['x']}
+    fields.update(kwargs)
+    return Trigger(**fields)
+
+
+class TriggerCacheTest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.path = os.path.join(self.directory, 'moira', 'token.cache')
+
+    @staticmethod
+    def _tags(*triggers):
+        return lambda: {trigger.id: frozenset(trigger.tags) for trigger in triggers}
+
+    def test_round_trip(self):
+        first, second = _trigger(desc='first'), _trigger(name='b')
+        trigger_cache = TriggerCache(self.path)
+        trigger_cache.put(first)
+        trigger_cache.put(second)
+        trigger_cache.discard(second.id)
+        trigger_cache.save()
+
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['token.cache'])
+        self.assertEqual(
+            TriggerCache(self.path).get(
+                [first.id, second.id], self._tags(first, second)
+            ),
+            {first.id: first},
+        )
+
+    def test_checked_against_remote_tags(self):
+        trigger = _trigger()
+        trigger_cache = TriggerCache(self.path)
+        trigger_cache.put(trigger)
+        trigger_cache.save()
+
+        remote_tags = Mock(return_value={})
+        self.assertEqual(TriggerCache(self.path).get(['1'], remote_tags), {})
+        self.assertFalse(remote_tags.called)
+        self.assertEqual(TriggerCache(self.path).get([trigger.id], remote_tags), {})
+        changed = _trigger(id=trigger.id, tags=['t', 'u'])
+        self.assertEqual(
+            TriggerCache(self.path).get([trigger.id], self._tags(changed)), {}
+        )
+
+    def test_expired_and_unregistered(self):
+        trigger = _trigger()
+        trigger_cache = TriggerCache(self.path)
+        trigger_cache.put(trigger)
+        trigger_cache.save()
+
+        self.assertEqual(
+            TriggerCache(self.path, max_age=0).get([trigger.id], self._tags(trigger)),
+            {},
+        )
+        trigger_cache = TriggerCache(self.path)
+        trigger_cache.retain([])
+        self.assertEqual(trigger_cache.get([trigger.id], self._tags(trigger)), {})
+
+    def test_unreadable_or_other_format_ignored(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'wb') as stream:
+            stream.write(b'garbage')
+        self.assertEqual(TriggerCache(self.path).get(['1'], dict), {})
+
+        trigger = _trigger()
+        trigger_cache = TriggerCache(self.path)
+        trigger_cache.put(trigger)
+        trigger_cache.save()
+        with patch.object(
+            cache, 'TRIGGER_CACHE_FORMAT', cache.TRIGGER_CACHE_FORMAT + 1
+        ):
+            self.assertEqual(
+                TriggerCache(self.path).get([trigger.id], self._tags(trigger)), {}
+            )
+
+    def test_paths(self):
+        paths = {
+            SnapshotCache.for_user(url, user, directory=self.directory)
+            .trigger_cache(token)
+            .path
+            for url, user, token in [
+                ('u1', None, 't'),
+                ('u2', None, 't'),
+                ('u1', 'user', 't'),
+                ('u1', None, 't2'),
+            ]
+        }
+        self.assertEqual(len(paths), 4)
+
+
+class SnapshotCacheTest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.server = FakeMoiraServer().start()
+        self.addCleanup(self.server.stop)
+        self.server.contacts['c1'] = {
+            'id': 'c1',
+            'type': 'mail',
+            'value': 'team@example.com',
+        }
+        self.server.subscriptions['s1'] = {
+            'id': 's1',
+            'tags': ['t'],
+            'contacts': ['c1'],
+        }
+        self.server.triggers['1'] = {
+            'id': '1',
+            'name': 'a',
+            'tags': ['t'],
+            'targets': ['x'],
+        }
+        self.moira = Moira(self.server.url)
+
+    def _read(self, snapshot):
+        return (
+            [s.id for s in snapshot.subscriptions()],
+            [c.id for c in snapshot.contacts()],
+            sorted(snapshot.trigger_catalog().find('a', ['t'])),
+        )
+
+    def _run(self, **kwargs):
+        """Reads every part of a snapshot with the cache, counting the requests."""
+        snapshot = MoiraSnapshot(
+            self.moira, cache=SnapshotCache(self.directory, **kwargs)
+        )
+        self.server.requests.clear()
+        parts = self._read(snapshot)
+        snapshot.save()
+        return parts
+
+    def test_unchanged_parts_read_from_cache(self):
+        self.assertEqual(self._run(), (['s1'], ['c1'], ['1']))
+        self.assertEqual(self.server.count('GET'), 3)
+
+        self.assertEqual(self._run(), (['s1'], ['c1'], ['1']))
+        self.assertEqual(self.server.count('GET'), 1)
+        self.assertEqual(self.server.count('GET', 'tag/stats'), 1)
+
+    def test_changes_seen_by_tag_stats(self):
+        self._run()
+        self.server.subscriptions['s1']['tags'] = ['u']
+        self.server.subscriptions['s3'] = {
+            'id': 's3',
+            'tags': ['u'],
+            'contacts': ['c1'],
+        }
+        self.server.triggers['2'] = {
+            'id': '2',
+            'name': 'a',
+            'tags': ['t'],
+            'targets': ['x'],
+        }
+
+        self.assertEqual(self._run(), (['s1', 's3'], ['c1'], ['1', '2']))
+        self.assertEqual(self.server.count('GET', 'subscription'), 1)
+        self.assertEqual(self.server.count('GET', 'trigger'), 1)
+        self.assertEqual(self.server.count('GET', 'user/settings'), 0)
+
+    def test_expired(self):
+        self._run()
+        self._run(max_age=0)
+        self.assertEqual(self.server.count('GET'), 3)
+        self.assertEqual(self.server.count('GET', 'tag/stats'), 0)
+
+    def test_own_writes_cached(self):
+        snapshot = MoiraSnapshot(self.moira, cache=SnapshotCache(self.directory))
+        self._read(snapshot)
+        del self.server.subscriptions['s1']
+        snapshot.discard_subscription('s1')
+        self.server.triggers['2'] = {
+            'id': '2',
+            'name': 'a',
+            'tags': ['t'],
+            'targets': ['x'],
+        }
+        snapshot.put_trigger('2', 'a', ['t'])
+        snapshot.save()
+
+        self.assertEqual(self._run(), ([], ['c1'], ['1', '2']))
+        self.assertEqual(self.server.count('GET'), 1)
+
+
+class ConfigCacheTest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = os.path.join(directory.name, 'configs')
+        self.filename = os.path.join(directory.name, 'alert.yaml')
+        with open(self.filename, 'w') as stream:
+            stream.write(CONFIG)
+
+    def _read(self, cluster_name='prod', version='1'):
+        return config.read_from_file(
+            self.filename,
+            cluster_name=cluster_name,
+            cache=ConfigCache(self.directory, version=version),
+        )
+
+    def test_same_as_cold_parse(self):
+        cold = config.read_from_file(self.filename, cluster_name='prod')
+        self.assertEqual(self._read(), cold)
+        with patch.object(config, '_parse') as _parse_mock:
+            cached = self._read()
+        self.assertFalse(_parse_mock.called)
+        self.assertEqual(cached, cold)
+        self.assertEqual(cached.json(), cold.json())
+        self.assertEqual(
+            [t.__fields_set__ for t in cached.triggers],
+            [t.__fields_set__ for t in cold.triggers],
+        )
+
+    def test_stored_as_json(self):
+        self._read()
+        (name,) = os.listdir(self.directory)
+        with open(os.path.join(self.directory, name), 'rb') as stream:
+            content = json.loads(zlib.decompress(stream.read()))
+        self.assertEqual(content['config']['triggers'][0]['name'], 'svc-a')
+        self.assertNotIn('ttl', content['config']['triggers'][0])
+
+    def test_keyed_on_content_cluster_and_version(self):
+        self._read()
+        self._read(cluster_name='dev')
+        self._read(version='2')
+        with open(self.filename, 'ab') as stream:
+            stream.write(b'\n# changed\n')
+        self._read()
+        self.assertEqual(len(os.listdir(self.directory)), 4)
+        self.assertEqual(self._read(cluster_name='dev').triggers[0].tags, ['svc-dev'])
+
+    def test_unreadable_ignored_and_unused_removed(self):
+        self._read()
+        (name,) = os.listdir(self.directory)
+        with open(os.path.join(self.directory, name), 'wb') as stream:
+            stream.write(b'garbage')
+        self.assertEqual(
+            self._read(), config.read_from_file(self.filename, cluster_name='prod')
+        )
+
+        os.utime(os.path.join(self.directory, name), (0, 0))
+        config.read_from_file(
+            self.filename,
+            cluster_name='dev',
+            cache=ConfigCache(self.directory, version='1'),
+        )
+        self.assertNotIn(name, os.listdir(self.directory))
+
+
+class ValidationCacheTest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_round_trip_and_stats(self):
+        validation_cache = ValidationCache.for_url(
+            'http://graphite/render', directory=self.directory
+        )
+        validation_cache.put('valid', None)
+        validation_cache.put('invalid', 'Bad target')
+        validation_cache.save()
+
+        validation_cache = ValidationCache.for_url(
+            'http://graphite/render', directory=self.directory
+        )
+        self.assertEqual(
+            validation_cache.get(['valid', 'invalid', 'unknown']),
+            {'valid': None, 'invalid': 'Bad target'},
+        )
+        self.assertEqual(
+            validation_cache.summary(), 'Validation cache: 2 hits (1 invalid), 1 misses'
+        )
+        self.assertEqual(
+            ValidationCache.for_url(
+                'http://other/render', directory=self.directory
+            ).get(['valid']),
+            {},
+        )
+
+    def test_negative_ttl(self):
+        validation_cache = ValidationCache.for_url('url', directory=self.directory)
+        validation_cache.put('valid', None)
+        validation_cache.put('invalid', 'Bad target')
+        validation_cache.negative_ttl = 0
+        self.assertEqual(validation_cache.get(['valid', 'invalid']), {'valid': None})
+        validation_cache.save()
+
+        with open(validation_cache.path, 'rb') as stream:
+            self.assertNotIn(b'invalid', zlib.decompress(stream.read()))
+
+
+class CachedSetupTest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.moira = Moira('http://localhost:1234/api/')
+        self.redis = FakeRedis()
+        self.data = Alerts(triggers=[{'name': 'a', 'tags': ['t'], 'targets': ['x']}])
+        self.remote_ids = []
+        self.remote_tag = 't'
+
+    def _setup(self):
+        def create(**fields):
+            trigger = mock_trigger(**fields)
+            self.remote_ids.append(trigger.id)
+            return trigger
+
+        with patch.object(self.moira, '_trigger') as _trigger_mock, patch.object(
+            self.moira, '_subscription'
+        ), patch.object(self.moira, '_tag') as _tag_mock:
+            _trigger_mock.create = Mock(side_effect=create)
+            _trigger_mock.fetch_by_id = Mock(return_value=None)
+            _tag_mock.stats = lambda: [TagStats(self.remote_tag, [], self.remote_ids)]
+            MoiraAlert(
+                self.moira,
+                self.redis,
+                'test',
+                snapshot_cache=SnapshotCache(self.directory),
+            ).setup(self.data)
+        return _trigger_mock
+
+    def test_registered_triggers_read_from_cache(self):
+        self.assertEqual(self._setup().create.call_count, 1)
+
+        _trigger_mock = self._setup()
+        self.assertFalse(_trigger_mock.fetch_by_id.called)
+        self.assertFalse(_trigger_mock.create.called)
+
+        # tags of the trigger were changed in Moira
+        self.remote_tag = 'u'
+        _trigger_mock = self._setup()
+        self.assertEqual(_trigger_mock.fetch_by_id.call_count, 1)
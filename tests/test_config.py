@@ -0,0 +1,225 @@
+import io
+import os
+import tempfile
+
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+import yaml
+from moira_client import Moira
+from pydantic import ValidationError
+
+from alert_autoconf import config
+from alert_autoconf.config import ConfigReader, read_manifest
+from alert_autoconf.models import Alerts, Subscription, TriggerFile
+from alert_autoconf.moira import MoiraAlert
+
+from fakes import FakeRedis
+
+
+TRIGGER = '''
+  - name: trigger {}
+    tags: ['{{cluster}}', OK]
+    targets: ['stats.{{cluster}}.errors']
+'''
+HEADER = 'version: 1.1\nprefix: svc-\n'
+ALERTING = (
+    'alerting:\n'
+    '  - tags: [\'{cluster}\']\n'
+    '    contacts: [{type: mail, value: team@example.com}]\n'
+)
+
+
+def _config(triggers=2, header=HEADER):
+    return (
+        header
+        + 'triggers:'
+        + ''.join(TRIGGER.format(i) for i in range(triggers))
+        + ALERTING
+    )
+
+
+class _Stream(io.BytesIO):
+    """Counts how many bytes the parser has read."""
+
+    def read(self, size=-1):
+        chunk = super().read(size)
+        self.position = self.tell()
+        return chunk
+
+
+class ConfigReaderTest(TestCase):
+    def test_items_rendered(self):
+        items = list(ConfigReader(_config().encode(), 'prod'))
+        self.assertEqual(
+            [type(item) for item in items], [TriggerFile, TriggerFile, Subscription]
+        )
+        self.assertEqual(
+            [items[0].name, items[1].name], ['svc-trigger 0', 'svc-trigger 1']
+        )
+        self.assertEqual(items[0].tags, ['svc-prod', 'OK'])
+        self.assertEqual(items[0].targets, ['stats.prod.errors'])
+        self.assertEqual(items[2].tags, ['svc-prod'])
+
+    def test_items_streamed(self):
+        stream = _Stream(_config(triggers=2000).encode())
+        next(iter(ConfigReader(stream, 'prod')))
+        self.assertLess(stream.position, len(stream.getvalue()) / 2)
+
+    def test_header_after_sections(self):
+        content = _config(header='') + HEADER
+        self.assertEqual(
+            list(ConfigReader(content.encode(), 'prod')),
+            list(ConfigReader(_config().encode(), 'prod')),
+        )
+
+    def test_read_same_as_whole_document(self):
+        for content in (
+            'triggers: [{name: a, tags: [t], targets: [x]}]\nversion: 1\n',
+            'triggers: &t []\nalerting: *t\n',
+            'prefix: svc-\n',
+        ):
+            with self.subTest(content=content):
+                data = ConfigReader(content.encode(), None).read()
+                whole = Alerts(**yaml.load(content, Loader=config.YAML_LOADER))
+                self.assertEqual(data, whole)
+                self.assertEqual(data.__fields_set__, whole.__fields_set__)
+
+    def test_errors_point_to_item(self):
+        for content, loc in (
+            (
+                _config(header='version: 1\n').replace('trigger 1', '[1]'),
+                ('triggers', 1, 'name'),
+            ),
+            (_config() + '  - 5\n', ('alerting', 1)),
+            (
+                'triggers:'
+                + TRIGGER.format(0)
+                + TRIGGER.format(1).replace('targets', 'target'),
+                ('triggers', 1, 'targets'),
+            ),
+        ):
+            with self.subTest(loc=loc), self.assertRaises(ValidationError) as error:
+                ConfigReader(content.encode(), 'prod').read()
+            self.assertEqual([e['loc'] for e in error.exception.errors()], [loc])
+
+    def test_not_a_mapping(self):
+        for content in ('', '- 1'):
+            with self.subTest(content=content), self.assertRaises(TypeError):
+                ConfigReader(content.encode(), None).read()
+
+
+class ReadManifestTest(TestCase):
+    def _write(self, text):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        directory = directory.name
+        filename = os.path.join(directory, 'manifest.yaml')
+        with open(filename, 'w') as stream:
+            stream.write(text)
+        return directory, filename
+
+    def test_read(self):
+        directory, filename = self._write(
+            'configs:\n'
+            '  - config: service/alert.yaml\n'
+            '    token: service\n'
+            '  - config: /abs/alert.yaml\n'
+            '    cluster: prod\n'
+        )
+        entries = read_manifest(filename).configs
+        self.assertEqual(
+            [(e.config, e.token, e.cluster) for e in entries],
+            [
+                (os.path.join(directory, 'service/alert.yaml'), 'service', None),
+                ('/abs/alert.yaml', 'kubernetes:prod', 'prod'),
+            ],
+        )
+
+    def test_invalid(self):
+        for text in (
+            'configs:\n  - config: a.yaml\n',
+            'configs:\n'
+            '  - {config: a.yaml, token: t}\n'
+            '  - {config: b.yaml, cluster: c, token: t}\n',
+        ):
+            with self.subTest(text=text), self.assertRaises(ValidationError):
+                read_manifest(self._write(text)[1])
+
+
+class ConfigDigestTest(TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.moira = Moira('http://localhost:1234/api/')
+        self.subscriptions = [
+            SimpleNamespace(
+                id='s1',
+                tags=['t'],
+                contacts=['c1'],
+                escalations=[],
+                sched={'startOffset': 0, 'endOffset': 1439, 'tzOffset': 0, 'days': []},
+            )
+        ]
+        self.contacts = [
+            SimpleNamespace(id='c1', type='mail', value='a@b.c', fallback_value=None)
+        ]
+        self.digest = config.config_digest(
+            config.read_from_file('tests/valid_config.yaml', cluster_name=None),
+            version='1',
+        )
+
+    def _alert(self):
+        alert = MoiraAlert(self.moira, self.redis, 'test')
+        subscription_mock = patch.object(self.moira, '_subscription').start()
+        subscription_mock.fetch_all = Mock(side_effect=lambda: self.subscriptions)
+        contact_mock = patch.object(self.moira, '_contact').start()
+        contact_mock.fetch_by_current_user = Mock(side_effect=lambda: self.contacts)
+        self.addCleanup(patch.stopall)
+        return alert
+
+    def test_config_digest(self):
+        data = config.read_from_file('tests/valid_config.yaml', cluster_name=None)
+        self.assertEqual(config.config_digest(data, version='1'), self.digest)
+        self.assertNotEqual(config.config_digest(data, version='2'), self.digest)
+        data.triggers[0].ttl += 1
+        self.assertNotEqual(config.config_digest(data, version='1'), self.digest)
+
+    def test_unchanged(self):
+        alert = self._alert()
+        self.assertFalse(alert.is_up_to_date(self.digest))
+        alert.save_digest(self.digest)
+        self.assertTrue(alert.is_up_to_date(self.digest))
+        self.assertFalse(
+            alert.is_up_to_date(config.config_digest(Alerts(), version='1'))
+        )
+
+    def test_remote_state_changed(self):
+        alert = self._alert()
+        alert.save_digest(self.digest)
+        self.subscriptions[0].tags = ['other']
+        self.assertFalse(alert.is_up_to_date(self.digest))
+
+    def test_redis_state_changed(self):
+        alert = self._alert()
+        alert.save_digest(self.digest)
+        self.redis.sadd('autoconf:token:test', 't1')
+        self.assertFalse(alert.is_up_to_date(self.digest))
+
+    def test_setup_reuses_remote_state(self):
+        alert = self._alert()
+        self.redis.sadd('autoconf:token-alerting:test', 's1')
+        alert.save_digest(self.digest)
+        self.subscriptions[0].tags = ['other']
+        self.assertFalse(alert.is_up_to_date(self.digest))
+        alert.setup(Alerts())
+
+        # once for save_digest and once for is_up_to_date and setup
+        self.assertEqual(self.moira.subscription.fetch_all.call_count, 2)
+        self.assertEqual(self.moira.contact.fetch_by_current_user.call_count, 2)
+
+    def test_setup_clears_digest(self):
+        alert = self._alert()
+        alert.save_digest(self.digest)
+        alert.setup(Alerts())
+        self.assertIsNone(alert.storage.load().digest)
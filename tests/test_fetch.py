@@ -0,0 +1,95 @@
+import threading
+import time
+
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from moira_client import Moira
+from redis import Redis
+
+from alert_autoconf.concurrency import bounded_apply, bounded_map
+from alert_autoconf.moira import MoiraAlert
+
+from fakes import FakeRedis
+
+
+class BoundedMapTest(TestCase):
+    def test_keeps_order(self):
+        def slow_square(x):
+            time.sleep(0.001 * (10 - x))
+            return x * x
+
+        self.assertEqual(
+            bounded_map(slow_square, range(10), 4), [x * x for x in range(10)]
+        )
+
+    def test_respects_worker_limit(self):
+        lock = threading.Lock()
+        running = [0]
+        peak = [0]
+
+        def work(_):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.005)
+            with lock:
+                running[0] -= 1
+
+        bounded_map(work, range(20), 3)
+        self.assertLessEqual(peak[0], 3)
+
+    def test_reraises(self):
+        def fail(x):
+            raise RuntimeError(x)
+
+        with self.assertRaises(RuntimeError):
+            bounded_map(fail, range(5), 2)
+
+    def test_apply_processes_every_item(self):
+        def check(x):
+            if x % 2:
+                raise RuntimeError(x)
+            return x
+
+        outcomes = bounded_apply(check, range(6), 3)
+        self.assertEqual([o.result for o in outcomes], [0, None, 2, None, 4, None])
+        self.assertEqual([o.error.args[0] for o in outcomes if o.error], [1, 3, 5])
+
+
+class FetchTriggersTest(TestCase):
+    def setUp(self):
+        self.moira = Moira('http://localhost:1234/api/')
+        self.redis = Redis.from_url('redis://localhost:5678/10')
+
+    def test_invalid_fetch_workers_raises_ValueError(self):
+        with self.assertRaises(ValueError):
+            MoiraAlert(self.moira, self.redis, 'test', fetch_workers=0)
+
+    def test_fetch_keeps_order(self):
+        ids = [str(i) for i in range(20)]
+        with patch.object(self.moira, '_trigger') as _trigger_mock:
+            _trigger_mock.fetch_by_id = Mock(side_effect=lambda tid: 'trigger-' + tid)
+            alert = MoiraAlert(self.moira, self.redis, 'test', fetch_workers=8)
+            result = alert._fetch_triggers(ids)
+
+        self.assertEqual(result, ['trigger-' + i for i in ids])
+        self.assertEqual(_trigger_mock.fetch_by_id.call_count, len(ids))
+
+    def test_missing_triggers_removed_in_one_call(self):
+        redis = FakeRedis()
+        redis.sadd(MoiraAlert.TRIGGER_TOKEN_PREFIX + 'test', '1', '2', '3')
+        redis.log.clear()
+        with patch.object(self.moira, '_trigger') as _trigger_mock:
+            _trigger_mock.fetch_by_id = Mock(return_value=None)
+            alert = MoiraAlert(self.moira, redis, 'test', fetch_workers=4)
+            with alert.storage.batch():
+                snapshot = alert._load_trigger_snapshot(
+                    [], alert.storage.load().trigger_ids
+                )
+
+        self.assertEqual(redis.commands['SREM'], 1)
+        self.assertEqual(set(redis.sent('SREM', alert.trigger_token)), {'1', '2', '3'})
+        self.assertFalse(redis.exists(alert.trigger_token))
+        self.assertTrue(snapshot.registered)
+        self.assertEqual(len(snapshot), 0)
@@ -0,0 +1,46 @@
+from unittest import TestCase
+
+from benchmark_import import (
+    ENTRY_POINTS,
+    HEAVY_MODULES,
+    HELP_IMPORT_BUDGET,
+    RUN_IMPORT_BUDGETS,
+    RUN_IMPORTS,
+    import_times,
+    run_import_times,
+    seconds,
+)
+
+
+# the fastest of several measurements is compared,
+# so that a busy machine does not fail the test
+TRIES = 3
+
+
+def _fastest(measure) -> float:
+    return min(seconds(measure()) for _ in range(TRIES))
+
+
+class ImportTimeTest(TestCase):
+    def test_help(self):
+        for script in ENTRY_POINTS:
+            with self.subTest(script=script):
+                modules = import_times(script, '--help')
+                self.assertEqual(
+                    [
+                        name
+                        for name in modules
+                        if name in HEAVY_MODULES or name.split('.')[0] in HEAVY_MODULES
+                    ],
+                    [],
+                )
+                self.assertLess(
+                    _fastest(lambda: import_times(script, '--help')), HELP_IMPORT_BUDGET
+                )
+
+    def test_runs(self):
+        for run in RUN_IMPORTS:
+            with self.subTest(run=run):
+                self.assertLess(
+                    _fastest(lambda: run_import_times(run)), RUN_IMPORT_BUDGETS[run]
+                )
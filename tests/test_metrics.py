@@ -0,0 +1,151 @@
+import json
+import os
+import tempfile
+
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from moira_client import Moira
+
+from alert_autoconf.metrics import RunMetrics, api_endpoint, instrument_redis
+from alert_autoconf.models import Alerts
+from alert_autoconf.moira import MoiraAlert
+from alert_autoconf.storage import TokenStorage
+from alert_autoconf.transport import PooledMoira
+
+from fakes import FakeRedis, mock_trigger
+
+
+class RunMetricsTest(TestCase):
+    def test_api_endpoint(self):
+        self.assertEqual(api_endpoint('trigger/1a2b/state'), 'trigger/{id}/state')
+        self.assertEqual(api_endpoint('subscription/1a2b'), 'subscription/{id}')
+        self.assertEqual(api_endpoint('user/settings'), 'user/settings')
+        self.assertEqual(api_endpoint('trigger'), 'trigger')
+
+    def test_count_api_calls(self):
+        transport = Mock(request=Mock(return_value={}))
+        metrics = RunMetrics()
+        moira = PooledMoira(
+            'http://localhost:1234/api/', transport, on_request=metrics.count_api_call
+        )
+
+        moira._client.get('trigger/1/state')
+        moira._client.get('trigger/2/state')
+        moira._client.post('subscription', json={})
+        moira._client.delete('subscription/3')
+        self.assertEqual(
+            dict(metrics.api_calls),
+            {
+                ('GET', 'trigger/{id}/state'): 2,
+                ('POST', 'subscription'): 1,
+                ('DELETE', 'subscription/{id}'): 1,
+            },
+        )
+        self.assertEqual(
+            transport.request.call_args[0],
+            ('DELETE', 'http://localhost:1234/api/subscription/3'),
+        )
+
+    def test_instrument_redis(self):
+        redis = FakeRedis()
+        metrics = RunMetrics()
+        instrument_redis(redis, metrics)
+
+        storage = TokenStorage(redis, 'test')
+        storage.load()
+        redis.get('key')
+        self.assertEqual(metrics.redis_round_trips, 2)
+        self.assertEqual(metrics.redis_commands['SMEMBERS'], 2)
+        self.assertEqual(metrics.redis_commands['GET'], 2)
+
+    def test_prometheus(self):
+        metrics = RunMetrics()
+        with metrics.phase('read_config'):
+            pass
+        metrics.count_api_call('GET', 'trigger/1')
+        metrics.tally('trigger', 'create', 3)
+        metrics.success = True
+        text = metrics.to_prometheus({'token': 'a "b"'})
+
+        self.assertIn('# TYPE alert_autoconf_phase_seconds gauge\n', text)
+        # the file is rewritten by every run,
+        # so its counts are labelled as totals of the last run
+        self.assertIn(
+            '# HELP alert_autoconf_redis_commands '
+            'Redis commands in the last run by name.\n',
+            text,
+        )
+        self.assertIn('alert_autoconf_run_success{token="a \\"b\\""} 1\n', text)
+        self.assertIn(
+            'alert_autoconf_moira_requests'
+            '{endpoint="trigger/{id}",method="GET",token="a \\"b\\""} 1\n',
+            text,
+        )
+        self.assertIn(
+            'alert_autoconf_objects'
+            '{action="create",kind="trigger",token="a \\"b\\""} 3\n',
+            text,
+        )
+
+    def test_write(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        metrics = RunMetrics()
+        metrics.tally('subscription', 'delete')
+        metrics.write_json(os.path.join(directory.name, 'metrics.json'))
+        metrics.write_prometheus(os.path.join(directory.name, 'metrics.prom'))
+
+        with open(os.path.join(directory.name, 'metrics.json')) as stream:
+            self.assertEqual(json.load(stream)['objects'], {'subscription delete': 1})
+        self.assertEqual(
+            sorted(os.listdir(directory.name)), ['metrics.json', 'metrics.prom']
+        )
+
+
+class SetupMetricsTest(TestCase):
+    def test_phases_and_tallies(self):
+        moira = Moira('http://localhost:1234/api/')
+        data = Alerts(
+            triggers=[
+                {'name': 'a', 'tags': ['t'], 'targets': ['x']},
+                {
+                    'name': 'b',
+                    'tags': ['t'],
+                    'targets': ['y'],
+                    'parents': [{'name': 'p', 'tags': ['t']}],
+                },
+            ]
+        )
+
+        metrics = RunMetrics()
+        with patch.object(moira, '_trigger') as _trigger_mock, patch.object(
+            moira, '_subscription'
+        ):
+            _trigger_mock.fetch_all = Mock(
+                return_value=[SimpleNamespace(id='1', name='p', tags=['t'])]
+            )
+            _trigger_mock.create = Mock(side_effect=mock_trigger)
+            MoiraAlert(moira, FakeRedis(), 'test', metrics=metrics).setup(data)
+
+        self.assertEqual(
+            set(metrics.phase_seconds),
+            {
+                'load_triggers',
+                'triggers_pass_1',
+                'triggers_pass_2',
+                'find_trigger_parents',
+                'alerting',
+            },
+        )
+        self.assertEqual(metrics.phase_calls['find_trigger_parents'], 1)
+        # pass 1 creates both triggers, pass 2 sets the parent of the second one
+        self.assertEqual(
+            dict(metrics.objects),
+            {
+                ('trigger', 'create'): 2,
+                ('trigger', 'update'): 1,
+                ('trigger', 'unchanged'): 1,
+            },
+        )
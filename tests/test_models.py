@@ -0,0 +1,150 @@
+import json
+import uuid
+
+from datetime import time
+from unittest import TestCase
+
+from alert_autoconf.models import (
+    DaysEnum,
+    Saturation,
+    Trigger,
+    TriggerFile,
+    TtlStateEnum,
+)
+from alert_autoconf.moira import trigger_json_to_model
+from alert_autoconf.reconcile import render_trigger
+
+
+def _values(**kwargs):
+    values = {
+        'id': str(uuid.uuid4()),
+        'name': 'a',
+        'tags': ['t'],
+        'targets': ['x'],
+        'warn_value': 10.0,
+        'error_value': 20,
+        'ttl_state': 'ERROR',
+        'day_disable': ['Mon', 'Sun'],
+        'time_start': time(hour=1, minute=30),
+        'parents': ['p'],
+        'saturation': [
+            {'type': 'take-heartbeat', 'fallback': 'OK', 'parameters': {'x': 1}}
+        ],
+    }
+    values.update(kwargs)
+    return values
+
+
+class TrustedTriggerTest(TestCase):
+    def assertSameModel(self, trusted, validated):
+        self.assertEqual(type(trusted), type(validated))
+        self.assertEqual(trusted, validated)
+        self.assertEqual(trusted.__fields_set__, validated.__fields_set__)
+        self.assertEqual(trusted.json(), validated.json())
+
+    def test_same_as_validated(self):
+        for values in (
+            _values(),
+            _values(warn_value=None, error_value=None, saturation=[], parents=None),
+            {'name': 'a', 'tags': ['t'], 'targets': ['x', 'y']},
+            json.loads(Trigger(**_values()).json()),
+        ):
+            with self.subTest(values=values):
+                trusted = Trigger.trusted(values)
+                self.assertSameModel(trusted, Trigger(**values))
+        self.assertIs(trusted.ttl_state, TtlStateEnum.ERROR)
+        self.assertEqual(trusted.day_disable, [DaysEnum.MON, DaysEnum.SUN])
+        self.assertIsInstance(trusted.saturation[0], Saturation)
+
+    def test_dashboard_validated(self):
+        values = _values(dashboard='http://grafana/d/1')
+        self.assertSameModel(Trigger.trusted(values), Trigger(**values))
+
+    def test_moira_json(self):
+        data = {
+            'id': str(uuid.uuid4()),
+            'name': 'a',
+            'tags': ['t'],
+            'targets': ['x'],
+            'warn_value': 1.0,
+            'error_value': 2.0,
+            'ttl_state': 'NODATA',
+            'dashboard': '',
+            'sched': {
+                'startOffset': 90,
+                'endOffset': 1439,
+                'days': [{'name': 'Tue', 'enabled': False}],
+            },
+            'saturation': [{'type': 'check-first-target', 'extra_parameters': None}],
+        }
+        trigger = trigger_json_to_model(data)
+        validated = Trigger(
+            **{**trigger.dict(), 'saturation': [s.dict() for s in trigger.saturation]}
+        )
+        self.assertEqual(trigger, validated)
+        self.assertEqual(trigger.warn_value, 1)
+        self.assertEqual(trigger.time_start, time(hour=1, minute=30))
+
+    def test_render_trigger(self):
+        trigger = TriggerFile(**_values(parents=[{'name': 'p', 'tags': ['t']}]))
+        rendered = render_trigger(trigger, ['1'])
+
+        fields = trigger.dict()
+        fields['parents'] = ['1']
+        del fields['id']
+        self.assertSameModel(rendered, Trigger(**fields))
+        rendered.tags.append('u')
+        self.assertEqual(trigger.tags, ['t'])
+
+
+class CanonicalFormTest(TestCase):
+    def test_equal(self):
+        trigger = Trigger(
+            **_values(
+                tags=['t', 'u'], dashboard='http://grafana/d/1?panelId=2&from=now-1h'
+            )
+        )
+        same = Trigger(
+            **_values(tags=['u', 't'], dashboard='http://grafana/d/2?panelId=2')
+        )
+        self.assertEqual(trigger.canonical(), same.canonical())
+        self.assertEqual(hash(trigger.canonical()), hash(same.canonical()))
+        self.assertIn(same.canonical(), {trigger.canonical()})
+
+    def test_different(self):
+        trigger = Trigger(**_values())
+        for values in (
+            _values(tags=['t', 'u']),
+            _values(warn_value=11),
+            _values(dashboard='http://grafana/d/1?panelId=3'),
+            _values(saturation=[]),
+        ):
+            with self.subTest(values=values):
+                self.assertNotEqual(trigger.canonical(), Trigger(**values).canonical())
+
+    def test_parents(self):
+        trigger = Trigger(**_values(parents=['p']))
+        other = Trigger(**_values(parents=['q']))
+        self.assertNotEqual(trigger.canonical(), other.canonical())
+        self.assertEqual(
+            trigger.canonical(ignore_inheritance=True),
+            other.canonical(ignore_inheritance=True),
+        )
+        self.assertEqual(trigger.canonical_fields()[-1], 'parents')
+        self.assertNotIn('parents', trigger.canonical_fields(ignore_inheritance=True))
+
+    def test_reset_on_assignment(self):
+        trigger = Trigger(**_values())
+        canonical = trigger.canonical()
+        self.assertIs(trigger.canonical(), canonical)
+        trigger.name = 'b'
+        self.assertNotEqual(trigger.canonical(), canonical)
+        self.assertEqual(set(trigger.dict()), set(Trigger.__fields__))
+
+    def test_saturation(self):
+        saturation = Saturation(type='take-heartbeat', parameters={'x': 1})
+        same = Saturation.trusted({'type': 'take-heartbeat', 'parameters': {'x': 1}})
+        self.assertEqual(saturation, same)
+        self.assertEqual(hash(saturation), hash(same))
+        saturation.fallback = 'OK'
+        self.assertNotEqual(saturation, same)
@@ -0,0 +1,205 @@
+import random
+import uuid
+
+from concurrent.futures import ProcessPoolExecutor
+from unittest import TestCase
+from unittest.mock import patch
+
+from alert_autoconf import reconcile
+from alert_autoconf.models import Trigger
+from alert_autoconf.reconcile import (
+    _is_equal_trigger,
+    _is_same_trigger_but_changed,
+    plan_triggers,
+    plan_triggers_sharded,
+    render_trigger,
+)
+
+
+def _make_trigger(**kwargs):
+    fields = {
+        'name': 'Trigger_1',
+        'tags': ['service_1'],
+        'targets': ['stats.timer_1'],
+        'parents': [],
+    }
+    fields.update(**kwargs)
+    return Trigger(**fields)
+
+
+def _legacy_plan(triggers, api_triggers, ignore_inheritance):
+    """The nested loops previously used by MoiraAlert._triggers_worker."""
+    triggers_to_create = triggers.copy()
+    for trigger in triggers:
+        for api_trigger in api_triggers:
+            try:
+                if triggers_to_create and _is_equal_trigger(
+                    trigger, api_trigger, ignore_inheritance
+                ):
+                    triggers_to_create.remove(trigger)
+            except Exception:
+                pass
+
+    to_update = []
+    to_delete = []
+    for api_trigger in api_triggers:
+        if [t for t in triggers if _is_same_trigger_but_changed(t, api_trigger)]:
+            for trigger in [
+                t
+                for t in triggers_to_create
+                if _is_same_trigger_but_changed(t, api_trigger)
+            ]:
+                to_update.append((trigger, api_trigger))
+                triggers_to_create = [t for t in triggers_to_create if t is not trigger]
+                break
+        else:
+            to_delete.append(api_trigger)
+    return to_update, to_delete, triggers_to_create
+
+
+class PlanTriggersTest(TestCase):
+    def test_empty(self):
+        plan = plan_triggers([], [], ignore_inheritance=False)
+        self.assertEqual(plan, ([], [], [], []))
+
+    def test_unchanged(self):
+        left = _make_trigger(tags=['t1', 't2'])
+        right = _make_trigger(id=str(uuid.uuid4()), tags=['t2', 't1'])
+        plan = plan_triggers([left], [right], ignore_inheritance=False)
+        self.assertEqual(plan.unchanged, [left])
+        self.assertFalse(plan.to_update or plan.to_create or plan.to_delete)
+
+    def test_dashboard_compared_by_panel_id(self):
+        left = _make_trigger(dashboard='http://grafana.local/d/1?panelId=17&fullscreen')
+        right = _make_trigger(
+            id=str(uuid.uuid4()), dashboard='http://grafana.local/d/2?panelId=17'
+        )
+        plan = plan_triggers([left], [right], ignore_inheritance=False)
+        self.assertEqual(plan.unchanged, [left])
+
+    def test_update(self):
+        left = _make_trigger(desc='new')
+        right = _make_trigger(id=str(uuid.uuid4()), desc='old')
+        plan = plan_triggers([left], [right], ignore_inheritance=False)
+        self.assertEqual(plan.to_update, [(left, right)])
+        self.assertFalse(plan.unchanged or plan.to_create or plan.to_delete)
+
+    def test_parents_ignored_with_inheritance_off(self):
+        left = _make_trigger(parents=[])
+        right = _make_trigger(id=str(uuid.uuid4()), parents=[str(uuid.uuid4())])
+        self.assertEqual(plan_triggers([left], [right], True).unchanged, [left])
+        self.assertEqual(
+            plan_triggers([left], [right], False).to_update, [(left, right)]
+        )
+
+    def test_difference_logged(self):
+        left = _make_trigger(desc='new')
+        right = _make_trigger(id=str(uuid.uuid4()), desc='old')
+        with self.assertLogs(level='INFO') as logs:
+            self.assertFalse(_is_equal_trigger(left, right, ignore_inheritance=False))
+        self.assertEqual(
+            logs.output,
+            [
+                'INFO:root:Detected difference in trigger {}, '
+                'field desc: new != old'.format(right.id)
+            ],
+        )
+
+    def test_many_candidates(self):
+        api_triggers = [
+            _make_trigger(id=str(uuid.uuid4()), desc=str(i)) for i in range(20)
+        ]
+        left = _make_trigger(desc='7')
+        plan = plan_triggers([left], api_triggers, ignore_inheritance=False)
+        self.assertEqual(plan.unchanged, [left])
+        self.assertFalse(plan.to_update or plan.to_create)
+
+    def test_changed_targets_order_is_create_and_delete(self):
+        left = _make_trigger(targets=['a', 'b'], desc='new')
+        right = _make_trigger(id=str(uuid.uuid4()), targets=['b', 'a'], desc='old')
+        plan = plan_triggers([left], [right], ignore_inheritance=False)
+        self.assertEqual(plan.to_create, [left])
+        self.assertEqual(plan.to_delete, [right])
+
+    def test_matches_legacy_algorithm(self):
+        rnd = random.Random(42)
+
+        def random_trigger(with_id):
+            fields = {'id': str(uuid.uuid4())} if with_id else {}
+            return _make_trigger(
+                **fields,
+                name=rnd.choice(['a', 'b', 'c']),
+                tags=rnd.sample(['t1', 't2', 't3'], rnd.randint(1, 2)),
+                targets=rnd.sample(['x', 'y'], rnd.randint(1, 2)),
+                desc=rnd.choice(['', 'd']),
+                parents=rnd.choice([[], ['p']]),
+            )
+
+        for _ in range(200):
+            triggers = [random_trigger(False) for _ in range(rnd.randint(0, 8))]
+            api_triggers = [random_trigger(True) for _ in range(rnd.randint(0, 8))]
+            ignore_inheritance = rnd.choice([True, False])
+
+            plan = plan_triggers(triggers, api_triggers, ignore_inheritance)
+            to_update, to_delete, to_create = _legacy_plan(
+                triggers, api_triggers, ignore_inheritance
+            )
+
+            self.assertEqual(
+                [(id(t), id(api_t)) for t, api_t in plan.to_update],
+                [(id(t), id(api_t)) for t, api_t in to_update],
+            )
+            self.assertEqual(
+                [id(t) for t in plan.to_delete], [id(t) for t in to_delete]
+            )
+            self.assertEqual(
+                [t.dict() for t in plan.to_create], [t.dict() for t in to_create]
+            )
+
+
+class PlanTriggersShardedTest(TestCase):
+    def test_matches_plan_triggers(self):
+        rnd = random.Random(13)
+
+        def random_trigger(with_id):
+            fields = {'id': str(uuid.uuid4())} if with_id else {}
+            return _make_trigger(
+                **fields,
+                name=rnd.choice(['a', 'b', 'c', 'd', 'e']),
+                tags=rnd.sample(['t1', 't2', 't3'], rnd.randint(1, 2)),
+                targets=rnd.sample(['x', 'y'], rnd.randint(1, 2)),
+                desc=rnd.choice(['', 'd']),
+                parents=rnd.choice([[], ['p']]),
+            )
+
+        triggers = [random_trigger(False) for _ in range(300)]
+        parent_ids = [rnd.choice([[], ['p']]) for _ in triggers]
+        api_triggers = [random_trigger(True) for _ in range(300)]
+        rendered = [render_trigger(t, ids) for t, ids in zip(triggers, parent_ids)]
+        position = {id(t): i for i, t in enumerate(rendered)}
+
+        with ProcessPoolExecutor(max_workers=2) as executor, patch.object(
+            reconcile, 'SHARDED_PLAN_MIN_TRIGGERS', 0
+        ):
+            for ignore_inheritance in (True, False):
+                sharded = plan_triggers_sharded(
+                    triggers, parent_ids, api_triggers, ignore_inheritance, executor, 3
+                )
+                plan = plan_triggers(rendered, api_triggers, ignore_inheritance)
+
+                self.assertEqual(
+                    sharded.unchanged,
+                    [triggers[position[id(t)]] for t in plan.unchanged],
+                )
+                self.assertEqual(
+                    [(t.dict(), id(api_t)) for t, api_t in sharded.to_update],
+                    [(t.dict(), id(api_t)) for t, api_t in plan.to_update],
+                )
+                self.assertEqual(
+                    [t.dict() for t in sharded.to_create],
+                    [t.dict() for t in plan.to_create],
+                )
+                self.assertEqual(
+                    [id(t) for t in sharded.to_delete], [id(t) for t in plan.to_delete]
+                )
+                self.assertTrue(plan.to_update and plan.to_create and plan.to_delete)
@@ -0,0 +1,219 @@
+import uuid
+
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from moira_client import Moira
+from redis import Redis
+
+from alert_autoconf.models import Alerts, ParentTriggerRef, Trigger
+from alert_autoconf.moira import MoiraAlert
+from alert_autoconf.snapshot import MoiraSnapshot, TriggerCatalog, TriggerSnapshot
+
+from fakes import FakeRedis, mock_trigger
+
+
+def _moira_trigger(id, name, tags):
+    return SimpleNamespace(id=id, name=name, tags=tags)
+
+
+class TriggerCatalogTest(TestCase):
+    def test_find_ignores_tags_order(self):
+        catalog = TriggerCatalog(
+            [_moira_trigger('1', 'DC shutdown', ['global', 'datacenters'])]
+        )
+        self.assertEqual(catalog.find('DC shutdown', ['datacenters', 'global']), ['1'])
+        self.assertEqual(catalog.find('DC shutdown', ['datacenters']), [])
+
+    def test_put_moves_trigger(self):
+        catalog = TriggerCatalog([_moira_trigger('1', 'a', ['t'])])
+        catalog.put('1', 'b', ['t'])
+        self.assertEqual(catalog.find('a', ['t']), [])
+        self.assertEqual(catalog.find('b', ['t']), ['1'])
+        self.assertEqual(len(catalog), 1)
+
+    def test_discard(self):
+        catalog = TriggerCatalog(
+            [_moira_trigger('1', 'a', ['t']), _moira_trigger('2', 'a', ['t'])]
+        )
+        catalog.discard('1')
+        catalog.discard('unknown')
+        self.assertEqual(catalog.find('a', ['t']), ['2'])
+
+
+class FindTriggerParentsTest(TestCase):
+    def setUp(self):
+        self.moira = Moira('http://localhost:1234/api/')
+        self.redis = Redis.from_url('redis://localhost:5678/10')
+        self.all_triggers = [
+            _moira_trigger('1', 'DC shutdown', ['datacenters', 'global']),
+            _moira_trigger('2', 'maintenance', ['autoconf']),
+            _moira_trigger('3', 'maintenance', ['autoconf']),
+        ]
+
+    def test_catalog_fetched_once(self):
+        with patch.object(self.moira, '_trigger') as _trigger_mock:
+            _trigger_mock.fetch_all = Mock(return_value=self.all_triggers)
+            alert = MoiraAlert(self.moira, self.redis, 'test')
+            for _ in range(3):
+                parents = alert._find_trigger_parents(
+                    [
+                        ParentTriggerRef(
+                            name='DC shutdown', tags=['global', 'datacenters']
+                        )
+                    ]
+                )
+                self.assertEqual(parents, ['1'])
+
+        self.assertEqual(_trigger_mock.fetch_all.call_count, 1)
+
+    def test_errors(self):
+        with patch.object(self.moira, '_trigger') as _trigger_mock:
+            _trigger_mock.fetch_all = Mock(return_value=self.all_triggers)
+            alert = MoiraAlert(self.moira, self.redis, 'test')
+            with self.assertRaisesRegex(ValueError, 'Could not find trigger'):
+                alert._find_trigger_parents(
+                    [ParentTriggerRef(name='absent', tags=['x'])]
+                )
+            with self.assertRaisesRegex(ValueError, 'Found 2 > 1 triggers'):
+                alert._find_trigger_parents(
+                    [ParentTriggerRef(name='maintenance', tags=['autoconf'])]
+                )
+
+
+class TriggerSnapshotTest(TestCase):
+    def test_put_and_discard(self):
+        first = Trigger(id=str(uuid.uuid4()), name='a', tags=['t'], targets=['x'])
+        second = Trigger(id=str(uuid.uuid4()), name='b', tags=['t'], targets=['x'])
+        snapshot = TriggerSnapshot([first, second], registered=False)
+
+        changed = first.copy(update={'desc': 'changed'})
+        snapshot.put(changed)
+        self.assertEqual(snapshot.triggers(), [changed, second])
+        self.assertTrue(snapshot.registered)
+
+        snapshot.discard(second.id)
+        self.assertEqual(snapshot.triggers(), [changed])
+
+
+class TwoPhaseSetupTest(TestCase):
+    def setUp(self):
+        self.moira = Moira('http://localhost:1234/api/')
+        self.redis = FakeRedis()
+
+    def test_single_read_for_both_phases(self):
+        for plan_workers in (1, 2):
+            with self.subTest(plan_workers=plan_workers):
+                self.redis = FakeRedis()
+                self._check_single_read(plan_workers)
+
+    def _check_single_read(self, plan_workers):
+        data = Alerts(
+            triggers=[
+                {
+                    'name': 'child',
+                    'tags': ['service'],
+                    'targets': ['stats.timer'],
+                    'parents': [{'name': 'DC shutdown', 'tags': ['global']}],
+                }
+            ]
+        )
+        saved = []
+
+        def create(**fields):
+            trigger = mock_trigger(**fields)
+            trigger.save = Mock(side_effect=lambda: saved.append(fields))
+            return trigger
+
+        with patch.object(self.moira, '_trigger') as _trigger_mock, patch.object(
+            self.moira, '_subscription'
+        ):
+            _trigger_mock.fetch_all = Mock(
+                return_value=[_moira_trigger('1', 'DC shutdown', ['global'])]
+            )
+            _trigger_mock.create = Mock(side_effect=create)
+            alert = MoiraAlert(
+                self.moira, self.redis, 'test', plan_workers=plan_workers
+            )
+            alert.setup(data)
+
+        self.assertFalse(_trigger_mock.fetch_by_id.called)
+        self.assertEqual(_trigger_mock.fetch_all.call_count, 1)
+        # state is read once, each pass registers its triggers with one write
+        self.assertEqual(self.redis.round_trips, 3)
+        self.assertEqual(
+            self.redis.smembers(alert.trigger_token), {saved[1]['id'].encode()}
+        )
+        self.assertEqual(len(saved), 2)
+        self.assertEqual(saved[0]['parents'], [])
+        self.assertEqual(saved[1]['parents'], ['1'])
+        self.assertIn('id', saved[1])
+
+
+class MoiraSnapshotTest(TestCase):
+    def setUp(self):
+        self.moira = Moira('http://localhost:1234/api/')
+        self.redis = FakeRedis()
+        self.contact = SimpleNamespace(
+            id='c1', type='mail', value='a@b.c', fallback_value=None
+        )
+        self.created = []
+
+    def _create(self, **fields):
+        subscription = SimpleNamespace(id=str(uuid.uuid4()), save=Mock(), **fields)
+        self.created.append(subscription)
+        return subscription
+
+    def _sync(self, tokens, snapshot):
+        for token in tokens:
+            data = Alerts(
+                alerting=[
+                    {'tags': [token], 'contacts': [{'type': 'mail', 'value': 'a@b.c'}]}
+                ]
+            )
+            alert = MoiraAlert(self.moira, self.redis, token, moira_snapshot=snapshot)
+            if not alert.is_up_to_date('digest'):
+                alert.setup(data)
+                alert.save_digest('digest')
+
+    def test_tokens_share_one_download(self):
+        with patch.object(
+            self.moira, '_subscription'
+        ) as _subscription_mock, patch.object(self.moira, '_contact') as _contact_mock:
+            _subscription_mock.fetch_all = Mock(return_value=[])
+            _subscription_mock.create = Mock(side_effect=self._create)
+            _contact_mock.fetch_by_current_user = Mock(return_value=[self.contact])
+            snapshot = MoiraSnapshot(self.moira)
+            self._sync(['a', 'b'], snapshot)
+
+            self.assertEqual(_subscription_mock.fetch_all.call_count, 1)
+            self.assertEqual(_contact_mock.fetch_by_current_user.call_count, 1)
+            self.assertEqual(_subscription_mock.create.call_count, 2)
+            self.assertEqual(snapshot.subscriptions(), self.created)
+
+            # digests saved over the in-memory snapshot hold against a fresh download
+            _subscription_mock.fetch_all = Mock(return_value=list(self.created))
+            self._sync(['a', 'b'], MoiraSnapshot(self.moira))
+            self.assertEqual(_subscription_mock.create.call_count, 2)
+
+    def test_writes_applied_to_fetched_parts_only(self):
+        moira = Mock()
+        moira.trigger.fetch_all = Mock(return_value=[_moira_trigger('1', 'a', ['t'])])
+        moira.subscription.fetch_all = Mock(return_value=[SimpleNamespace(id='s1')])
+        snapshot = MoiraSnapshot(moira)
+
+        snapshot.put_trigger('2', 'a', ['t'])
+        snapshot.discard_subscription('s1')
+        self.assertEqual(snapshot.trigger_catalog().find('a', ['t']), ['1'])
+        self.assertEqual([s.id for s in snapshot.subscriptions()], ['s1'])
+
+        snapshot.put_trigger('2', 'b', ['t'])
+        snapshot.discard_trigger('1')
+        snapshot.put_subscription(SimpleNamespace(id='s2'))
+        snapshot.discard_subscription('s1')
+        self.assertEqual(snapshot.trigger_catalog().find('b', ['t']), ['2'])
+        self.assertEqual(len(snapshot.trigger_catalog()), 1)
+        self.assertEqual([s.id for s in snapshot.subscriptions()], ['s2'])
+        self.assertEqual(moira.trigger.fetch_all.call_count, 1)
+        self.assertEqual(moira.subscription.fetch_all.call_count, 1)
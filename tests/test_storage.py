@@ -0,0 +1,193 @@
+from types import SimpleNamespace
+from unittest import TestCase
+
+from moira_client import Moira
+
+from alert_autoconf.moira import MoiraAlert
+from alert_autoconf.storage import (
+    TokenStorage,
+    rebuild_subscription_owners,
+    scan_subscription_owners,
+)
+
+from fakes import FakeRedis
+
+
+class TokenStorageTest(TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.storage = TokenStorage(self.redis, 'test')
+
+    def test_load_in_one_round_trip(self):
+        self.redis.sadd('autoconf:token:test', 't1', 't2')
+        self.redis.sadd('autoconf:token-alerting:test', 's1')
+        self.redis.round_trips = 0
+
+        state = self.storage.load()
+
+        self.assertEqual(state.trigger_ids, {'t1', 't2'})
+        self.assertEqual(state.subscription_ids, {'s1'})
+        self.assertEqual(self.redis.round_trips, 1)
+
+    def test_load_absent_token(self):
+        state = self.storage.load()
+        self.assertEqual(state.trigger_ids, set())
+        self.assertEqual(state.subscription_ids, set())
+
+    def test_flush_merges_changes(self):
+        self.storage.add_triggers(['t1'])
+        self.storage.add_triggers(['t2', 't3'])
+        self.storage.remove_triggers(['t3'])
+        self.storage.add_subscriptions(['s1'])
+        self.assertEqual(self.redis.round_trips, 0)
+
+        self.storage.flush()
+        self.storage.flush()
+
+        self.assertEqual(self.redis.round_trips, 1)
+        self.assertEqual(self.redis.commands['SADD'], 2)
+        self.assertEqual(self.redis.smembers('autoconf:token:test'), {b't1', b't2'})
+        self.assertEqual(self.redis.smembers('autoconf:token-alerting:test'), {b's1'})
+
+    def test_batch_flushes_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with self.storage.batch():
+                self.storage.add_triggers(['t1'])
+                raise RuntimeError()
+
+        self.assertEqual(self.redis.smembers('autoconf:token:test'), {b't1'})
+
+
+class SubscriptionOwnersTest(TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+
+    def test_index_follows_alerting_set(self):
+        first = TokenStorage(self.redis, 'first')
+        first.add_subscriptions(['s1', 's2'])
+        first.flush()
+        self.assertEqual(
+            first.get_subscription_owners(['s1', 's2']), {'s1': 'first', 's2': 'first'}
+        )
+        self.assertEqual(self.redis.commands['SCAN'], 0)
+
+        first.remove_subscriptions(['s1'])
+        first.flush()
+        self.assertEqual(
+            self.redis.hgetall('autoconf:subscription-owners'), {b's2': b'first'}
+        )
+
+    def test_remove_keeps_owner_of_other_token(self):
+        first = TokenStorage(self.redis, 'first')
+        second = TokenStorage(self.redis, 'second')
+        first.add_subscriptions(['s1'])
+        first.flush()
+        second.add_subscriptions(['s1'])
+        second.flush()
+
+        first.remove_subscriptions(['s1'])
+        first.flush()
+        self.assertEqual(
+            self.redis.hgetall('autoconf:subscription-owners'), {b's1': b'second'}
+        )
+
+        second.remove_subscriptions(['s1'])
+        first.add_subscriptions(['s1'])
+        first.flush()
+        second.flush()
+        self.assertEqual(
+            self.redis.hgetall('autoconf:subscription-owners'), {b's1': b'first'}
+        )
+
+    def test_missing_owners_are_scanned(self):
+        # registered by alert.py of an older version, which does not update the index
+        self.redis.sadd('autoconf:token-alerting:second', 's2')
+        first = TokenStorage(self.redis, 'first')
+        first.add_subscriptions(['s1'])
+        first.flush()
+
+        self.assertEqual(
+            first.get_subscription_owners(['s1', 's2', 's3']),
+            {'s1': 'first', 's2': 'second'},
+        )
+        self.assertEqual(self.redis.commands['SCAN'], 1)
+        # only the ids missing from the index, in the sets of the other tokens
+        self.assertEqual(self.redis.commands['SISMEMBER'], 2)
+        self.assertEqual(self.redis.commands['SMEMBERS'], 0)
+
+    def test_remove_retried_when_owner_changes(self):
+        first = TokenStorage(self.redis, 'first')
+        first.add_subscriptions(['s1'])
+        first.flush()
+        hmget = self.redis._cmd_hmget
+
+        def take_over(name, *keys):
+            # another token registers the subscription between HMGET and EXEC
+            self.redis._cmd_hmget = hmget
+            owners = hmget(name, *keys)
+            second = TokenStorage(self.redis, 'second')
+            second.add_subscriptions(['s1'])
+            second.flush()
+            return owners
+
+        self.redis._cmd_hmget = take_over
+        first.remove_subscriptions(['s1'])
+        first.flush()
+
+        self.assertEqual(self.redis.commands['HMGET'], 2)
+        self.assertEqual(
+            self.redis.hgetall('autoconf:subscription-owners'), {b's1': b'second'}
+        )
+        self.assertEqual(self.redis.smembers('autoconf:token-alerting:first'), set())
+
+    def test_rebuild(self):
+        self.redis.sadd('autoconf:token-alerting:first', 's1', 's2')
+        self.redis.sadd('autoconf:token-alerting:second', 's3')
+
+        self.assertEqual(rebuild_subscription_owners(self.redis), 3)
+
+        storage = TokenStorage(self.redis, 'first')
+        self.redis.commands.clear()
+        self.assertEqual(
+            storage.get_subscription_owners(['s1', 's2', 's3']),
+            {'s1': 'first', 's2': 'first', 's3': 'second'},
+        )
+        self.assertEqual(self.redis.commands['SCAN'] + self.redis.commands['KEYS'], 0)
+
+    def test_scan_excludes_token(self):
+        self.redis.sadd('autoconf:token-alerting:first', 's1')
+        self.redis.sadd('autoconf:token-alerting:second', 's1', 's2')
+        self.assertEqual(
+            scan_subscription_owners(self.redis, exclude_token='first'),
+            {'s1': 'second', 's2': 'second'},
+        )
+
+
+class ProtectedSubscriptionsTest(TestCase):
+    def setUp(self):
+        self.moira = Moira('http://localhost:1234/api/')
+        self.redis = FakeRedis()
+        self.redis.sadd('autoconf:token-alerting:test', 'own')
+        self.redis.sadd('autoconf:token-alerting:other', 'foreign')
+        self.subscriptions = [SimpleNamespace(id=i) for i in ('own', 'foreign', 'free')]
+
+    def _protected(self):
+        alert = MoiraAlert(self.moira, self.redis, 'test')
+        return alert._get_protected_subscriptions(self.subscriptions)
+
+    def test_without_index(self):
+        self.assertEqual(self._protected(), {'foreign': 'other'})
+
+    def test_with_index(self):
+        rebuild_subscription_owners(self.redis)
+        self.redis.commands.clear()
+        self.subscriptions = self.subscriptions[:2]
+        self.assertEqual(self._protected(), {'foreign': 'other'})
+        self.assertEqual(self.redis.commands['SCAN'] + self.redis.commands['KEYS'], 0)
+        self.assertEqual(self.redis.commands['HMGET'], 1)
+
+    def test_registered_after_backfill(self):
+        rebuild_subscription_owners(self.redis)
+        # registered by alert.py of an older version during a rolling upgrade
+        self.redis.sadd('autoconf:token-alerting:other', 'free')
+        self.assertEqual(self._protected(), {'foreign': 'other', 'free': 'other'})
@@ -1,6 +1,11 @@
+import random
+
+from types import SimpleNamespace
 from unittest import TestCase
 
+from alert_autoconf.models import Contact, Subscription
 from alert_autoconf.moira import MoiraAlert
+from alert_autoconf.reconcile import plan_subscriptions, subscription_fingerprint
 
 
 def _make_sub(**kwargs):
@@ -78,3 +83,79 @@ class SubscriptionCmpTest(TestCase):
         s2 = _make_sub(escalations=[_make_esc(contacts=['2', '1'])])
         r = MoiraAlert._subscription_not_changed(s1, s2)
         self.assertTrue(r)
+
+
+def _subscription(tags, contact_ids, offset=None):
+    contacts = [Contact(id=i, type='mail', value=i) for i in contact_ids]
+    escalations = (
+        [] if offset is None else [{'contacts': contacts, 'offset_in_minutes': offset}]
+    )
+    return Subscription(tags=tags, contacts=contacts, escalations=escalations)
+
+
+def _moira_subscription(id, subscription):
+    return SimpleNamespace(id=id, **subscription.to_custom_dict())
+
+
+def _legacy_not_changed(first, second):
+    def escalations_to_set(escalations):
+        return set(
+            (e['offset_in_minutes'], tuple(sorted(e['contacts']))) for e in escalations
+        )
+
+    return (
+        all(set(first[f]) == set(second[f]) for f in ('tags', 'contacts'))
+        and all(
+            first['sched'][f] == second['sched'][f]
+            for f in ('startOffset', 'endOffset', 'tzOffset', 'days')
+        )
+        and escalations_to_set(first['escalations'])
+        == escalations_to_set(second['escalations'])
+    )
+
+
+class PlanSubscriptionsTest(TestCase):
+    def test_plan(self):
+        kept = _subscription(['t1', 't2'], ['c1', 'c2'], offset=10)
+        changed = _subscription(['t1'], ['c1'])
+        current = [
+            _moira_subscription(
+                '1', _subscription(['t2', 't1'], ['c2', 'c1'], offset=10)
+            ),
+            _moira_subscription('2', _subscription(['t1'], ['c1'], offset=10)),
+        ]
+        plan = plan_subscriptions([kept, changed], current)
+        self.assertEqual(plan.unchanged, [kept])
+        self.assertEqual(plan.to_create, [changed])
+        self.assertEqual([s.id for s in plan.to_delete], ['2'])
+
+    def test_duplicates_matched_once(self):
+        desired = [_subscription(['t'], ['c']), _subscription(['t'], ['c'])]
+        current = [
+            _moira_subscription(str(i), _subscription(['t'], ['c'])) for i in range(3)
+        ]
+        plan = plan_subscriptions(desired, current)
+        self.assertEqual(plan.to_create, [])
+        self.assertEqual([s.id for s in plan.to_delete], ['2'])
+
+    def test_fingerprint_matches_not_changed(self):
+        rnd = random.Random(7)
+
+        def random_sub():
+            return _make_sub(
+                tags=rnd.sample(['t1', 't2', 't3'], rnd.randint(0, 2)),
+                contacts=rnd.sample(['1', '2'], rnd.randint(0, 2)),
+                escalations=[
+                    _make_esc(
+                        rnd.choice([10, 20]), rnd.sample(['1', '2'], rnd.randint(1, 2))
+                    )
+                    for _ in range(rnd.randint(0, 2))
+                ],
+            )
+
+        for _ in range(200):
+            first, second = random_sub(), random_sub()
+            self.assertEqual(
+                subscription_fingerprint(first) == subscription_fingerprint(second),
+                _legacy_not_changed(first, second),
+            )
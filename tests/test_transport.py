@@ -0,0 +1,100 @@
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest import TestCase
+
+import requests
+
+from moira_client import Moira
+
+from alert_autoconf.models import Alerts
+from alert_autoconf.moira import MoiraAlert
+from alert_autoconf.transport import HttpTransport, PooledMoira
+
+from fakes import FakeMoiraServer, FakeRedis
+
+
+def _retry_policy(max_tries):
+    # the fields of moira_client.RetryPolicy
+    return SimpleNamespace(max_tries=max_tries, delay=0, backoff=1)
+
+
+class HttpTransportTest(TestCase):
+    def setUp(self):
+        self.server = FakeMoiraServer().start()
+        self.addCleanup(self.server.stop)
+        for i in range(50):
+            self.server.triggers[str(i)] = {
+                'id': str(i),
+                'name': 'trigger {}'.format(i),
+                'tags': ['t'],
+            }
+
+    def _moira(self, **kwargs):
+        transport = HttpTransport(**kwargs)
+        self.addCleanup(transport.close)
+        return PooledMoira(self.server.url, transport)
+
+    def test_connections_kept_alive(self):
+        moira = Moira(self.server.url)
+        for _ in range(3):
+            moira._client.get('trigger')
+        self.assertEqual(self.server.connections, 3)
+
+        self.server.connections = 0
+        moira = self._moira(pool_size=2)
+        with ThreadPoolExecutor(4) as executor:
+            results = list(
+                executor.map(
+                    moira._client.get, ['trigger/{}'.format(i) for i in range(20)]
+                )
+            )
+        self.assertEqual([r['id'] for r in results], [str(i) for i in range(20)])
+        self.assertLessEqual(self.server.connections, 2)
+
+    def test_gzip(self):
+        expected = self._moira(gzip=False)._client.get('trigger')
+        plain_bytes = self.server.response_bytes
+
+        self.server.response_bytes = 0
+        self.assertEqual(self._moira()._client.get('trigger'), expected)
+        self.assertLess(self.server.response_bytes, plain_bytes / 2)
+
+    def test_retries(self):
+        self.server.error_rate = 1
+        with self.assertRaises(requests.HTTPError):
+            self._moira(retry_policy=_retry_policy(3))._client.get('trigger')
+        self.assertEqual(self.server.count('GET', 'trigger'), 3)
+
+        self.server.error_rate = 0
+        with self.assertRaises(requests.HTTPError):
+            self._moira(retry_policy=_retry_policy(3))._client.get(
+                'trigger/missing/unknown'
+            )
+        self.assertEqual(self.server.count('GET', 'trigger/{id}/unknown'), 1)
+
+    def test_read_timeout(self):
+        self.server.latency = 0.2
+        with self.assertRaises(requests.Timeout):
+            self._moira(read_timeout=0.05)._client.get('trigger')
+
+    def test_sync_engine(self):
+        self.server.triggers.clear()
+        self.server.error_rate = 0.2
+        moira = self._moira(pool_size=4, retry_policy=_retry_policy(10))
+        redis = FakeRedis()
+        data = Alerts(
+            triggers=[
+                {'name': 'trigger {}'.format(i), 'tags': ['t'], 'targets': ['x']}
+                for i in range(20)
+            ]
+        )
+
+        MoiraAlert(moira, redis, 'test', fetch_workers=4, write_workers=4).setup(data)
+
+        self.assertEqual(len(self.server.triggers), 20)
+        self.assertEqual(
+            redis.members('autoconf:token:test'), set(self.server.triggers)
+        )
+        # injected errors were retried by the policy
+        self.assertGreater(sum(self.server.errors.values()), 0)
+        self.assertLessEqual(self.server.connections, 4)
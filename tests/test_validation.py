@@ -0,0 +1,207 @@
+import json
+import os
+import tempfile
+
+from unittest import TestCase
+from unittest.mock import Mock
+
+import requests
+
+from alert_autoconf.cache import ValidationCache
+from alert_autoconf.models import Alerts
+from alert_autoconf.validation import (
+    ConfigFile,
+    TargetValidator,
+    find_configs,
+    read_configs,
+    render_params,
+    validate_config,
+    validate_configs,
+)
+
+
+def _session(invalid=(), broken=(), unavailable=()):
+    """Session rendering targets like Graphite:
+    one invalid target fails the whole request.
+    """
+
+    def get(url, params, timeout):
+        targets = [v for k, v in params if k == 'target']
+        if any(t in broken for t in targets):
+            raise requests.ConnectionError('connection refused')
+        response = Mock(status_code=200)
+        if any(t in unavailable for t in targets):
+            response.status_code = 503
+            response.text = '<html>Service Unavailable</html>'
+            response.json.side_effect = json.JSONDecodeError(
+                'Expecting value', response.text, 0
+            )
+            return response
+        if any(t in invalid for t in targets):
+            response.text = 'Bad target'
+            response.json.side_effect = json.JSONDecodeError(
+                'Expecting value', 'Bad target', 0
+            )
+        else:
+            response.json.return_value = []
+        return response
+
+    return Mock(get=Mock(side_effect=get))
+
+
+def _requested_targets(session):
+    return [
+        [v for k, v in c[1]['params'] if k == 'target']
+        for c in session.get.call_args_list
+    ]
+
+
+class TargetValidatorTest(TestCase):
+    def test_render_params(self):
+        self.assertEqual(
+            requests.Request(
+                'GET', 'http://graphite/render', params=render_params(['a.b'])
+            )
+            .prepare()
+            .url,
+            'http://graphite/render?format=json&target=a.b&from=-1min'
+            '&noNullPoints=true&maxDataPoints=1',
+        )
+
+    def test_deduplicated(self):
+        session = _session()
+        results = TargetValidator('url', session, workers=4).check(
+            ['a', 'b', 'a', 'c', 'b']
+        )
+        self.assertEqual(sorted(results), ['a', 'b', 'c'])
+        self.assertTrue(all(r.ok for r in results.values()))
+        self.assertEqual(sorted(_requested_targets(session)), [['a'], ['b'], ['c']])
+
+    def test_batches(self):
+        session = _session(invalid={'c'}, broken={'e'})
+        results = TargetValidator('url', session, batch_size=3).check(
+            ['a', 'b', 'c', 'd', 'e']
+        )
+
+        self.assertEqual(
+            _requested_targets(session),
+            [['a', 'b', 'c'], ['a'], ['b'], ['c'], ['d', 'e'], ['d'], ['e']],
+        )
+        self.assertEqual([t for t, r in results.items() if r.ok], ['a', 'b', 'd'])
+        self.assertEqual(results['c'].text, 'Bad target')
+        self.assertIsInstance(results['e'].exception, requests.ConnectionError)
+
+    def test_cached(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'validation.cache')
+
+        session = _session(invalid={'b'}, broken={'c'}, unavailable={'d'})
+        validation_cache = ValidationCache(path)
+        results = TargetValidator('url', session, cache=validation_cache).check(
+            ['a', 'b', 'c', 'd']
+        )
+        validation_cache.save()
+        self.assertEqual(_requested_targets(session), [['a'], ['b'], ['c'], ['d']])
+        self.assertIsNone(results['d'].text)
+        self.assertIsInstance(results['d'].exception, RuntimeError)
+
+        session = _session()
+        validation_cache = ValidationCache(path)
+        results = TargetValidator('url', session, cache=validation_cache).check(
+            ['a', 'b', 'c', 'd']
+        )
+        # the failed request of c and the 503 of d are not cached
+        self.assertEqual(_requested_targets(session), [['c'], ['d']])
+        self.assertEqual(
+            {t: r.ok for t, r in results.items()},
+            {'a': True, 'b': False, 'c': True, 'd': True},
+        )
+        self.assertEqual(results['b'].text, 'Bad target')
+        self.assertEqual((validation_cache.hits, validation_cache.misses), (2, 2))
+
+
+class ValidateConfigTest(TestCase):
+    def test_reported_per_trigger_and_target(self):
+        data = Alerts(
+            triggers=[
+                {'name': 'first', 'tags': ['t'], 'targets': ['a', 'bad']},
+                {'name': 'second', 'tags': ['t'], 'targets': ['a', 'down']},
+            ]
+        )
+        logger = Mock()
+        validator = TargetValidator(
+            'url', _session(invalid={'bad'}, broken={'down'}), workers=2, batch_size=2
+        )
+
+        self.assertFalse(validate_config(data, validator, logger))
+        self.assertEqual(
+            [c[0][0] for c in logger.info.call_args_list],
+            ['Trigger: "first", target: "0" OK', 'Trigger: "second", target: "0" OK'],
+        )
+        self.assertEqual(
+            [c[0][0] for c in logger.error.call_args_list],
+            [
+                'Trigger: "first", target: "1" ERROR: Bad target',
+                'Trigger: "second", target: "1", exception: "connection refused"',
+            ],
+        )
+
+
+class ValidateConfigsTest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        for path in ('a/alert.yaml', 'b/c/Alert.yaml', 'b/other.yaml', 'bad.yaml'):
+            os.makedirs(
+                os.path.dirname(os.path.join(self.directory, path)), exist_ok=True
+            )
+            with open('tests/valid_config.yaml') as source, open(
+                os.path.join(self.directory, path), 'w'
+            ) as target:
+                target.write('triggers: 5' if path == 'bad.yaml' else source.read())
+
+    def _path(self, path):
+        return os.path.join(self.directory, path)
+
+    def test_find_configs(self):
+        self.assertEqual(
+            find_configs(
+                [self._path('b'), self._path('**/*.yaml'), self._path('missing.yaml')]
+            ),
+            [
+                self._path('b/c/Alert.yaml'),
+                self._path('a/alert.yaml'),
+                self._path('b/other.yaml'),
+                self._path('bad.yaml'),
+                self._path('missing.yaml'),
+            ],
+        )
+
+    def test_read_and_validate(self):
+        filenames = [
+            self._path('a/alert.yaml'),
+            self._path('bad.yaml'),
+            self._path('b/other.yaml'),
+        ]
+        configs = read_configs(filenames, None, workers=2)
+        self.assertEqual([c.filename for c in configs], filenames)
+        self.assertEqual([c.data is None for c in configs], [False, True, False])
+        self.assertIn('ValidationError', configs[1].error)
+
+        session = _session()
+        status = validate_configs(configs, TargetValidator('url', session), Mock())
+        self.assertEqual(status, dict(zip(filenames, [True, False, True])))
+        # both valid configs are the same, their targets are rendered once
+        targets = [
+            target for trigger in configs[0].data.triggers for target in trigger.targets
+        ]
+        self.assertEqual(session.get.call_count, len(set(targets)))
+
+    def test_unreadable_file(self):
+        (config,) = read_configs([self._path('missing.yaml')], None, workers=1)
+        self.assertEqual(
+            config, ConfigFile(self._path('missing.yaml'), None, config.error)
+        )
+        self.assertIn('FileNotFoundError', config.error)
@@ -0,0 +1,113 @@
+import threading
+import uuid
+
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from moira_client import Moira
+
+from alert_autoconf.models import Trigger
+from alert_autoconf.moira import MoiraAlert
+from alert_autoconf.snapshot import TriggerSnapshot
+
+from fakes import FakeRedis, mock_trigger
+
+
+def _make_trigger(**kwargs):
+    fields = {'name': 'trigger', 'tags': ['tag'], 'targets': ['target']}
+    fields.update(kwargs)
+    return Trigger(**fields)
+
+
+class TriggerWriteTest(TestCase):
+    def setUp(self):
+        self.moira = Moira('http://localhost:1234/api/')
+        self.redis = FakeRedis()
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def _create(self, **fields):
+        trigger = mock_trigger(**fields)
+
+        def save():
+            if fields['name'] == 'broken':
+                raise RuntimeError('broken')
+            if fields['name'] == 'interrupted':
+                raise KeyboardInterrupt()
+            with self.lock:
+                self.calls.append(('save', trigger.id))
+
+        trigger.save = Mock(side_effect=save)
+        return trigger
+
+    def _delete(self, trigger_id):
+        with self.lock:
+            self.calls.append(('delete', trigger_id))
+        return True
+
+    def test_errors_do_not_stop_other_triggers(self):
+        triggers = [_make_trigger(name=name) for name in ('a', 'broken', 'b', 'c')]
+        with patch.object(self.moira, '_trigger') as _trigger_mock:
+            _trigger_mock.create = Mock(side_effect=self._create)
+            alert = MoiraAlert(self.moira, self.redis, 'test', write_workers=4)
+            with self.assertLogs(level='ERROR') as logs, self.assertRaisesRegex(
+                RuntimeError, 'broken'
+            ):
+                alert._create_trigger(triggers)
+
+        self.assertIn('name :: broken', logs.output[0])
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(self.redis.commands['SADD'], 1)
+        self.assertEqual(
+            self.redis.smembers(alert.trigger_token),
+            {trigger_id.encode() for _, trigger_id in self.calls},
+        )
+
+    @patch('alert_autoconf.storage.REGISTER_CHUNK_SIZE', 2)
+    def test_interrupted_run_registers_saved_triggers(self):
+        triggers = [
+            _make_trigger(name=name) for name in ('a', 'b', 'c', 'interrupted', 'd')
+        ]
+        with patch.object(self.moira, '_trigger') as _trigger_mock:
+            _trigger_mock.create = Mock(side_effect=self._create)
+            alert = MoiraAlert(self.moira, self.redis, 'test', write_workers=1)
+            with self.assertRaises(KeyboardInterrupt):
+                alert._create_trigger(triggers)
+
+        self.assertEqual(len(self.calls), 3)
+        # the first chunk and 'c', saved in the interrupted chunk, are registered
+        self.assertEqual(
+            self.redis.smembers(alert.trigger_token),
+            {trigger_id.encode() for _, trigger_id in self.calls},
+        )
+        self.assertEqual(self.redis.commands['SADD'], 2)
+
+    def test_updates_before_deletes(self):
+        ids = [str(uuid.uuid4()) for _ in range(8)]
+        api_triggers = [
+            _make_trigger(id=ids[i], name=str(i), desc='old') for i in range(8)
+        ]
+        self.redis.sadd('autoconf:token:test', *ids)
+        triggers = [_make_trigger(name=str(i), desc='new') for i in range(0, 8, 2)]
+        snapshot = TriggerSnapshot(api_triggers, registered=True)
+
+        with patch.object(self.moira, '_trigger') as _trigger_mock:
+            _trigger_mock.create = Mock(side_effect=self._create)
+            _trigger_mock.delete = Mock(side_effect=self._delete)
+            alert = MoiraAlert(self.moira, self.redis, 'test', write_workers=4)
+            alert._triggers_worker(triggers, snapshot, ignore_inheritance=True)
+
+        kinds = [kind for kind, _ in self.calls]
+        self.assertEqual(kinds, ['save'] * 4 + ['delete'] * 4)
+        self.assertEqual(
+            {i for kind, i in self.calls if kind == 'delete'}, set(ids[1::2])
+        )
+        self.assertEqual(
+            self.redis.smembers(alert.trigger_token), {i.encode() for i in ids[::2]}
+        )
+        self.assertEqual(self.redis.commands['SREM'], 1)
+        self.assertEqual([t.desc for t in snapshot.triggers()], ['new'] * 4)
+
+    def test_invalid_write_workers_raises_ValueError(self):
+        with self.assertRaises(ValueError):
+            MoiraAlert(self.moira, self.redis, 'test', write_workers=0)